@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+'''
+bench-pipeline: time the frame pipeline on synthetic experiments.
+
+For each scale and label style, an experiment is generated with
+  make-synthetic-exp.py and run through the same scripts used on real
+  data: the style's cache script (suzhou-cache-frames.py or
+  nasalcoda-cache-frames.py) on each subject, process-cache.py on the
+  resulting caches, and the style's PCA/LDA script. Every stage runs
+  in its own process, so its wall time and peak memory (maximum
+  resident set size) can be measured separately; stage output goes to
+  logs/ in the working directory.
+
+Results are printed as a table and written to bench_results.json in
+  the working directory: one record per scale, style and stage, with
+  frames handled, seconds, frames per second, peak memory in MB and
+  the stage's exit status. A stage that fails (e.g. because imgphon or
+  scikit-learn isn't installed) is recorded and the rest of that run
+  skipped.
+
+Usage: python bench-pipeline.py [workdir] [--scales small,medium]
+         [--styles suzhou,nasalcoda] [--stages generate,cache,process,pca]
+         [--jobs N]
+  workdir: directory for experiments, caches, logs and results; must
+    not contain a previous run of the same scale and style
+  --scales: comma-separated names from SCALES below
+  --frames, --geometry: override the frames per acquisition and frame
+    geometry of every scale
+  --jobs: passed to the cache scripts (acquisitions in parallel)
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from ultramisc.metadata import load_metadata, metadata_path
+from ultramisc.synthetic import GEOMETRY, STYLES
+
+# experiment sizes; frames per acquisition are about 2 s at 60 fps
+SCALES = {
+	'small': {'subjects': 1, 'acqs': 16, 'frames': 120},
+	'medium': {'subjects': 2, 'acqs': 64, 'frames': 120},
+	'large': {'subjects': 4, 'acqs': 200, 'frames': 120},
+}
+
+STAGES = ['generate', 'cache', 'process', 'pca']
+
+here = os.path.dirname(os.path.abspath(__file__))
+dimred = os.path.join(os.path.dirname(here), "dim-reduction")
+
+CACHE_SCRIPTS = {
+	'suzhou': "suzhou-cache-frames.py",
+	'nasalcoda': "nasalcoda-cache-frames.py",
+}
+PCA_SCRIPTS = {
+	'suzhou': "suzhou-pca-lda.py",
+	'nasalcoda': "nasalcoda-pca-lda.py",
+}
+
+# stages are started from a minimal launcher process: a child's peak
+# memory includes the memory of the process it was forked from, which
+# would otherwise be this one, with numpy and pandas loaded
+LAUNCHER = """
+import os, subprocess, sys, time
+with open(sys.argv[1], "w") as log:
+	start = time.perf_counter()
+	proc = subprocess.Popen(sys.argv[2:], stdout=log, stderr=subprocess.STDOUT,
+							stdin=subprocess.DEVNULL)
+	_, status, usage = os.wait4(proc.pid, 0)
+print(os.waitstatus_to_exitcode(status), time.perf_counter() - start, usage.ru_maxrss)
+"""
+
+def run(cmd, logfile):
+	'''
+	Run cmd with output to logfile; return (exit code, seconds, peak
+	  resident memory in MB) of that process alone.
+	'''
+	out = subprocess.check_output([sys.executable, "-c", LAUNCHER, logfile] + cmd)
+	status, seconds, maxrss = out.split()
+	# ru_maxrss is in kilobytes on Linux, bytes on macOS
+	peak = int(maxrss) / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+	return int(status), float(seconds), peak
+
+def count_rows(dirs, stem):
+	'''
+	Total metadata rows of the caches called stem in dirs.
+	'''
+	total = 0
+	for d in dirs:
+		if os.path.exists(metadata_path(d, stem)):
+			total += len(load_metadata(d, stem))
+	return total
+
+def link_caches(subjdirs, cachedir):
+	'''
+	Hardlink each subject's frame cache into cachedir/<subject>, the
+	  layout process-cache.py expects (no acquisition folders below).
+	'''
+	out = []
+	for subjdir in subjdirs:
+		dest = os.path.join(cachedir, os.path.basename(subjdir))
+		os.makedirs(dest)
+		for path in (os.path.join(subjdir, "frames.npy"), metadata_path(subjdir, "frames")):
+			os.link(path, os.path.join(dest, os.path.basename(path)))
+		out.append(dest)
+	return out
+
+def bench(workdir, scale, style, args):
+	'''
+	Run all requested stages for one scale and style; return records.
+	'''
+	size = dict(SCALES[scale])
+	if args.frames is not None:
+		size['frames'] = args.frames
+	name = "{}-{}".format(scale, style)
+	expdir = os.path.join(workdir, name)
+	cachedir = os.path.join(workdir, name + "-caches")
+	logdir = os.path.join(workdir, "logs")
+	subjdirs = [os.path.join(expdir, "subj{}".format(s + 1)) for s in range(size['subjects'])]
+	py = sys.executable
+
+	records = []
+	def record(stage, frames, status, seconds, peak):
+		rec = {
+			'scale': scale, 'style': style, 'stage': stage,
+			'subjects': size['subjects'], 'acqs': size['acqs'],
+			'frames_per_acq': size['frames'], 'geometry': list(args.geometry),
+			'raw_frames': size['subjects'] * size['acqs'] * size['frames'],
+			'frames': frames, 'seconds': round(seconds, 3),
+			'frames_per_sec': round(frames / seconds, 1) if seconds > 0 else None,
+			'peak_mb': round(peak, 1), 'status': status,
+		}
+		records.append(rec)
+		print("{:<8} {:<10} {:<9} {:>8} {:>9.2f} {:>10} {:>9.1f} {:>5}".format(
+			scale, style, stage, frames, seconds,
+			"-" if rec['frames_per_sec'] is None else rec['frames_per_sec'],
+			peak, status))
+		return status == 0
+
+	if 'generate' in args.stages:
+		cmd = [py, os.path.join(here, "make-synthetic-exp.py"), expdir,
+			   "--style", style, "--subjects", str(size['subjects']),
+			   "--acqs", str(size['acqs']), "--frames", str(size['frames']),
+			   "--geometry"] + [str(g) for g in args.geometry]
+		status, seconds, peak = run(cmd, os.path.join(logdir, name + "-generate.log"))
+		if not record('generate', size['subjects'] * size['acqs'] * size['frames'],
+					  status, seconds, peak):
+			return records
+
+	if 'cache' in args.stages:
+		total_s, max_peak, status = 0.0, 0.0, 0
+		for subjdir in subjdirs:
+			cmd = [py, os.path.join(dimred, CACHE_SCRIPTS[style]), subjdir]
+			if style == 'nasalcoda':
+				cmd += [os.path.join(expdir, "words.txt"), os.path.join(expdir, "segments.txt")]
+			cmd += ["--jobs", str(args.jobs)]
+			logfile = os.path.join(logdir, "{}-cache-{}.log".format(name, os.path.basename(subjdir)))
+			status, seconds, peak = run(cmd, logfile)
+			total_s += seconds
+			max_peak = max(max_peak, peak)
+			if status != 0:
+				break
+		if not record('cache', count_rows(subjdirs, "frames"), status, total_s, max_peak):
+			return records
+
+	cachedirs = [os.path.join(cachedir, os.path.basename(s)) for s in subjdirs]
+	if 'process' in args.stages:
+		if not os.path.exists(cachedir):
+			cachedirs = link_caches(subjdirs, cachedir)
+		cmd = [py, os.path.join(dimred, "process-cache.py"), cachedir]
+		status, seconds, peak = run(cmd, os.path.join(logdir, name + "-process.log"))
+		if not record('process', count_rows(cachedirs, "frames"), status, seconds, peak):
+			return records
+
+	if 'pca' in args.stages:
+		cmd = [py, os.path.join(dimred, PCA_SCRIPTS[style]), cachedir,
+			   "--pca_dim", str(args.pca_dim), "--lda_dim", str(args.lda_dim)]
+		status, seconds, peak = run(cmd, os.path.join(logdir, name + "-pca.log"))
+		record('pca', count_rows(cachedirs, "frames_proc"), status, seconds, peak)
+	return records
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("workdir",
+						help="Directory for experiments, caches, logs and results"
+						)
+	parser.add_argument("--scales",
+						help="Comma-separated scales to run, from {} \
+						(default small,medium)".format(", ".join(SCALES)),
+						default="small,medium"
+						)
+	parser.add_argument("--styles",
+						help="Comma-separated label styles (default all)",
+						default=",".join(sorted(STYLES))
+						)
+	parser.add_argument("--stages",
+						help="Comma-separated stages to run (default all: {})".format(
+							",".join(STAGES)),
+						default=",".join(STAGES)
+						)
+	parser.add_argument("-n",
+						"--frames",
+						help="Frames per acquisition, overriding the scales' own",
+						type=int,
+						default=None
+						)
+	parser.add_argument("-g",
+						"--geometry",
+						help="Frame geometry: nscanlines npoints junk \
+						(default {} {} {})".format(*GEOMETRY),
+						type=int,
+						nargs=3,
+						default=list(GEOMETRY)
+						)
+	parser.add_argument("-j",
+						"--jobs",
+						help="Acquisitions processed in parallel by the cache \
+						scripts (default 1; 0 for one per CPU)",
+						type=int,
+						default=1
+						)
+	parser.add_argument("-p",
+						"--pca-dim",
+						help="Principal components for PCA/LDA (default 10)",
+						type=int,
+						default=10
+						)
+	parser.add_argument("-l",
+						"--lda-dim",
+						help="Linear discriminants for PCA/LDA (default 1)",
+						type=int,
+						default=1
+						)
+	args = parser.parse_args()
+
+	scales = args.scales.split(",")
+	styles = args.styles.split(",")
+	args.stages = args.stages.split(",")
+	for value,known,what in ((scales, SCALES, "scale"), (styles, STYLES, "style"),
+							 (args.stages, STAGES, "stage")):
+		unknown = [v for v in value if v not in known]
+		if unknown:
+			print("\tUnknown {}(s): {}".format(what, ", ".join(unknown)))
+			parser.print_help()
+			sys.exit(2)
+
+	os.makedirs(os.path.join(args.workdir, "logs"), exist_ok=True)
+	results_out = os.path.join(args.workdir, "bench_results.json")
+
+	print("{:<8} {:<10} {:<9} {:>8} {:>9} {:>10} {:>9} {:>5}".format(
+		"scale", "style", "stage", "frames", "seconds", "frames/s", "peak MB", "exit"))
+	records = []
+	for scale in scales:
+		for style in styles:
+			records.extend(bench(args.workdir, scale, style, args))
+			with open(results_out, "w") as out:
+				json.dump(records, out, indent=1)
+	print("Results written to {}".format(results_out))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+'''
+make-synthetic-exp: write a synthetic EchoB experiment directory (see
+  ultramisc.synthetic) for testing and benchmarking the pipeline.
+
+Usage: python make-synthetic-exp.py [expdir] [--style suzhou] [--subjects 1]
+         [--acqs 10] [--frames 120] [--geometry 127 1020 36] [--seed 0]
+  expdir: directory to create; one subj<N> folder of acquisitions
+    is written in it per subject
+  --style: label style, suzhou or nasalcoda (which also writes
+    words.txt and segments.txt for nasalcoda-cache-frames.py)
+  --frames: ultrasound frames per acquisition
+  --geometry: nscanlines, npoints and junk of each frame
+  --no-sidecars: don't write compiled tier sidecars (the TextGrids
+    are then parsed with audiolabel on first use)
+'''
+
+import argparse
+import os
+import sys
+
+from ultramisc.synthetic import FRAME_RATE, GEOMETRY, STYLES, make_experiment
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("expdir",
+						help="Experiment directory to create"
+						)
+	parser.add_argument("-s",
+						"--style",
+						help="Label style (default suzhou)",
+						choices=sorted(STYLES),
+						default="suzhou"
+						)
+	parser.add_argument("--subjects",
+						help="Number of subjects (default 1)",
+						type=int,
+						default=1
+						)
+	parser.add_argument("-a",
+						"--acqs",
+						help="Acquisitions per subject (default 10)",
+						type=int,
+						default=10
+						)
+	parser.add_argument("-n",
+						"--frames",
+						help="Frames per acquisition (default 120)",
+						type=int,
+						default=120
+						)
+	parser.add_argument("-g",
+						"--geometry",
+						help="Frame geometry: nscanlines npoints junk \
+						(default {} {} {})".format(*GEOMETRY),
+						type=int,
+						nargs=3,
+						default=list(GEOMETRY)
+						)
+	parser.add_argument("--fps",
+						help="Frame rate (default {})".format(FRAME_RATE),
+						type=float,
+						default=FRAME_RATE
+						)
+	parser.add_argument("--seed",
+						help="Random seed (default 0)",
+						type=int,
+						default=0
+						)
+	parser.add_argument("--no-sidecars",
+						help="Don't write compiled tier sidecars",
+						action="store_true"
+						)
+	args = parser.parse_args()
+
+	if os.path.exists(args.expdir):
+		print("\t{} already exists".format(args.expdir))
+		sys.exit(2)
+
+	summary = make_experiment(args.expdir, subjects=args.subjects, acqs=args.acqs,
+							  nframes=args.frames, geometry=tuple(args.geometry),
+							  style=args.style, fps=args.fps,
+							  sidecars=not args.no_sidecars, seed=args.seed)
+	print("{} acquisitions, {} frames ({:.1f} MB of .raw data) in {}".format(
+		summary['acqs'], summary['frames'], summary['bytes'] / 1e6, args.expdir))
+
+if __name__ == "__main__":
+	main()
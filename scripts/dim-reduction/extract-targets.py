@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''
+extract-targets: build one frame cache per target set listed in a spec
+  file, in a single pass over an experiment's acquisitions. See
+  ultramisc.extract for the spec format and example-targets.json for
+  the Suzhou and nasal coda targets expressed as a spec. Target sets
+  whose tiers an experiment's TextGrids lack are skipped (and the skips
+  logged), so the example runs on either project's data; its Suzhou set
+  writes the same frames.npy and pron column as suzhou-cache-frames.
+
+Usage: python extract-targets.py [expdir] [spec] [--flop -f] [--jobs -j N]
+  expdir: directory containing all ultrasound acquisitions for a subject
+  spec: JSON file listing the target sets to extract
+  --flop: horizontally mirror the data (if probe was used backwards)
+  --jobs: number of acquisitions to process in parallel (0: one per CPU)
+'''
+
+import argparse
+import os
+import sys
+
+from ultramisc.catalog import add_catalog_args, open_catalog
+from ultramisc.extract import extract
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("expdir", 
+						help="Experiment directory containing \
+						acquisitions in flat structure"
+						)
+	parser.add_argument("spec",
+						help="JSON file listing target sets to be extracted"
+						)
+	parser.add_argument("-f", 
+						"--flop", 
+						help="Horizontally flip the data", 
+						action="store_true"
+						)
+	parser.add_argument("-j",
+						"--jobs",
+						help="Number of acquisitions to process in parallel \
+						(default 1; 0 for one per CPU)",
+						type=int,
+						default=1
+						)
+	add_catalog_args(parser)
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.expdir):
+		print("\tDirectory provided doesn't exist")
+		parser.print_help()
+		sys.exit(2)
+
+	# ask for frame dimensions if the first acquisition has none
+	geometry = None
+	with open_catalog(args.expdir, args) as catalog:
+		acqs = catalog.acquisitions()
+	if len(acqs) > 0 and acqs[0].nscanlines is None:
+		print("WARNING: no data in {}.img.txt, please input:".format(acqs[0].timestamp))
+		nscanlines = int(input("\tnscanlines (usually 127) "))
+		npoints = int(input("\tnpoints (usually 1020) "))
+		junk = int(input("\tjunk (usually 36, or 1020 - 984) "))
+		geometry = (nscanlines, npoints, junk)
+
+	counts = extract(args.expdir, args.spec, flop=args.flop, jobs=args.jobs, geometry=geometry)
+	for name,n in counts.items():
+		print("{}: {} rows cached".format(name, n))
+
+if __name__ == "__main__":
+	main()
@@ -6,143 +6,92 @@ pre-trained Mandarin Chinese acoustic model.
 Lists of target segments and/or can be input to selectively extract data. If
 either list is omitted, no restrictions are 
 
-Usage: python nasalcoda-cache-frames.py [expdir] [words] [segments] [--flop -f]
+Usage: python nasalcoda-cache-frames.py [expdir] [words] [segments] [--flop -f] [--jobs -j N]
   expdir: directory containing all ultrasound acquisitions for a subject
   words: list of target words, plaintext
   segments: list of target segments, plaintext (including suprasegmentals)
   --flop: horizontally mirror the data (if probe was used backwards)
+  --jobs: number of acquisitions to process in parallel (0: one per CPU)
 '''
 
 import argparse
-import audiolabel
-import glob
 import numpy as np
 import os
-import pandas as pd
 import re
-import shutil
 import sys
 
-from collections import OrderedDict
 from hashlib import sha1
-from operator import itemgetter
-from ultratils.rawreader import RawReader
-
-from ultramisc.ebutils import read_echob_metadata, read_stimfile
-
-def read_stimfile(stimfile):
-	with open(stimfile, "r") as stfile:
-		stim = stfile.read().rstrip('\n').upper()
-	return stim
-
-# read in command line arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("expdir", 
-					help="Experiment directory containing \
-					acquisitions in flat structure"
-					)
-parser.add_argument("words",
-					help="Plaintext list of target words to be extracted"
-					)
-parser.add_argument("segments",
-					help="Plaintext list of target segments to be extracted"
-					)
-parser.add_argument("-f", 
-					"--flop", 
-					help="Horizontally flip the data", 
-					action="store_true"
-					)
-args = parser.parse_args()
-
-# check for appropriate directory
-try:
-	expdir = args.expdir
-except IndexError:
-	print("\tDirectory provided doesn't exist")
-	ArgumentParser.print_usage
-	ArgumentParser.print_help
-	sys.exit(2)
-
-frames_out = os.path.join(expdir,"frames.npy")
-metadata_out = os.path.join(expdir,"frames_metadata.pickle")
-
-# glob expression: locates .raw files in subdirs
-rawfile_glob_exp = os.path.join(expdir,"*","*.raw")
-
-# create regular expressions for target words and segments
-# TODO: default to match ^(?!sil|sp).* for phones
-# TODO: default to match "not nothing" for words 
-with open(args.words, 'r') as mydict:
-	wrds = [line.strip().split()[0].lower() for line in mydict.readlines()]
-with open(args.segments,'r') as mysegm:
-	segs = [line.strip().split()[0] for line in mysegm.readlines()]
-	
-# make a more generally useful regular expression for segments
-# TODO set these to "any alphanumeric label which isn't sp or sil" if args
-# aren't provided
-word_regexp = re.compile("^({})$".format('|'.join(wrds)))
-seg_regexp = re.compile("^({})$".format('|'.join(segs)))
-
-# folder path for discards
-disc = os.path.join(expdir,"_discards")
-
-# empty data collection objects
-data = None
-recs = []
-
-# loop through available .raw files
-for rf in glob.glob(rawfile_glob_exp):
-	parent = os.path.dirname(rf)
-	acq = os.path.split(parent)[1]
-	stimfile = os.path.join(parent,"stim.txt")
-	stim = read_stimfile(stimfile)
-	if stim == "BOLUS" or stim == "PRACTICE":
-		continue
-	print("Now working on " + acq)
-	wav = os.path.join(parent,str(acq + ".ch1.wav"))
+
+from ultramisc.catalog import add_catalog_args, open_catalog
+from ultramisc.discards import record_discard, relocate
+from ultramisc.framecache import FrameCacheWriter
+from ultramisc.integrity import verify_frames
+from ultramisc.manifest import remove_manifest
+from ultramisc.metadata import NASALCODA_SCHEMA, MetadataBuilder
+from ultramisc.parallel import imap_ordered
+from ultramisc.rawframes import RawFrames
+from ultramisc.sync import load_sync_tiers
+from ultramisc.tiers import load_tiers
+
+def extract_acq(job):
+	"""
+	Find the target frames in one acquisition. Runs in a worker process
+	  when --jobs is given, so nothing is printed or moved here; the main
+	  process does that with the returned dict, in timestamp order.
+	Inputs: job, tuple of (Acquisition, stim, (nscanlines, npoints, junk),
+	  flop, expdir, wrds, seg_regexp).
+	"""
+	acq_rec, stim, (nscanlines, npoints, junk), flop, expdir, wrds, seg_regexp = job
+	rf = acq_rec.raw
+	parent = acq_rec.parent
+	acq = acq_rec.timestamp
+
+	result = {
+		'acq': acq,
+		'parent': parent,
+		'data': None, # frames, or None if no targets found
+		'recs': None, # MetadataBuilder, one row per frame
+		'msgs': ["Now working on " + acq], # progress messages
+		'discard': None # reason, phone and frame offset if discarded
+	}
+
 	tg = os.path.join(parent,str(acq + ".ch1.TextGrid"))
-	sync = os.path.join(parent,str(acq + '.sync.txt'))
 	sync_tg = os.path.join(parent,str(acq + ".sync.TextGrid"))
-	idx_txt = os.path.join(parent,str(acq + ".idx.txt"))
-	
-	# instantiate RawReader, which extracts ultrasound data from .raw files
-	if data is None:
-		try:
-			nscanlines, npoints, junk = read_echob_metadata(rf)
-		except ValueError: 
-			print("WARNING: no data in {}.img.txt".format(acq))
-			nscanlines = int(input("\tnscanlines (usually 64) ")) # TODO update values
-			npoints = int(input("\tnpoints (usually 1024) "))
-			junk = int(input("\tjunk (usually 78) "))
 	
-	rdr = RawReader(rf, nscanlines=nscanlines, npoints=npoints)
-	
-	# instantiate LabelManager objects for FA transcript and sync pulses
+	# load compiled tiers for FA transcript and sync pulses
 	try: 
-		pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
+		tg_tiers = load_tiers(tg)
 	except FileNotFoundError:
-		print("No alignment TG in {}; skipping".format(acq))
-		continue
+		result['msgs'].append("No alignment TG in {}; skipping".format(acq))
+		return result
 		
 	try: 
-		sync_pm = audiolabel.LabelManager(from_file=sync_tg, from_type="praat")
+		sync_idx = load_sync_tiers(sync_tg, tiers=('pulse_idx', 'raw_data_idx'))
 	except FileNotFoundError:
-		print("No sync TG in {}; skipping".format(acq))
-		continue
+		result['msgs'].append("No sync TG in {}; skipping".format(acq))
+		return result
+
+	# instantiate RawFrames, which maps ultrasound data from .raw files
+	rdr = RawFrames(rf, nscanlines=nscanlines, npoints=npoints, junk=junk, flop=flop)
+
+	# target frame indices and metadata for current acq
+	acq_idxs = []
+	acq_recs = []
+	discard_acq = False
 	
-	for seg,match in pm.tier('phones').search(seg_regexp, return_match=True):
-		context = pm.tier('words').label_at(seg.center).text
+	for seg,match in tg_tiers['phones'].search(seg_regexp, return_match=True):
+		context = tg_tiers['words'].label_at(seg.center).text
 		if context in wrds:  
-			before = pm.tier('phones').prev(seg)
+			before = tg_tiers['phones'].prev(seg)
 
 			# assume default "sp" if there is no following label;
 			# i.e. empty final interval
-			after = pm.tier('phones').next(seg)
+			after = tg_tiers['phones'].next(seg)
 			try:
 				after_label = after.text
 			except AttributeError: 
 				after_label = 'sp'
-			two_after = pm.tier('phones').next(after)
+			two_after = tg_tiers['phones'].next(after)
 			try:
 				two_after_label = two_after.text
 			except AttributeError: 
@@ -168,66 +117,167 @@ for rf in glob.glob(rawfile_glob_exp):
 					
 				# get midpoint time and find closest ultrasound frame in sync TG
 				midpoint = seg.center
-				diff_list = []
-				diff2_list = []
-				for frame in sync_pm.tier('pulse_idx'):
-					diff = abs(frame.t1 - midpoint)
-					diff_list.append(diff)
-				for frame in sync_pm.tier('raw_data_idx'):
-					diff2 = abs(frame.t1 - midpoint)
-					diff2_list.append(diff2)
-				# TODO rewrite this chunk, temporary fix added
-				mid_pulse_idx_num = min(enumerate(diff_list), key=itemgetter(1))[0] 
-				mid_raw_data_idx_num = min(enumerate(diff2_list), key=itemgetter(1))[0]
+				mid_pulse_idx_num = sync_idx['pulse_idx'].nearest(midpoint)
+				mid_raw_data_idx_num = sync_idx['raw_data_idx'].nearest(midpoint)
 				
 				# get midpoint frame; discard if out of recorded range
-				try:
-					raw = rdr.get_frame(mid_pulse_idx_num - 1) # temporary fix
-				except IndexError: # thrown by RawReader.rdr if no frame at timepoint
+				frame_idx = mid_pulse_idx_num - 1 # temporary fix
+				if not rdr.has_frame(frame_idx):
 					# issue warning and move entire acq to discards folder
-					print("No frame available in {}, discarding".format(acq))
-					rdr.close()
-					if not os.path.isdir(disc):
-						os.mkdir(disc)
-					shutil.copytree(parent, os.path.join(disc,acq))
-					shutil.rmtree(parent)
-					continue
-
-				trim = raw[junk:,:]
-
-				# flop if needed
-				if args.flop:
-					trim = np.fliplr(trim)
+					result['msgs'].append("No frame available in {}, discarding".format(acq))
+					result['discard'] = {'reason': "no frame available", 'phone': seg.text, 'frame_offset': 0}
+					discard_acq = True
+					break
+
+				acq_idxs.append(frame_idx)
+				acq_recs.append({
+					'speaker': expdir,
+					'timestamp': acq,
+					'time': midpoint,
+					'pulseidx': int(mid_pulse_idx_num),
+					'width': nscanlines,
+					'height': npoints - junk,
+					'phone': out_phone,
+					'sup': out_sup,
+					'stim': stim,
+					'before': re.sub(r'[0-9]+', '', before.text),
+					'after': re.sub(r'[0-9]+', '', after.text)
+				})
+
+	# read all target frames in the acq at once (trimmed, flopped if needed)
+	if len(acq_idxs) > 0 and not discard_acq:
+		acq_data = rdr.get_frames(acq_idxs)
+		acq_md = MetadataBuilder(NASALCODA_SCHEMA, capacity=len(acq_recs))
+		for trim,rec in zip(acq_data, acq_recs):
+			acq_md.append(rec, sha1=sha1(trim.ravel()).hexdigest(), sha1_dtype=trim.dtype)
+		result['data'] = acq_data
+		result['recs'] = acq_md
+	rdr.close()
+
+	return result
+
+def main():
+	# read in command line arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument("expdir", 
+						help="Experiment directory containing \
+						acquisitions in flat structure"
+						)
+	parser.add_argument("words",
+						help="Plaintext list of target words to be extracted"
+						)
+	parser.add_argument("segments",
+						help="Plaintext list of target segments to be extracted"
+						)
+	parser.add_argument("-f", 
+						"--flop", 
+						help="Horizontally flip the data", 
+						action="store_true"
+						)
+	parser.add_argument("-j",
+						"--jobs",
+						help="Number of acquisitions to process in parallel \
+						(default 1; 0 for one per CPU)",
+						type=int,
+						default=1
+						)
+	parser.add_argument("-r",
+						"--relocate",
+						help="Also move discarded acquisitions to the _discards \
+						folder (by renaming; never copies data)",
+						action="store_true"
+						)
+	add_catalog_args(parser)
+	args = parser.parse_args()
+
+	# check for appropriate directory
+	try:
+		expdir = args.expdir
+	except IndexError:
+		print("\tDirectory provided doesn't exist")
+		ArgumentParser.print_usage
+		ArgumentParser.print_help
+		sys.exit(2)
+
+	frames_out = os.path.join(expdir,"frames.npy")
+	metadata_out = os.path.join(expdir,"frames_metadata.npz")
+
+	# create regular expressions for target words and segments
+	# TODO: default to match ^(?!sil|sp).* for phones
+	# TODO: default to match "not nothing" for words 
+	with open(args.words, 'r') as mydict:
+		wrds = [line.strip().split()[0].lower() for line in mydict.readlines()]
+	with open(args.segments,'r') as mysegm:
+		segs = [line.strip().split()[0] for line in mysegm.readlines()]
+		
+	# make a more generally useful regular expression for segments
+	# TODO set these to "any alphanumeric label which isn't sp or sil" if args
+	# aren't provided
+	word_regexp = re.compile("^({})$".format('|'.join(wrds)))
+	seg_regexp = re.compile("^({})$".format('|'.join(segs)))
+
+	# folder path for discards
+	disc = os.path.join(expdir,"_discards")
+
+	# empty data collection objects; ultrasound data is streamed
+	# to frames_out as it is found, replacing any earlier cache (and
+	# its manifest)
+	remove_manifest(expdir, "frames")
+	writer = FrameCacheWriter(frames_out)
+	md = MetadataBuilder(NASALCODA_SCHEMA)
+
+	# index of acquisitions (.raw files in subdirs); changed folders are
+	# re-read on every run, files edited in place with --refresh
+	catalog = open_catalog(expdir, args)
+
+	# loop through available .raw files, skipping non-trials
+	acqs = []
+	for acq_rec in catalog.acquisitions():
+		stim = (acq_rec.stim or "").upper()
+		if stim == "BOLUS" or stim == "PRACTICE":
+			continue
+		acqs.append((acq_rec, stim))
+
+	# frame dimensions, read from first acq
+	geometry = None
+	if len(acqs) > 0:
+		first = acqs[0][0]
+		if first.nscanlines is not None:
+			geometry = (first.nscanlines, first.npoints, first.junk)
+		else:
+			print("WARNING: no data in {}.img.txt".format(first.timestamp))
+			nscanlines = int(input("\tnscanlines (usually 64) ")) # TODO update values
+			npoints = int(input("\tnpoints (usually 1024) "))
+			junk = int(input("\tjunk (usually 78) "))
+			geometry = (nscanlines, npoints, junk)
+
+	# acquisitions are processed in parallel with --jobs, but results
+	# come back (and are written and discarded) in timestamp order
+	jobs = [(acq_rec, stim, geometry, args.flop, expdir, wrds, seg_regexp)
+			for acq_rec,stim in acqs]
+	for result in imap_ordered(extract_acq, jobs, jobs=args.jobs):
+		for msg in result['msgs']:
+			print(msg)
+
+		# discard the acquisition if needed; this is only recorded in
+		# the discard manifest, which the catalog respects from now on
+		if result['discard'] is not None:
+			record_discard(expdir, result['acq'], stage="nasalcoda-cache-frames", **result['discard'])
+			if args.relocate and not relocate(result['parent'], os.path.join(disc,result['acq'])):
+				print("Can't move {} to {} without copying; left in place".format(result['acq'], disc))
+			continue
+
+		if result['data'] is not None:
+			md.extend(result['recs'])
+			writer.extend(result['data'])
 				
-				if data is None:
-					data = np.expand_dims(trim, axis=0)
-				else:
-					data = np.concatenate([data, np.expand_dims(trim, axis=0)])
-					
-				recs.append(
-					OrderedDict([
-						('speaker', expdir),
-						('timestamp', acq),
-						('time', midpoint),
-						('pulseidx', int(mid_pulse_idx_num)),
-						('width', nscanlines),
-						('height', npoints - junk),
-						('phone', out_phone),
-						('sup', out_sup),
-						('stim', stim),
-						('before', re.sub(r'[0-9]+', '', before.text)),
-						('after', re.sub(r'[0-9]+', '', after.text)),
-						('sha1', sha1(trim.ravel()).hexdigest()),
-						('sha1_dtype', trim.dtype)
-					])
-				)
-			
-md = pd.DataFrame.from_records(recs, columns=recs[0].keys())
-
-# check that metadata matches data, frame-by-frame
-assert(len(md) == data.shape[0])
-for idx,row in md.iterrows():
-	assert(row['sha1'] == sha1(data[idx].ravel()).hexdigest())
-
-np.save(frames_out, data)
-md.to_pickle(metadata_out)
+	writer.close()
+	data = np.load(frames_out, mmap_mode='r')
+
+	# check that metadata matches data, frame-by-frame
+	verify_frames(data, md.to_frame(), column='sha1')
+
+	md.write(metadata_out)
+
+if __name__ == "__main__":
+	main()
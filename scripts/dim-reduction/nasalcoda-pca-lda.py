@@ -11,8 +11,11 @@ import pandas as pd
 import re
 import sys
 
-from hashlib import sha1
 from imgphon.ultrasound import reconstruct_frame
+from ultramisc.framestore import open_frame_cache
+from ultramisc.integrity import verify_frames
+from ultramisc.metadata import descriptive
+from ultramisc.procframes import crop_frames, read_crop
 from sklearn.decomposition import PCA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 
@@ -40,21 +43,17 @@ for root, dirs, files in os.walk(expdir):
 		if d.startswith("."): # don't run on MAC OS hidden directories
 			continue
 		subject = re.sub("[^0-9]","",d) # subject is any numbers in directory name
-		data_in = os.path.join(root,d,"frames_proc.npy")
-		data = np.load(data_in)
-		metadata_in = os.path.join(root,d,'frames_proc_metadata.pickle')
-		md_pre = pd.read_pickle(metadata_in)
+		store = open_frame_cache(os.path.join(root,d), "frames_proc")
+		# break off nasals specifically (vowels are in these data sets, too);
+		# only the selected frames are read from disk
+		nas_rows = store.select(phone=['n','ng'])
+		pca_data, md_pre = store.read(nas_rows)
 		# check that metadata matches data, frame-by-frame
-		assert(len(md_pre) == data.shape[0])
-		for idx,row in md_pre.iterrows():
-			assert(row['sha1_filt'] == sha1(data[idx].ravel()).hexdigest())
+		verify_frames(pca_data, md_pre, column='sha1_filt')
 		# get rid of hash columns after checking
-		md = md_pre.iloc[:,0:11].copy() 
-		
-		# break off nasals specifically (vowels are in these data sets, too)
-		nas_mask = md['phone'].isin(['n','ng'])
-		pca_data = data[nas_mask]
-		pca_md = md[nas_mask]
+		pca_md = descriptive(md_pre)
+		# keep only the RoI's box if frames were cropped to it in processing
+		pca_data = crop_frames(pca_data, read_crop(os.path.join(root,d), "frames_proc"))
 
 		if args.flop:
 			 # flips all frames on their second axis, i.e. front-back
@@ -0,0 +1,40 @@
+'''
+pack-cache: convert .npy + metadata file frame caches into single-file
+  .ucache containers (see ultramisc.framestore), which the PCA/LDA scripts
+  read in preference to the older pair.
+Usage: python pack-cache.py [expdir] [--stem frames_proc] [--remove]
+'''
+
+import argparse
+import os
+
+from ultramisc.framestore import convert_legacy
+from ultramisc.metadata import metadata_path
+
+# read in arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("expdir",
+					help="Experiment directory containing all subjects'\
+						  caches and metadata in separate folders"
+					)
+parser.add_argument("--stem", "-s", default="frames_proc",
+					help="Name of the cache to convert (default frames_proc)"
+					)
+parser.add_argument("--remove", "-r", action="store_true",
+					help="Delete the .npy and metadata files after conversion"
+					)
+args = parser.parse_args()
+
+for root, dirs, files in os.walk(args.expdir):
+	for d in dirs:
+		if d.startswith("."): # don't run on MAC OS hidden directories
+			continue
+		frames_npy = os.path.join(root, d, args.stem + ".npy")
+		md_file = metadata_path(os.path.join(root, d), args.stem)
+		if not (os.path.exists(frames_npy) and os.path.exists(md_file)):
+			continue
+		out = convert_legacy(frames_npy, md_file)
+		print("{}: wrote {}".format(d, os.path.basename(out)))
+		if args.remove:
+			os.remove(frames_npy)
+			os.remove(md_file)
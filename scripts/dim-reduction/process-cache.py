@@ -1,7 +1,7 @@
 '''
 process-cache.py: a python command line utility for cleaning up
   ultrasound frame data stored in a .npy cache. A metadata
-  pickle is used to identify frames. Both of these files are
+  file is used to identify frames. Both of these files are
   created using one of the *-cache-frames.py scripts also stored 
   in this repository.
 
@@ -14,12 +14,45 @@ process-cache.py: a python command line utility for cleaning up
 Usage: python process-cache.py [expdir] [--flop -f]
   expdir:      The experiment directory, which contains a folder for
                each subject. These in turn contain files called 
-               frames.npy and frames_metadata.pickle.
+               frames.npy and frames_metadata.npz (or .pickle).
   --flop:      If used, horizontally mirror the data (to correct for 
   		       ultrasound probe being oriented backwards).
   --roi:  	   If used, apply a mask to the image to isolate a 
   		       region of interest. Entire image is cached if not used.
+  --crop:      With --roi, filter and keep only the RoI's bounding box
+               (the rest of each frame is zero), which is much faster;
+               its position in the frame is stored in
+               frames_proc_crop.json for PCA. Frames are still scaled
+               from 0 to their maximum, but despeckling's speckle scale
+               is taken over the box rather than the whole masked frame,
+               so output differs from a run without --crop.
   --overwrite  Overwrite existing outputs, if specified.
+  --jobs:      Number of processes filtering frames (default 1; 0 for
+               one per CPU); output is identical for any number.
+  --batch:     Never ask for input: each subject's RoI is read from
+               the subj<N>_roi.txt saved by an earlier run (or from
+               --roi-table), preview PDFs are written without waiting
+               for approval, and subjects without a RoI are skipped.
+  --roi-table: Table of RoI bounds for all subjects (columns subject,
+               upper, lower, left, right; see ultramisc.roifile);
+               implies --roi. Without --batch, these (or saved) bounds
+               are the starting point offered for approval.
+  --store:     Directory of a store of processed frames (see
+               ultramisc.procstore; none by default). Frames already
+               processed with the same settings, in this or an earlier
+               run, are read from the store rather than filtered again.
+  --store-size: Size bound in MB of the store (default 4096).
+
+  Progress is printed every few seconds with the rate and time left,
+  and the time spent in each stage (load, verify, mean, mask, srad,
+  convert, clean, hash, store, save) is written to
+  frames_proc_timing.json in each subject's folder (see
+  ultramisc.timing).
+
+  Frames are processed out of core: frames.npy is memory-mapped, the
+  mean frame is summed a chunk at a time and frames_proc.npy is
+  written through a memory map (see ultramisc.framecache), so memory
+  use is bounded by the chunk size rather than the size of the cache.
 '''
 
 import argparse
@@ -31,209 +64,277 @@ import pandas as pd
 import re
 import sys
 
-from hashlib import sha1
 from imgphon import ultrasound as us
-from ultratils.pysonix.scanconvert import Converter
-
-# read in arguments from command line
-parser = argparse.ArgumentParser()
-parser.add_argument("expdir", 
-					help="Experiment directory containing all subjects'\
-						  caches and metadata in separate folders"
-					)
-parser.add_argument("-o", 
-					"--overwrite", 
-					help="Overwrites existing outputs if present.",
-					action="store_true"
-					)
-<<<<<<< HEAD
-parser.add_argument("-f", 
-					"--flop", 
-					help="Horizontally flip the data", 
-					action="store_true"
-					)
-parser.add_argument("-r",
-					"--roi",
-					help="Trim data to a region of interest",
-					action="store_true"
-					)
-
-=======
->>>>>>> 0f476dee17ab53abaf3fc9322ff58c2e30bd9483
-args = parser.parse_args()
-
-# create some objects we will need to instantiate the converter
-class Header(object):
-	def __init__(self):
-		pass
-class Probe(object):
-	def __init__(self):
-		pass
-# to be defined below on first pass through data
-conv = None
-
-# argument checking
-try:
-	expdir = args.expdir
-except IndexError:
-	print("\tDirectory provided doesn't exist")
-	ArgumentParser.print_usage
-	ArgumentParser.print_help
-	sys.exit(2)
-
-# create some output file handles
-frames_out = "frames_proc.npy"
-metadata_out = "frames_proc_metadata.pickle"
-
-# loop through 
-for root,directories,files in os.walk(expdir):
-	for d in directories:
-
-		if os.path.exists(os.path.join(root,d,frames_out)):
-			if args.overwrite:
-				print("Skipping {}, already processed".format(d))
-				pass
+from ultramisc.framecache import MappedFrameCache, mean_frame
+from ultramisc.manifest import MODES, verify_cache, write_manifest
+from ultramisc.metadata import load_metadata, write_metadata
+from ultramisc.procframes import FramePipeline, process_frames, write_crop
+from ultramisc.procstore import DEFAULT_MAX_BYTES, ProcStore
+from ultramisc.roifile import ROI_FIELDS, lookup_roi, read_roi_table, roi_filename, write_roi
+from ultramisc.scanconv import scan_table
+from ultramisc.timing import Progress, StageTimer, write_timing
+
+def main():
+	# read in arguments from command line
+	parser = argparse.ArgumentParser()
+	parser.add_argument("expdir", 
+						help="Experiment directory containing all subjects'\
+							  caches and metadata in separate folders"
+						)
+	parser.add_argument("-o", 
+						"--overwrite", 
+						help="Overwrites existing outputs if present.",
+						action="store_true"
+						)
+	parser.add_argument("-f", 
+						"--flop", 
+						help="Horizontally flip the data", 
+						action="store_true"
+						)
+	parser.add_argument("-r",
+						"--roi",
+						help="Trim data to a region of interest",
+						action="store_true"
+						)
+	parser.add_argument("--crop",
+						help="With --roi, filter only the RoI's bounding box \
+							  (faster; despeckles slightly differently)",
+						action="store_true"
+						)
+	parser.add_argument("-v",
+						"--verify",
+						help="How to check cache integrity: full, sample, or \
+							  trust (skip if already verified and unchanged)",
+						choices=MODES,
+						default="trust"
+						)
+	parser.add_argument("-c",
+						"--chunk-size",
+						help="Number of frames despeckled at once (default: \
+							  sized to fit the frames in cache; lower to save memory)",
+						type=int,
+						default=None
+						)
+	parser.add_argument("-j",
+						"--jobs",
+						help="Number of processes filtering frames in parallel \
+							  (default 1; 0 for one per CPU)",
+						type=int,
+						default=1
+						)
+	parser.add_argument("-b",
+						"--batch",
+						help="Run without asking for input, using saved RoIs",
+						action="store_true"
+						)
+	parser.add_argument("--roi-table",
+						help="Table of RoI bounds for all subjects (implies --roi)",
+						default=None
+						)
+	parser.add_argument("--store",
+						help="Directory of a store of processed frames reused \
+							  by later runs (default: no store)",
+						default=None
+						)
+	parser.add_argument("-s",
+						"--store-size",
+						help="Size bound in MB of the store (default 4096)",
+						type=int,
+						default=DEFAULT_MAX_BYTES // 2**20
+						)
+	args = parser.parse_args()
+
+	# processed frames kept for reuse across runs, if asked for
+	store = ProcStore(args.store, max_bytes=args.store_size * 2**20) if args.store else None
+
+	# RoI bounds for all subjects, if given in one table
+	roi_table = None
+	if args.roi_table:
+		args.roi = True
+		roi_table = read_roi_table(args.roi_table)
+	skipped = []
+
+	# to be defined below on first pass through data
+	conv = None
+
+	# argument checking
+	try:
+		expdir = args.expdir
+	except IndexError:
+		print("\tDirectory provided doesn't exist")
+		ArgumentParser.print_usage
+		ArgumentParser.print_help
+		sys.exit(2)
+
+	# create some output file handles
+	frames_out = "frames_proc.npy"
+	metadata_out = "frames_proc_metadata.npz"
+
+	# loop through 
+	for root,directories,files in os.walk(expdir):
+		for d in directories:
+
+			if os.path.exists(os.path.join(root,d,frames_out)):
+				if args.overwrite:
+					print("Skipping {}, already processed".format(d))
+					pass
+				else:
+					continue
+
+			# folder name without any alphabetic characters
+			subject = re.sub("[^0-9]","",d)
+
+			# saved RoI bounds (or --roi-table entry), required in batch mode
+			saved_roi = None
+			if args.roi:
+				saved_roi = lookup_roi(subject, os.path.join(root,d), roi_table)
+				if saved_roi is None and args.batch:
+					print("No saved RoI for {}; skipping it in batch mode".format(d))
+					skipped.append(d)
+					continue
+
+			# time spent in each stage for this subject
+			timer = StageTimer()
+
+			# read in data and metadata
+			with timer.stage('load'):
+				data_in = os.path.join(root,d,"frames.npy")
+				pca_data = np.load(data_in, mmap_mode='r')
+				pca_md = load_metadata(os.path.join(root,d), "frames")
+
+			# check that metadata matches data, frame-by-frame
+			with timer.stage('verify', pca_data.shape[0]):
+				verify_cache(os.path.join(root,d), "frames", pca_data, pca_md, 'sha1',
+							 stage="process-cache", mode=args.verify)
+
+			# TODO implement a general data subsetter (external lists)
+
+			# define scan conversion (C9-5/10 probe) from first acq for first subj
+			if conv is None:
+				print("Defining Converter ...")
+				conv = scan_table(pca_data[0].shape)
+
+
+			# get mean frame
+			with timer.stage('mean', pca_data.shape[0]):
+				mean = mean_frame(pca_data)
+			conv_mean = conv.convert(mean)
+			plt.title("Mean frame, Spkr {:}".format(subject))
+			plt.imshow(conv_mean, cmap="Greys_r")
+			file_ending_mean = "subj{:}_mean.pdf".format(subject)
+			savepath_mean = os.path.join(root,d,file_ending_mean)
+			plt.savefig(savepath_mean)
+
+			# mask data according to RoI (or lack thereof)
+			if not args.roi:
+				# TODO build this into us.roi?
+				print("No mask applied to data.")
+				mask = np.ones(pca_data[0].shape, dtype=pca_data[0].dtype)
+
 			else:
-				continue
-
-		# folder name without any alphabetic characters
-		subject = re.sub("[^0-9]","",d)
-
-		# read in data and metadata
-		data_in = os.path.join(root,d,"frames.npy")
-		pca_data = np.load(data_in)
-		metadata_in = os.path.join(root,d,'frames_metadata.pickle')
-		pca_md = pd.read_pickle(metadata_in)
-
-		# check that metadata matches data, frame-by-frame
-		assert(len(pca_md) == pca_data.shape[0])
-		for idx,row in pca_md.iterrows():
-			assert(row['sha1'] == sha1(pca_data[idx].ravel()).hexdigest())
-
-		# TODO implement a general data subsetter (external lists)
-
-		# define Converter parameters from first acq for first subj
-		if conv is None:
-			print("Defining Converter ...")
-			header = Header()
-			header.w = pca_data[0].shape[1]   # input image width
-			header.h = pca_data[0].shape[0]   # input image height, trimmed
-			header.sf = 4000000         	# magic number, sorry!
-			probe = Probe()
-			probe.radius = 10000        	# based on '10' in transducer model number
-			probe.numElements = 128     	# based on '128' in transducer model number
-			probe.pitch = 185           	# based on Ultrasonix C9-5/10 transducer
-			conv = Converter(header, probe)
-
-
-		# get mean frame
-		mean_frame = pca_data.mean(axis=0)
-		conv_mean = np.flipud(conv.convert(np.flipud(mean_frame)))
-		plt.title("Mean frame, Spkr {:}".format(subject))
-		plt.imshow(conv_mean, cmap="Greys_r")
-		file_ending_mean = "subj{:}_mean.pdf".format(subject)
-		savepath_mean = os.path.join(root,d,file_ending_mean)
-		plt.savefig(savepath_mean)
-
-		# mask data according to RoI (or lack thereof)
-		if not args.roi:
-			# TODO build this into us.roi?
-			print("No mask applied to data.")
-			mask = np.ones(pca_data[0].shape, dtype=pca_data[0].dtype)
-
-		else:
-			print("Defining region of interest ...")
-			# starter boundaries
-			roi_upper = 600
-			roi_lower = 200
-			roi_left = 20
-			roi_right = 50
-
-			# show user masked mean frame, ask for input on mask
-			while True:
-				mask = us.roi(mean_frame, 
-					upper=roi_upper, 
-					lower=roi_lower,
-					left=roi_left,
-					right=roi_right)
-				masked_mean = mean_frame * mask
-				conv_masked = np.flipud(conv.convert(np.flipud(masked_mean)))
-				plt.title("Mean frame and RoI, Spkr {:}".format(subject))
-				plt.imshow(conv_masked, cmap="Greys_r")
-				file_ending_roi = "subj{:}_roi.pdf".format(subject)
-				savepath_roi = os.path.join(root,d,file_ending_roi)
-				plt.savefig(savepath_roi)
-				good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
-
-				# If good, go ahead. If not, ask for new bounds.
-				if good_roi.upper() in ['Y', 'N']:
-					if good_roi.upper() == "Y":
+				print("Defining region of interest ...")
+				# starter boundaries, saved ones if any
+				roi_upper = 600
+				roi_lower = 200
+				roi_left = 20
+				roi_right = 50
+				if saved_roi is not None:
+					roi_upper, roi_lower, roi_left, roi_right = [saved_roi[f] for f in ROI_FIELDS]
+
+				# show user masked mean frame, ask for input on mask
+				while True:
+					mask = us.roi(mean, 
+						upper=roi_upper, 
+						lower=roi_lower,
+						left=roi_left,
+						right=roi_right)
+					masked_mean = mean * mask
+					conv_masked = conv.convert(masked_mean)
+					plt.title("Mean frame and RoI, Spkr {:}".format(subject))
+					plt.imshow(conv_masked, cmap="Greys_r")
+					file_ending_roi = "subj{:}_roi.pdf".format(subject)
+					savepath_roi = os.path.join(root,d,file_ending_roi)
+					plt.savefig(savepath_roi)
+					if args.batch:
+						print("Using saved RoI; preview in {}".format(savepath_roi))
 						break
+					good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
+
+					# If good, go ahead. If not, ask for new bounds.
+					if good_roi.upper() in ['Y', 'N']:
+						if good_roi.upper() == "Y":
+							break
+						else:
+							roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
+							roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
+							roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
+							roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
 					else:
-						roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
-						roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
-						roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
-						roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
-				else:
-					print("Typo, try again ...")
-
-		# some filtering parameters based on image size
-		conv_frame = conv.convert(pca_data[0])
-		adj_radius = int(conv_frame.shape[0]/50) # for median filter
-
-		# heads-up
-		print("Preprocessing data for PCA ...")
-
-		# make a sample frame for reference and show user
-		in_sample = pca_data[0]
-		masked_samp = in_sample * mask # using mask defined above
-		sradd_samp = us.srad(masked_samp)
-		convd_samp = np.flipud(conv.convert(np.flipud(sradd_samp)))
-		clean_samp = us.clean_frame(convd_samp, median_radius=adj_radius)
-		rescaled_samp = clean_samp * 255
-		sample_frame = rescaled_samp.astype(np.uint8)
-		plt.title("Sample frame, Spkr {:}".format(subject))
-		plt.imshow(sample_frame, cmap="Greys_r")
-		file_ending_sample = "subj{:}_sample.pdf".format(subject)
-		savepath_sample = os.path.join(root,d,file_ending_sample)
-		plt.savefig(savepath_sample)
-		print("Please check sample frame at {}!".format(savepath_sample))
-
-		# save a RoI file for later reference
-		print("RoI of upper {:} lower {:}, left {:} right {:} used".format(roi_upper,roi_lower,roi_left,roi_right))
-		file_ending_roi = "subj{:}_roi.txt".format(subject)
-		savepath_roi = os.path.join(root,d,file_ending_roi)
-		with open(savepath_roi,"w") as out:
-			out.write('\t'.join(['upper', 'lower', 'left', 'right']) + '\n')
-			out.write('\t'.join([str(roi_upper), str(roi_lower), str(roi_left), str(roi_right)]))
-
-		# set up ultrasound frame array for PCA
-		out_frames = np.empty([pca_data.shape[0]] + list(conv_frame.shape)) * np.nan
-		out_frames = out_frames.astype('uint8')
-		filt_hds = []
-		total = out_frames.shape[0]
-
-		for idx,frame in enumerate(pca_data):
-			masked = frame * mask # using mask defined above
-			sradd = us.srad(masked)
-			# TODO should remove outer flipud for consistent output
-			convd = np.flipud(conv.convert(np.flipud(sradd)))
-			clean = us.clean_frame(convd, median_radius=adj_radius)
-			# copying to out_frames casts to np.uint8; rescaling required
-			rescaled = clean * 255
-			out_frames[idx,:,:] = rescaled
-			# new sha1 hex: filtered, conv to np.uint8
-			filt_hds.append(sha1(out_frames[idx].ravel()).hexdigest()) 
-			print("\tAdded frame {} of {}".format(idx+1,total))
-
-		# add new sha1 hash as a column in the df
-		pca_md = pca_md.assign(sha1_filt=pd.Series(filt_hds, index=pca_md.index))
-
-		# check that metadata matches data, frame-by-frame
-		assert(len(pca_md) == pca_data.shape[0])
-		for idx,row in pca_md.iterrows():
-			assert(row['sha1'] == sha1(pca_data[idx].ravel()).hexdigest())
-
-		# output
-		np.save(os.path.join(root,d,frames_out), out_frames)
-		pca_md.to_pickle(os.path.join(root,d,metadata_out))
+						print("Typo, try again ...")
+
+			# some filtering parameters based on image size
+			adj_radius = int(conv.out_shape[0]/50) # for median filter
+
+			# heads-up
+			print("Preprocessing data for PCA ...")
+
+			# mask (defined above), despeckle, convert and clean each frame
+			# in one pass, cropped to the RoI with --crop (see ultramisc.procframes)
+			pipeline = FramePipeline(conv, mask=mask, median_radius=adj_radius,
+									 clean=us.clean_frame, chunk=args.chunk_size, timer=timer,
+									 crop=args.crop)
+
+			# make a sample frame for reference and show user
+			sample_frame = pipeline.run(pca_data[:1], np.empty((1,) + conv.out_shape, dtype=np.uint8))[0]
+			plt.title("Sample frame, Spkr {:}".format(subject))
+			plt.imshow(sample_frame, cmap="Greys_r")
+			file_ending_sample = "subj{:}_sample.pdf".format(subject)
+			savepath_sample = os.path.join(root,d,file_ending_sample)
+			plt.savefig(savepath_sample)
+			print("Please check sample frame at {}!".format(savepath_sample))
+
+			# save a RoI file for later reference
+			if args.roi:
+				print("RoI of upper {:} lower {:}, left {:} right {:} used".format(roi_upper,roi_lower,roi_left,roi_right))
+				savepath_roi = os.path.join(root,d,roi_filename(subject))
+				write_roi(savepath_roi, dict(zip(ROI_FIELDS, [roi_upper, roi_lower, roi_left, roi_right])))
+
+			# set up ultrasound frame array for PCA, memory-mapped on disk
+			out_cache = MappedFrameCache(os.path.join(root,d,frames_out),
+										 [pca_data.shape[0]] + list(conv.out_shape), np.uint8)
+			out_frames = out_cache.frames
+
+			# filter all frames a chunk at a time, in --jobs processes;
+			# new sha1 hex of each filtered frame, conv to np.uint8, in order;
+			# store keys use the (verified) raw digests in the metadata
+			filt_hds = process_frames(pca_data, out_frames, pipeline, jobs=args.jobs,
+									  store=store, progress=Progress("Filtered", "frames"),
+									  raw_digests=list(pca_md['sha1']))
+			if store is not None:
+				print("Reused {} of {} frames from {}".format(store.hits, len(filt_hds), store.root))
+				store.hits = store.misses = 0
+
+			# add new sha1 hash as a column in the df
+			pca_md = pca_md.assign(sha1_filt=pd.Series(filt_hds, index=pca_md.index))
+
+			# make sure there is one metadata row for each output frame
+			assert(len(pca_md) == out_frames.shape[0])
+
+			# output
+			with timer.stage('save', pca_data.shape[0]):
+				out_cache.close()
+				write_metadata(os.path.join(root,d,metadata_out), pca_md)
+				write_crop(os.path.join(root,d), "frames_proc", pipeline.geometry())
+				write_manifest(os.path.join(root,d), "frames_proc", stage="process-cache")
+			report = timer.report(frames=pca_data.shape[0], jobs=args.jobs)
+			savepath_timing = write_timing(os.path.join(root,d), "frames_proc", report)
+			print("Processed {} frames in {:.1f} s ({} frames/s); timing in {}".format(
+				report['frames'], report['wall'], report['frames_per_sec'], savepath_timing))
+			plt.close("all")
+
+	if skipped:
+		print("Skipped {} subject(s) without a saved RoI: {}".format(len(skipped), ", ".join(skipped)))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
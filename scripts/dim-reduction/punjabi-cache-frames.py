@@ -21,6 +21,9 @@ from operator import itemgetter
 from PIL import Image
 from scipy import ndimage
 
+from ultramisc.framecache import FrameCacheWriter
+from ultramisc.manifest import remove_manifest
+
 # read in args
 parser = argparse.ArgumentParser()
 parser.add_argument("directory", help="Experiment directory containing all subjects")
@@ -36,10 +39,11 @@ except AssertionError:
     parser.print_help()
     sys.exit(2)
 
-data = None
 recs = []
 frames_out = os.path.join(expdir,"frames.npy")
 metadata_out = os.path.join(expdir,"frames_metadata.pickle")
+remove_manifest(expdir, "frames") # any earlier cache is replaced
+writer = FrameCacheWriter(frames_out) # frames are streamed to disk
 png_glob_exp = os.path.join(os.path.normpath(expdir),"*.png")
 
 # for filename in list-of-files:
@@ -102,11 +106,11 @@ for filename in glob.glob(png_glob_exp):
             ])
         )
 
-    # add frame ndarray to frames list
-    if data is None:
-        data = np.expand_dims(rawdata, axis=0)
-    else:
-        data = np.concatenate([data, np.expand_dims(rawdata, axis=0)])
+    # add frame ndarray to cache
+    writer.append(rawdata)
+
+writer.close()
+data = np.load(frames_out, mmap_mode='r')
 
 # convert metadata to a DataFrame
 md = pd.DataFrame.from_records(recs, columns=recs[0].keys())
@@ -118,5 +122,4 @@ assert(len(md) == data.shape[0])
 assert(md.loc[0, 'sha1'] == sha1(data[0].ravel()).hexdigest())
 assert(md.loc[len(md)-1,'sha1'] == sha1(data[-1].ravel()).hexdigest())
 
-np.save(frames_out, data)
 md.to_pickle(metadata_out)
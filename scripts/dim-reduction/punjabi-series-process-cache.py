@@ -1,9 +1,17 @@
 '''
 punjabi-series-process-cache.py: process cache as done in Kochetov/Faytak/Nara project.
+  Several subject directories can be given to process them in one run;
+  with --batch, nothing is asked: each subject's RoI comes from the
+  subj<N>_roi.txt saved by an earlier run or from --roi-table (see
+  ultramisc.roifile), and subjects without one are skipped.
+  Time spent in each stage is written to frames_proc_timing.json in
+  each subject's folder (see ultramisc.timing).
+  frames.npy is memory-mapped and frames_proc.npy written through a
+  memory map (see ultramisc.framecache), so memory use is bounded by
+  the chunk size rather than the size of the cache.
 '''
 
 import argparse
-import glob
 import matplotlib.pyplot as plt
 import numpy as np 
 import pandas as pd
@@ -13,150 +21,211 @@ import sys
 
 from hashlib import sha1
 from imgphon import ultrasound as us
-from scipy.ndimage import median_filter
-
-# read in args
-parser = argparse.ArgumentParser()
-parser.add_argument("directory", help="Experiment directory containing all subjects")
-args = parser.parse_args()
-
-# check for appropriate directory
-expdir = args.directory
-try:
-    assert os.path.exists(args.directory)
-except AssertionError:
-    # TODO raise exception
-    print("\tDirectory provided doesn't exist")
-    parser.print_help()
-    sys.exit(2)
+from ultramisc.framecache import MappedFrameCache, mean_frame
+from ultramisc.manifest import remove_manifest
+from ultramisc.roifile import ROI_FIELDS, lookup_roi, read_roi_table, roi_filename, write_roi
+from ultramisc.srad import default_chunk, srad_chunks, srad_stack
+from ultramisc.timing import Progress, StageTimer, write_timing
 
 yes_no = ["Y", "N"]
 
-subject = "P" + re.sub("[^0-9]", "", expdir)
-
-data_in = os.path.join(expdir,"frames.npy")
-data = np.load(data_in)
-metadata_in = os.path.join(expdir,'frames_metadata.pickle')
-md = pd.read_pickle(metadata_in)
-
-# some sanity checks on data checksums
-assert(len(md) == data.shape[0]) # make sure one md row for each frame
-assert(md.loc[0, 'sha1'] == sha1(data[0][0].ravel()).hexdigest()) # checksums
-assert(md.loc[len(md)-1,'sha1'] == sha1(data[-1][0].ravel()).hexdigest())
-
-# TODO how to get the mean frame object for a 4D array?
-# make temp flattened array and take mean of that
-data_for_mean = data.reshape([
-    data.shape[0] * data.shape[1], 
-    data.shape[2],
-    data.shape[3]
-    ])
-#print(data_for_mean.shape)
-mean_frame = data_for_mean.mean(axis=0)
-#conv_mean = np.flipud(conv.convert(np.flipud(mean_frame)))
-plt.title("Mean frame, Spkr {:}".format(subject))
-plt.imshow(mean_frame, cmap="Greys_r")
-file_ending_mean = "subj{:}_mean.pdf".format(subject)
-savepath_mean = os.path.join(expdir,file_ending_mean)
-plt.savefig(savepath_mean)
-roi_upper = 325
-roi_lower = 200
-roi_left = 200
-roi_right = 400
-
-# TODO give mask converted shape
-while True:
-    mask = us.roi(mean_frame, 
-        upper=roi_upper, 
-        lower=roi_lower,
-        left=roi_left,
-        right=roi_right)
-    masked_mean = mean_frame * mask
-    #conv_masked = np.flipud(conv.convert(np.flipud(masked_mean)))
-    plt.title("Mean frame and RoI, {:}".format(subject))
-    plt.imshow(masked_mean, cmap="Greys_r")
-    file_ending_roi = "subj{:}_roi.pdf".format(subject)
-    savepath_roi = os.path.join(expdir,file_ending_roi)
-    plt.savefig(savepath_roi)
-    good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
-
-    # TODO improve typo handling
-    if good_roi.upper() in yes_no:
-        if good_roi.upper() == "Y":
+def process_subject(expdir, args, roi_table=None):
+    '''
+    Process the series cache in expdir; return False if skipped.
+    '''
+    subject = "P" + re.sub("[^0-9]", "", expdir)
+
+    # saved RoI bounds (or --roi-table entry), required in batch mode
+    saved_roi = lookup_roi(subject, expdir, roi_table)
+    if saved_roi is None and args.batch:
+        print("No saved RoI for {}; skipping it in batch mode".format(expdir))
+        return False
+
+    # time spent in each stage for this subject
+    timer = StageTimer()
+
+    with timer.stage('load'):
+        data_in = os.path.join(expdir,"frames.npy")
+        data = np.load(data_in, mmap_mode='r')
+        metadata_in = os.path.join(expdir,'frames_metadata.pickle')
+        md = pd.read_pickle(metadata_in)
+
+    # some sanity checks on data checksums
+    with timer.stage('verify'):
+        assert(len(md) == data.shape[0]) # make sure one md row for each frame
+        assert(md.loc[0, 'sha1'] == sha1(data[0][0].ravel()).hexdigest()) # checksums
+        assert(md.loc[len(md)-1,'sha1'] == sha1(data[-1][0].ravel()).hexdigest())
+
+    # TODO how to get the mean frame object for a 4D array?
+    # make temp flattened array and take mean of that
+    data_for_mean = data.reshape([
+        data.shape[0] * data.shape[1], 
+        data.shape[2],
+        data.shape[3]
+        ])
+    #print(data_for_mean.shape)
+    with timer.stage('mean', data_for_mean.shape[0]):
+        mean = mean_frame(data_for_mean)
+    #conv_mean = np.flipud(conv.convert(np.flipud(mean)))
+    plt.title("Mean frame, Spkr {:}".format(subject))
+    plt.imshow(mean, cmap="Greys_r")
+    file_ending_mean = "subj{:}_mean.pdf".format(subject)
+    savepath_mean = os.path.join(expdir,file_ending_mean)
+    plt.savefig(savepath_mean)
+    roi_upper = 325
+    roi_lower = 200
+    roi_left = 200
+    roi_right = 400
+    if saved_roi is not None:
+        roi_upper, roi_lower, roi_left, roi_right = [saved_roi[f] for f in ROI_FIELDS]
+
+    # TODO give mask converted shape
+    while True:
+        mask = us.roi(mean, 
+            upper=roi_upper, 
+            lower=roi_lower,
+            left=roi_left,
+            right=roi_right)
+        masked_mean = mean * mask
+        #conv_masked = np.flipud(conv.convert(np.flipud(masked_mean)))
+        plt.title("Mean frame and RoI, {:}".format(subject))
+        plt.imshow(masked_mean, cmap="Greys_r")
+        file_ending_roi = "subj{:}_roi.pdf".format(subject)
+        savepath_roi = os.path.join(expdir,file_ending_roi)
+        plt.savefig(savepath_roi)
+        if args.batch:
+            print("Using saved RoI; preview in {}".format(savepath_roi))
             break
+        good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
+
+        # TODO improve typo handling
+        if good_roi.upper() in yes_no:
+            if good_roi.upper() == "Y":
+                break
+            else:
+                roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
+                roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
+                roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
+                roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
         else:
-            roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
-            roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
-            roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
-            roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
-    else:
-        print("Typo, try again ...")
-
-adj_radius = int(data[0][0].shape[0]/50) # short side of single frame /50, for median filter
-
-print("Preprocessing data for PCA ...")
-
-in_series = data[0] # array
-out_frames_samp = []
-padding = 5 # number of pixels to tack on at edges to visually divide frames
-for frame in in_series:
-    crop_samp = frame[roi_lower:roi_upper, roi_left:roi_right]
-    sradd_samp = us.srad(crop_samp)
-    clean_samp = us.clean_frame(sradd_samp, median_radius=adj_radius)
-#    masked_samp = clean_samp * mask # using mask defined above
-    rescaled_samp = clean_samp * 255
-    sample_frame = rescaled_samp.astype(np.uint8)
-    sample_frame = np.pad(sample_frame, padding, 'constant')
-    out_frames_samp.append(sample_frame)
-
-out_series_samp = np.hstack(out_frames_samp)
-plt.title("Sample frames series, Spkr {:}".format(subject))
-plt.imshow(out_series_samp, cmap="Greys_r")
-file_ending_sample = "subj{:}_sample.pdf".format(subject)
-savepath_sample = os.path.join(expdir,file_ending_sample)
-plt.savefig(savepath_sample)
-print("Please check sample series at {}!".format(savepath_sample))
-
-# preallocate ultrasound frame array for PCA
-out_serieses = np.empty([data.shape[0]] + list(out_series_samp.shape)) * np.nan
-out_serieses = out_serieses.astype('uint8')
-filt_hds = []
-total = out_serieses.shape[0]
-
-frames_out = "frames_proc.npy"
-metadata_out = "frames_proc_metadata.pickle"
-
-# TODO loop index issues (get IndexError "out of range" at item 5)
-for idx,series in enumerate(data):
-    out_frames = []
-    for frame in series:
-        crop = frame[roi_lower:roi_upper, roi_left:roi_right]
-        sradd = us.srad(crop) 
-        clean = us.clean_frame(sradd, median_radius=adj_radius)
-        rescaled = clean * 255
-        out_frame = rescaled.astype(np.uint8)
-        out_frame = np.pad(out_frame, padding, 'constant')
-        out_frames.append(out_frame)
-
-    out_series = np.hstack(out_frames)
-    out_serieses[idx,:,:] = out_series
-    # new sha1 hex: filtered, conv to np.uint8
-    filt_hds.append(sha1(out_serieses[idx].ravel()).hexdigest()) 
-    print("\tAdded series {} of {}".format(idx+1,total))
-
-# add new sha1 hex as a column in the df
-md = md.assign(sha1_filt=pd.Series(filt_hds, index=md.index))
-
-# make sure there is one metadata row for each image frame
-assert(len(md) == out_serieses.shape[0])
-
-# for debugging
-# pca_md.to_csv(os.path.join(root,d,"test.csv"))
-
-# compare checksums
-assert(md.loc[0, 'sha1_filt'] == sha1(out_serieses[0].ravel()).hexdigest())
-assert(md.loc[len(md)-1,'sha1_filt'] == sha1(out_serieses[-1].ravel()).hexdigest())
+            print("Typo, try again ...")
+
+    # save a RoI file for later (batch) runs
+    write_roi(os.path.join(expdir, roi_filename(subject)),
+              dict(zip(ROI_FIELDS, [roi_upper, roi_lower, roi_left, roi_right])))
+
+    adj_radius = int(data[0][0].shape[0]/50) # short side of single frame /50, for median filter
+
+    print("Preprocessing data for PCA ...")
+
+    in_series = data[0] # array
+    out_frames_samp = []
+    padding = 5 # number of pixels to tack on at edges to visually divide frames
+    for sradd_samp in srad_stack(in_series[:, roi_lower:roi_upper, roi_left:roi_right]):
+        clean_samp = us.clean_frame(sradd_samp, median_radius=adj_radius)
+    #    masked_samp = clean_samp * mask # using mask defined above
+        rescaled_samp = clean_samp * 255
+        sample_frame = rescaled_samp.astype(np.uint8)
+        sample_frame = np.pad(sample_frame, padding, 'constant')
+        out_frames_samp.append(sample_frame)
+
+    out_series_samp = np.hstack(out_frames_samp)
+    plt.title("Sample frames series, Spkr {:}".format(subject))
+    plt.imshow(out_series_samp, cmap="Greys_r")
+    file_ending_sample = "subj{:}_sample.pdf".format(subject)
+    savepath_sample = os.path.join(expdir,file_ending_sample)
+    plt.savefig(savepath_sample)
+    print("Please check sample series at {}!".format(savepath_sample))
+
+    frames_out = "frames_proc.npy"
+    metadata_out = "frames_proc_metadata.pickle"
+
+    # preallocate ultrasound frame array for PCA, memory-mapped on disk
+    # (replacing any earlier output and its manifest)
+    remove_manifest(expdir, "frames_proc")
+    out_cache = MappedFrameCache(os.path.join(expdir,frames_out),
+                                 [data.shape[0]] + list(out_series_samp.shape), np.uint8)
+    out_serieses = out_cache.frames
+    filt_hds = []
+    total = out_serieses.shape[0]
+
+    # crop every frame of every series, and despeckle the crops a chunk
+    # (of whole series) at a time
+    series_len = data.shape[1]
+    crops = data[:, :, roi_lower:roi_upper, roi_left:roi_right]
+    crops = crops.reshape((-1,) + crops.shape[2:])
+    chunk = args.chunk_size or default_chunk(crops.shape[1:])
+    chunk = -(-chunk // series_len) * series_len
+    progress = Progress("Filtered", "series")
+
+    # TODO loop index issues (get IndexError "out of range" at item 5)
+    for start,sradd_chunk in timer.timed('srad', srad_chunks(crops, chunk=chunk),
+                                         count=lambda item: item[1].shape[0]):
+        for first in range(0, sradd_chunk.shape[0], series_len):
+            idx = (start + first) // series_len
+            out_frames = []
+            with timer.stage('clean', series_len):
+                for sradd in sradd_chunk[first:first + series_len]:
+                    clean = us.clean_frame(sradd, median_radius=adj_radius)
+                    rescaled = clean * 255
+                    out_frame = rescaled.astype(np.uint8)
+                    out_frame = np.pad(out_frame, padding, 'constant')
+                    out_frames.append(out_frame)
+
+                out_series = np.hstack(out_frames)
+                out_serieses[idx,:,:] = out_series
+            # new sha1 hex: filtered, conv to np.uint8
+            with timer.stage('hash', series_len):
+                filt_hds.append(sha1(out_serieses[idx].ravel()).hexdigest()) 
+            progress(idx+1, total)
+
+    # add new sha1 hex as a column in the df
+    md = md.assign(sha1_filt=pd.Series(filt_hds, index=md.index))
+
+    # make sure there is one metadata row for each image frame
+    assert(len(md) == out_serieses.shape[0])
+
+    # for debugging
+    # pca_md.to_csv(os.path.join(root,d,"test.csv"))
+
+    # compare checksums
+    assert(md.loc[0, 'sha1_filt'] == sha1(out_serieses[0].ravel()).hexdigest())
+    assert(md.loc[len(md)-1,'sha1_filt'] == sha1(out_serieses[-1].ravel()).hexdigest())
         
- # output
-np.save(os.path.join(expdir,frames_out), out_serieses)
-md.to_pickle(os.path.join(expdir,metadata_out))
\ No newline at end of file
+    # output
+    with timer.stage('save', crops.shape[0]):
+        out_cache.close()
+        md.to_pickle(os.path.join(expdir,metadata_out))
+    report = timer.report(frames=crops.shape[0], series=total)
+    savepath_timing = write_timing(expdir, "frames_proc", report)
+    print("Processed {} series in {:.1f} s ({} frames/s); timing in {}".format(
+        total, report['wall'], report['frames_per_sec'], savepath_timing))
+    plt.close("all")
+    return True
+
+# read in args
+parser = argparse.ArgumentParser()
+parser.add_argument("directory", nargs="+", help="Subject directories to process, one after another")
+parser.add_argument("-c", "--chunk-size", type=int, default=None,
+                    help="Number of frames despeckled at once, rounded up to whole series (default: sized to fit the frames in cache)")
+parser.add_argument("-b", "--batch", action="store_true",
+                    help="Run without asking for input, using saved RoIs")
+parser.add_argument("--roi-table", default=None,
+                    help="Table of RoI bounds for all subjects")
+args = parser.parse_args()
+
+# check for appropriate directories
+for expdir in args.directory:
+    if not os.path.exists(expdir):
+        # TODO raise exception
+        print("\tDirectory {} doesn't exist".format(expdir))
+        parser.print_help()
+        sys.exit(2)
+
+# RoI bounds for all subjects, if given in one table
+roi_table = read_roi_table(args.roi_table) if args.roi_table else None
+
+skipped = [expdir for expdir in args.directory if not process_subject(expdir, args, roi_table)]
+if skipped:
+    print("Skipped {} subject(s) without a saved RoI: {}".format(len(skipped), ", ".join(skipped)))
+    sys.exit(1)
@@ -5,47 +5,25 @@ suzhou-cache-frames: frame caching method as used in Suzhou iz/i project.
 '''
 
 import argparse
-import audiolabel
-import glob
 import imgphon as iph
 import os
 import numpy as np
-import pandas as pd
 import re
 import shutil
 import sys
 
-from collections import OrderedDict
 from hashlib import sha1
-from operator import itemgetter
 from PIL import Image
-from ultratils.rawreader import RawReader
 
-from ultramisc.ebutils import read_echob_metadata, read_stimfile
-
-def read_stimfile(stimfile):
-	with open(stimfile, "r") as stfile:
-		stim = stfile.read().rstrip('\n')
-	return stim
-
-# TODO move this (and the other fcns?) to utils
-def read_echob_metadata(rawfile):
-	'''
-	Gather information about a .raw file from its .img.txt file. 
-	'''
-	mfile = os.path.splitext(rawfile)[0] + ".img.txt"
-	mdict = {}
-	with open(mfile, 'r') as mf:
-		k = mf.readline().strip().split("\t")
-		v = mf.readline().strip().split("\t")
-		for fld,val in zip(k, v):
-			mdict[fld] = int(val)
-	
-	nscanlines = mdict['Height']
-	npoints = mdict['Pitch']
-	junk = npoints - mdict['Width'] # number of rows of junk data at outer edge of array
-	
-	return nscanlines, npoints, junk
+from ultramisc.catalog import add_catalog_args, open_catalog
+from ultramisc.discards import record_discard, relocate
+from ultramisc.framecache import FrameCacheWriter, acq_state, diff_sources, read_sources, write_sources
+from ultramisc.manifest import remove_manifest
+from ultramisc.metadata import SUZHOU_SCHEMA, MetadataBuilder, load_metadata, metadata_path
+from ultramisc.parallel import imap_ordered
+from ultramisc.rawframes import RawFrames
+from ultramisc.sync import load_sync_tiers
+from ultramisc.tiers import load_tiers
 
 class Header(object):
 	def __init__(self):
@@ -70,11 +48,6 @@ target_list = ['IZ', 'BIZX', 'SIZ', 'XIZ',
 
 iz_list = ['IZ', 'BIZX', 'SIZ', 'XIZ']
 
-recs = [] # metadata store
-data = None # array that will contain ultrasound data
-#frame_dim_1 = None
-#frame_dim_2 = None
-
 # TODO set of segments being searched for
 vre = re.compile(
 		 "^(IY1|IH1|UH1|UW1|OW1|AE1|SH|S)$" 
@@ -83,86 +56,47 @@ vre = re.compile(
 # distance (in frames) away from intended time point that can be subbed in
 threshhold = 3
 
-parser = argparse.ArgumentParser()
-parser.add_argument("expdir", 
-					help="Experiment directory containing \
-						acquisitions in flat structure"
-					)
-parser.add_argument("-f", 
-					"--flop", 
-					help="Horizontally flip the data", 
-					action="store_true"
-					)
-args = parser.parse_args()
-
-# check for appropriate directory
-try:
-	expdir = args.expdir
-except IndexError:
-	print("\tDirectory provided doesn't exist")
-	ArgumentParser.print_usage
-	ArgumentParser.print_help
-	sys.exit(2)
-
-# set up copy location
-output_dir = os.path.join(expdir,"_copy")
-try:
-	os.mkdir(output_dir)
-except FileExistsError:
-	shutil.rmtree(output_dir)
-	os.mkdir(output_dir)
-
-logfile = os.path.join(expdir,"frames_log.txt")
-discard_folder = os.path.join(expdir,"discards")
-frames_out = os.path.join(expdir,"frames.npy")
-metadata_out = os.path.join(expdir,"frames_metadata.pickle")
-
-with open(logfile,"w") as header:
-	header.write("acq"+"\t"+"stim"+"\t"+"phone"+"\t"+"status"+"\t"+"problem"+"\n")
-
-# glob expression
-rawfile_glob_exp = os.path.join(expdir,"*","*.raw")
-
-for rf in glob.glob(rawfile_glob_exp):
-
-	parent = os.path.dirname(rf)
-	acq = os.path.split(parent)[1]
+def extract_acq(job):
+	'''
+	Find the target frames in one acquisition. Runs in a worker process
+	  when --jobs is given, so nothing is printed, logged or moved here;
+	  the main process does that with the returned dict, in timestamp order.
+	Inputs: job, tuple of (Acquisition, (nscanlines, npoints, junk), flop).
+	'''
+	acq_rec, (nscanlines, npoints, junk), flop = job
 
-	# use stim.txt to skip non-trials
-	stimfile = os.path.join(parent,"stim.txt")
-	stim = read_stimfile(stimfile)
-	if stim == "bolus" or stim == "practice":
-		continue
-
-	print("Found "+acq)
-	# define "support" file names based on .raw
-	wav = os.path.join(parent,str(acq + ".ch1.wav"))
-	tg = os.path.join(parent,str(acq + ".ch1.TextGrid"))
-	sync = os.path.join(parent,str(acq + '.sync.txt'))
-	sync_tg = os.path.join(parent,str(acq + ".sync.TextGrid"))
-	idx_txt = os.path.join(parent,str(acq + ".idx.txt"))
-
-	# set up RawReader and frame dimensions
-	if data is None:
-		try:
-			nscanlines, npoints, junk = read_echob_metadata(rf)
-		except ValueError: 
-			print("WARNING: no data in {}.img.txt, please input:".format(acq))
-			nscanlines = int(input("\tnscanlines (usually 127) "))
-			npoints = int(input("\tnpoints (usually 1020) "))
-			junk = int(input("\tjunk (usually 36, or 1020 - 984) "))
-		#frame_dim_1 = nscanlines
-		#frame_dim_2 = npoints - junk
+	rf = acq_rec.raw
+	acq = acq_rec.timestamp
+	stim = acq_rec.stim
+
+	result = {
+		'acq': acq,
+		'parent': acq_rec.parent,
+		'data': None, # frames, or None if no targets found
+		'recs': None, # MetadataBuilder, one row per frame
+		'log': [], # lines for frames_log.txt
+		'msgs': ["Found "+acq], # progress messages
+		'discard': None # reason, phone and frame offset if discarded
+	}
 
-	rdr = RawReader(rf, nscanlines=nscanlines, npoints=npoints)
+	# "support" file names based on .raw
+	tg = acq_rec.tg
+	sync_tg = acq_rec.sync_tg
 
-	# instantiate LabelManagers
-	pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
-	sync_pm = audiolabel.LabelManager(from_file=sync_tg, from_type="praat")
+	rdr = RawFrames(rf, nscanlines=nscanlines, npoints=npoints, junk=junk, flop=flop)
+
+	# target frame indices and metadata for current acq
+	acq_idxs = []
+	acq_recs = []
+	discard_acq = False
+
+	# load compiled alignment tiers and sync pulse times once per acq
+	tg_tiers = load_tiers(tg)
+	sync_idx = load_sync_tiers(sync_tg, tiers=('pulse_idx', 'raw_data_idx'))
 
 	# extract ndarray representations of frames from .raw file
-	for v,m in pm.tier('phone').search(vre, return_match=True):
-		pron = pm.tier('word').label_at(v.center).text
+	for v,m in tg_tiers['phone'].search(vre, return_match=True):
+		pron = tg_tiers['word'].label_at(v.center).text
 
 		# skip any tokens from non-target words
 		if pron not in target_list:
@@ -189,98 +123,310 @@ for rf in glob.glob(rawfile_glob_exp):
 		else:
 			phone = v.text
 
-		# TODO make this a bit more extensible; test
-		before = pm.tier('phone').prev(v).text 
-		if before == "sp":
-			before = pm.tier('phone').prev(v,skip=1).text
-		after = pm.tier('phone').next(v).text 
-		if after == "sp":
-			after = pm.tier('phone').next(v,skip=1).text
+		# get segmental context, skipping over any "sp"
+		before = tg_tiers['phone'].prev_label(v, silence=["sp"]).text
+		after = tg_tiers['phone'].next_label(v, silence=["sp"]).text
 
-	   # get midpoint time and find closest ultrasound frame in sync TG
-		# TODO more efficient to duplicate ultratils frame_at approach
+		# get midpoint time and find closest ultrasound frame in sync TG
 		mid_timepoint = v.center
-		diff_list = []
-		diff2_list = []
-		for frame in sync_pm.tier('pulse_idx'):
-			diff = abs(frame.t1 - mid_timepoint)
-			diff_list.append(diff)
-		for frame in sync_pm.tier('raw_data_idx'):
-			diff2 = abs(frame.t1 - mid_timepoint)
-			diff2_list.append(diff2)
-		mid_pulse_idx_num = min(enumerate(diff_list), key=itemgetter(1))[0] 
-		mid_raw_data_idx_num = min(enumerate(diff2_list), key=itemgetter(1))[0] 
-
-		# get frame, and check for NaN frames
+		mid_pulse_idx_num = sync_idx['pulse_idx'].nearest(mid_timepoint)
+		mid_raw_data_idx_num = sync_idx['raw_data_idx'].nearest(mid_timepoint)
+
+		# check for NaN frames (outside of recorded range)
 		change = 0
-		discard_acq = False
 		while True:
-			pre_rawdata = rdr.get_frame(mid_pulse_idx_num)
-			if pre_rawdata is None:
+			if not rdr.has_frame(mid_pulse_idx_num):
 				mid_pulse_idx_num -= 1
 				mid_raw_data_idx_num -= 1 # TODO: necessary?
 				change += 1
 				if change > threshhold:
-					with open(logfile, "a") as log:
-						log.write(acq+"\t"+stim+"\t"+phone+"\t"+"discarded"+"\t"+"passed threshhold")
-					print("Frame change threshhold passed; acq {} discarded".format(acq))
+					result['log'].append(acq+"\t"+stim+"\t"+phone+"\t"+"discarded"+"\t"+"passed threshhold"+"\n")
+					result['msgs'].append("Frame change threshhold passed; acq {} discarded".format(acq))
+					result['discard'] = {'reason': "passed threshhold", 'phone': phone, 'frame_offset': -change}
 					discard_acq = True
 					break
 				else:
 					pass
 			else:
 				if change > 0:
-					with open(logfile, "a") as log:
-						log.write(acq+"\t"+stim+"\t"+phone+"\t"+"changed by {:}".format(change)+"\t"+"N/A")
-					print("Changed target in {:} by".format(acq), change, "frames")
+					result['log'].append(acq+"\t"+stim+"\t"+phone+"\t"+"changed by {:}".format(change)+"\t"+"N/A"+"\n")
+					result['msgs'].append("Changed target in {:} by {} frames".format(acq, change))
 				break
 
-		# discard the acquisition if needed
+		# stop looking in the acquisition if it is to be discarded
 		if discard_acq:
-			shutil.copytree(parent, os.path.join(discard_folder,acq))
-			shutil.rmtree(parent)
-			continue 
+			break
 
-		# preprocessing of images
-		rawdata = pre_rawdata.astype(np.uint8)
-		trim_data = rawdata[junk:,:]
+		acq_idxs.append(mid_pulse_idx_num)
 
-		if args.flop:
-				trim_data = np.fliplr(trim_data)
+		# generate metadata row for current acq; hashes added below
+		# TODO check variable names
+		acq_recs.append({
+			'timestamp': acq,
+			'time': v.center,
+			'pulseidx': int(mid_pulse_idx_num),
+			'rawdataidx': int(mid_raw_data_idx_num),
+			'width': nscanlines,
+			'height': npoints - junk,
+			'phone': phone,
+			'stim': stim,
+			'pron': pron,
+			'before': before,
+			'after': after
+		})
+
+	# read all target frames in the acq at once (trimmed and flopped)
+	if len(acq_idxs) > 0 and not discard_acq:
+		acq_data = rdr.get_frames(acq_idxs)
+		acq_md = MetadataBuilder(SUZHOU_SCHEMA, capacity=len(acq_recs))
+		for trim_data,rec in zip(acq_data, acq_recs):
+			acq_md.append(rec,
+						  sha1=sha1(trim_data.ravel()).hexdigest(),
+						  sha1_dtype=trim_data.dtype)
+		result['data'] = acq_data
+		result['recs'] = acq_md
+	rdr.close()
+
+	return result
+
+def merge_update(frames_out, update_out, old_md, drop, extracted, md):
+	'''
+	Merge the frames of new and changed acquisitions into the cache.
+	Inputs: frames_out, the cache; update_out, scratch cache holding the
+		extracted frames; old_md, the cache's metadata (DataFrame);
+	  drop, timestamps of changed and removed acquisitions;
+	  extracted, timestamp -> (first row in update_out, MetadataBuilder);
+	  md, MetadataBuilder receiving the metadata of the merged cache.
+	If the cache is in acquisition order, nothing was removed and every
+	  changed acquisition gives as many frames as before, their frames
+	  are overwritten in place and new acquisitions later than all
+	  cached ones appended, so the update costs as much as the change;
+	  otherwise the cache is rewritten once, in acquisition order.
+	'''
+	update = np.load(update_out, mmap_mode='r')
+	stamps = list(old_md['timestamp'].values)
+
+	# rows of each acquisition in the cache
+	old_rows = {}
+	for row,acq in enumerate(stamps):
+		old_rows.setdefault(acq, []).append(row)
+	kept = [acq for acq in old_rows if acq not in drop]
+	order = sorted(set(kept) | set(extracted))
+
+	appended = sorted(acq for acq in extracted if acq not in old_rows)
+	in_place = (stamps == sorted(stamps)
+				and all(acq in extracted and len(extracted[acq][1]) == len(old_rows[acq])
+						for acq in drop if acq in old_rows)
+				and (not stamps or not appended or appended[0] > stamps[-1]))
+	writer = None
+	if in_place and appended:
+		try:
+			writer = FrameCacheWriter.resume(frames_out)
+		except ValueError:
+			in_place = False
+
+	if in_place:
+		print("Updating {} in place".format(frames_out))
+		if any(acq in old_rows for acq in extracted):
+			frames = np.load(frames_out, mmap_mode='r+')
+			for acq,(start,recs) in extracted.items():
+				if acq in old_rows:
+					rows = old_rows[acq]
+					frames[rows[0]:rows[-1]+1] = update[start:start+len(recs)]
+			frames.flush()
+			del frames
+		for acq in appended:
+			start, recs = extracted[acq]
+			writer.extend(update[start:start+len(recs)])
+		if writer is not None:
+			writer.close()
+	else:
+		print("Rewriting {} in acquisition order".format(frames_out))
+		old = np.load(frames_out, mmap_mode='r')
+		writer = FrameCacheWriter(frames_out)
+		for acq in order:
+			if acq in extracted:
+				start, recs = extracted[acq]
+				writer.extend(update[start:start+len(recs)])
+			else:
+				rows = old_rows[acq]
+				for first in range(0, len(rows), 256):
+					writer.extend(old[rows[first:first+256]])
+		writer.close()
+		del old
+
+	for acq in order:
+		if acq in extracted:
+			md.extend(extracted[acq][1])
+		else:
+			md.extend(old_md.iloc[old_rows[acq]])
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("expdir", 
+						help="Experiment directory containing \
+							acquisitions in flat structure"
+						)
+	parser.add_argument("-f", 
+						"--flop", 
+						help="Horizontally flip the data", 
+						action="store_true"
+						)
+	parser.add_argument("-j",
+						"--jobs",
+						help="Number of acquisitions to process in parallel \
+							(default 1; 0 for one per CPU)",
+						type=int,
+						default=1
+						)
+	parser.add_argument("-i",
+						"--incremental",
+						help="Update the cache from an earlier run, extracting \
+							only new or changed acquisitions. Changed acquisitions \
+							giving as many frames as before are overwritten in \
+							place and new ones later than all cached ones appended; \
+							otherwise (removed acquisitions, changed frame counts, \
+							new acquisitions in between) the whole cache is copied \
+							once, so that frames stay in acquisition order",
+						action="store_true"
+						)
+	parser.add_argument("-r",
+						"--relocate",
+						help="Also move discarded acquisitions to the discards \
+							folder (by renaming; never copies data)",
+						action="store_true"
+						)
+	add_catalog_args(parser)
+	args = parser.parse_args()
+
+	# check for appropriate directory
+	try:
+		expdir = args.expdir
+	except IndexError:
+		print("\tDirectory provided doesn't exist")
+		ArgumentParser.print_usage
+		ArgumentParser.print_help
+		sys.exit(2)
+
+	logfile = os.path.join(expdir,"frames_log.txt")
+	discard_folder = os.path.join(expdir,"discards")
+	frames_out = os.path.join(expdir,"frames.npy")
+	update_out = os.path.join(expdir,"frames_update.npy")
+	metadata_out = os.path.join(expdir,"frames_metadata.npz")
+
+	# acquisition index; an incremental update has to notice files
+	# edited in place, so it checks every acquisition's files
+	catalog = open_catalog(expdir, args, refresh='files' if args.incremental else 'dirs')
 
-		if data is None:
-			data = np.expand_dims(trim_data, axis=0)
+	# use stim.txt to skip non-trials
+	acqs = catalog.acquisitions(exclude_stims=["bolus", "practice"])
+
+	# in incremental mode, reuse the existing cache if it was built with
+	# the same settings, and only extract new or changed acquisitions
+	params, old_sources = read_sources(frames_out)
+	incremental = (args.incremental
+				   and old_sources is not None
+				   and params['flop'] == args.flop
+				   and os.path.exists(frames_out)
+				   and os.path.exists(metadata_path(expdir, "frames")))
+	if args.incremental and not incremental:
+		print("No usable cache from an earlier run; building from scratch")
+
+	# set up copy location
+	output_dir = os.path.join(expdir,"_copy")
+	try:
+		os.mkdir(output_dir)
+	except FileExistsError:
+		if not incremental:
+			shutil.rmtree(output_dir)
+			os.mkdir(output_dir)
+
+	# frame dimensions, read from first acq (or from the earlier run)
+	geometry = None
+	if incremental:
+		geometry = tuple(params['geometry'])
+	elif len(acqs) > 0:
+		first = acqs[0]
+		if first.nscanlines is not None:
+			nscanlines, npoints, junk = first.nscanlines, first.npoints, first.junk
 		else:
-			data = np.concatenate([data, np.expand_dims(trim_data, axis=0)])
+			print("WARNING: no data in {}.img.txt, please input:".format(first.timestamp))
+			nscanlines = int(input("\tnscanlines (usually 127) "))
+			npoints = int(input("\tnpoints (usually 1020) "))
+			junk = int(input("\tjunk (usually 36, or 1020 - 984) "))
+		geometry = (nscanlines, npoints, junk)
+
+	md = MetadataBuilder(SUZHOU_SCHEMA) # metadata store
+	sources = {} # state of each acquisition contributing to the cache
+	extracted = {} # incremental: timestamp -> (first row in update_out, metadata)
+
+	if incremental:
+		new, changed, removed = diff_sources(old_sources, acqs)
+		print("{} new, {} changed, {} removed acquisitions".format(
+			len(new), len(changed), len(removed)))
+		todo = set(new) | set(changed)
+		drop = set(changed) | set(removed)
+		old_md = load_metadata(expdir, "frames")
+		for acq,state in old_sources.items():
+			if acq not in drop:
+				sources[acq] = state
+		# frames of new and changed acquisitions are extracted to a
+		# scratch cache first, then merged into frames_out (see merge_update)
+		writer = FrameCacheWriter(update_out)
+		acqs = [acq_rec for acq_rec in acqs if acq_rec.timestamp in todo]
+	else:
+		# ultrasound data is streamed to frames_out as it is found
+		writer = FrameCacheWriter(frames_out)
+		with open(logfile,"w") as header:
+			header.write("acq"+"\t"+"stim"+"\t"+"phone"+"\t"+"status"+"\t"+"problem"+"\n")
+
+	# frames_out is rewritten or updated below, so its manifest (if an
+	# earlier stage verified it) no longer applies
+	remove_manifest(expdir, "frames")
+
+	# acquisitions are processed in parallel with --jobs, but results
+	# come back (and are written, logged and discarded) in timestamp order
+	jobs = [(acq_rec, geometry, args.flop) for acq_rec in acqs]
+	states = {acq_rec.timestamp: acq_state(acq_rec) for acq_rec in acqs}
+	for result in imap_ordered(extract_acq, jobs, jobs=args.jobs):
+		for msg in result['msgs']:
+			print(msg)
+		if len(result['log']) > 0:
+			with open(logfile, "a") as log:
+				log.writelines(result['log'])
+
+		# discard the acquisition if needed; this is only recorded in
+		# the discard manifest, which the catalog respects from now on
+		if result['discard'] is not None:
+			record_discard(expdir, result['acq'], stage="suzhou-cache-frames", **result['discard'])
+			if args.relocate and not relocate(result['parent'], os.path.join(discard_folder,result['acq'])):
+				print("Can't move {} to {} without copying; left in place".format(result['acq'], discard_folder))
+			continue
 
-		# generate metadata row for current acq
-		# TODO check variable names
-		recs.append(
-			OrderedDict([
-				('timestamp', acq),
-				('time', v.center),
-				('pulseidx', int(mid_pulse_idx_num)),
-				('rawdataidx', int(mid_raw_data_idx_num)),
-				('width', nscanlines),
-				('height', npoints - junk),
-				('phone', phone),
-				('stim', stim),
-				('pron', pron),
-				('before', before),
-				('after', after),
-				('sha1', sha1(trim_data.ravel()).hexdigest()),
-				('sha1_dtype', trim_data.dtype)
-			])
-		)
-
-md = pd.DataFrame.from_records(recs, columns=recs[0].keys())
-
-# make sure there is one metadata row for each image frame
-assert(len(md) == data.shape[0])
-
-# compare checksums
-assert(md.loc[0, 'sha1'] == sha1(data[0].ravel()).hexdigest())
-assert(md.loc[len(md)-1,'sha1'] == sha1(data[-1].ravel()).hexdigest())
-
-np.save(frames_out, data)
-md.to_pickle(metadata_out)
\ No newline at end of file
+		if result['data'] is not None:
+			if incremental:
+				extracted[result['acq']] = (len(writer), result['recs'])
+			else:
+				md.extend(result['recs'])
+			writer.extend(result['data'])
+		sources[result['acq']] = states[result['acq']]
+
+	writer.close()
+	if incremental:
+		merge_update(frames_out, update_out, old_md, drop, extracted, md)
+		os.remove(update_out)
+	data = np.load(frames_out, mmap_mode='r')
+
+	# make sure there is one metadata row for each image frame
+	assert(len(md) == data.shape[0])
+
+	# compare checksums
+	hashes = md.column('sha1')
+	assert(hashes[0] == sha1(data[0].ravel()).hexdigest())
+	assert(hashes[-1] == sha1(data[-1].ravel()).hexdigest())
+
+	md.write(metadata_out)
+	write_sources(frames_out, {'flop': args.flop, 'geometry': geometry}, sources)
+
+if __name__ == "__main__":
+	main()
@@ -11,7 +11,10 @@ import pandas as pd
 import re
 import sys
 
-from hashlib import sha1
+from ultramisc.framestore import open_frame_cache
+from ultramisc.manifest import MODES, verify_cache
+from ultramisc.metadata import descriptive
+from ultramisc.procframes import crop_frames, read_crop
 from sklearn.decomposition import PCA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 
@@ -30,6 +33,7 @@ parser.add_argument("directory", help="Experiment directory containing all subje
 parser.add_argument("--pca_dim", "-p", help="Number of principal components to retain")
 parser.add_argument("--lda_dim", "-l", help="Number of linear discriminants to use")
 #parser.add_argument("-v", "--visualize", help="Produce plots of PC loadings on fan",action="store_true")
+parser.add_argument("--verify", help="How to check cache integrity: full, sample, or trust (skip if already verified and unchanged)", choices=MODES, default="trust")
 args = parser.parse_args()
 
 try:
@@ -62,17 +66,17 @@ for root,directories,files in os.walk(expdir):
 
 		subject = re.sub("[^0-9]","",d)
 
-		data_in = os.path.join(root,d,"frames_proc.npy")
-		data = np.load(data_in)
-		metadata_in = os.path.join(root,d,'frames_proc_metadata.pickle')
-		md_pre = pd.read_pickle(metadata_in)
+		store = open_frame_cache(os.path.join(root,d), "frames_proc")
+		data, md_pre = store.read()
 
-		# some sanity checks on data checksums
-		assert(len(md_pre) == data.shape[0]) # make sure one md row for each frame
-		assert(md_pre.loc[0, 'sha1_filt'] == sha1(data[0].ravel()).hexdigest()) # checksums
-		assert(md_pre.loc[len(md_pre)-1,'sha1_filt'] == sha1(data[-1].ravel()).hexdigest())
+		# sanity checks on data checksums, skipped if already verified
+		verify_cache(os.path.join(root,d), "frames_proc", data, md_pre, 'sha1_filt',
+					 stage="suzhou-pca-lda", mode=args.verify)
 		# get rid of hash-related columns after checking
-		md = md_pre.iloc[:,0:11].copy() 
+		md = descriptive(md_pre)
+
+		# keep only the RoI's box if frames were cropped to it in processing
+		data = crop_frames(data, read_crop(os.path.join(root,d), "frames_proc"))
 		
 		image_shape = data[0].shape
 		
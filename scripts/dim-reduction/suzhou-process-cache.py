@@ -2,10 +2,25 @@
 suzhou-process-cache: frame cache processing method as used in Suzhou project.
   NOTE: largely superceded by general script, ./process-cache.py, plus
   the ./suzhou-pca-lda* scripts run afterwards.
+  With --batch, nothing is asked: RoIs come from each subject's saved
+  subj<N>_roi.txt or from --roi-table (see ultramisc.roifile), and
+  subjects without one are skipped.
+  With --crop, only each RoI's bounding box is filtered and kept (see
+  ultramisc.procframes; despeckling differs slightly from a full-frame
+  run).
+  Frames are filtered in --jobs processes (output is the same for any
+  number).
+  With --store DIR, processed frames are kept in a size-bounded store
+  (--store-size, see ultramisc.procstore) and reused by later runs
+  with the same settings.
+  Time spent in each stage is written to frames_proc_timing.json in
+  each subject's folder (see ultramisc.timing).
+  frames.npy is memory-mapped, so only the frames selected below are
+  read, and frames_proc.npy is written through a memory map (see
+  ultramisc.framecache).
 '''
 
 import argparse
-import glob
 import matplotlib.pyplot as plt
 import numpy as np 
 import os
@@ -15,189 +30,219 @@ import sys
 
 from hashlib import sha1
 from imgphon import ultrasound as us
-from scipy.ndimage import median_filter
-from sklearn.decomposition import PCA
-from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
-from ultratils.pysonix.scanconvert import Converter
+from ultramisc.framecache import MappedFrameCache, mean_frame
+from ultramisc.manifest import MODES, verify_cache, write_manifest
+from ultramisc.metadata import load_metadata, write_metadata
+from ultramisc.procframes import FramePipeline, process_frames, write_crop
+from ultramisc.procstore import DEFAULT_MAX_BYTES, ProcStore
+from ultramisc.roifile import ROI_FIELDS, lookup_roi, read_roi_table, roi_filename, write_roi
+from ultramisc.scanconv import scan_table
+from ultramisc.timing import Progress, StageTimer, write_timing
 
 yes_no = ["Y", "N"]
 
-# instantiate converter for pca_data images
-class Header(object):
-	def __init__(self):
-		pass
-
-class Probe(object):
-	def __init__(self):
-		pass
-# to be defined below on first pass through data
-conv = None
-
 # sample frame output
 # sample_frame = None
 
-# read in arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("directory", help="Experiment directory containing all subjects")
-#parser.add_argument("n_pca", help="Number of principal components to start with")
-#parser.add_argument("n_lda", help="Number of linear discriminant functions to output")
-#parser.add_argument("-v", "--visualize", help="Produce plots of PC loadings on fan",action="store_true")
-args = parser.parse_args()
-
-try:
-	expdir = args.directory
-except IndexError:
-	print("\tDirectory provided doesn't exist")
-	ArgumentParser.print_usage
-	ArgumentParser.print_help
-	sys.exit(2)
-
-frames_out = "frames_proc.npy"
-metadata_out = "frames_proc_metadata.pickle"
-
-for root,directories,files in os.walk(expdir):
-
-	# TODO RoI stuff diff. for each subj
-
-	for d in directories:
-
-		subject = re.sub("[^0-9]","",d)
-
-		data_in = os.path.join(root,d,"frames.npy")
-		data = np.load(data_in)
-		metadata_in = os.path.join(root,d,'frames_metadata.pickle')
-		md = pd.read_pickle(metadata_in)
-
-		# some sanity checks on data checksums
-		assert(len(md) == data.shape[0]) # make sure one md row for each frame
-		assert(md.loc[0, 'sha1'] == sha1(data[0].ravel()).hexdigest()) # checksums
-		assert(md.loc[len(md)-1,'sha1'] == sha1(data[-1].ravel()).hexdigest())
-
-		# subset data
-		#training_list = ["IY1", "SH"] # for use later
-		#test_list = ["IZ1"] # for use later
-		vow_mask = (md['pron'].isin(["BIY", "IY", "XIY", "SIY", "BIZX", "IZ", "SIZ", "XIZ", "YZ", "XYZ", "SZ", "SZW"])) & (md['phone'] != "SH") & (md['phone'] != "S")
-		sh_mask = (md['pron'].isin(["XIZ", "XYZ", "XIY", "XIEX", "XEU"])) & (md['phone'] == "SH")
-		s_mask = (md['pron'].isin(["SAAE", "SEI", "SUW", "SIEX", "SOOW", "SZ", "SZW"])) & (md['phone'] == "S")
-		mask = vow_mask | sh_mask | s_mask
-		mask = mask.as_matrix()
-		pca_data = data[mask]
-		pca_md = md[mask]
-		pca_md = pca_md.reset_index(drop=True)
-
-		# define Converter parameters from first acq for first subj
-		if conv is None:
-			print("Defining Converter ...")
-			header = Header()
-			header.w = pca_data[0].shape[1]   # input image width
-			header.h = pca_data[0].shape[0]   # input image height, trimmed
-			header.sf = 4000000         	# magic number, sorry!
-			probe = Probe()
-			probe.radius = 10000        	# based on '10' in transducer model number
-			probe.numElements = 128     	# based on '128' in transducer model number
-			probe.pitch = 185           	# based on Ultrasonix C9-5/10 transducer
-			conv = Converter(header, probe)
-
-		print("Defining region of interest ...")
-
-		# get mean frame and apply mask
-		mean_frame = pca_data.mean(axis=0)
-		conv_mean = np.flipud(conv.convert(np.flipud(mean_frame)))
-		plt.title("Mean frame, Spkr {:}".format(subject))
-		plt.imshow(conv_mean, cmap="Greys_r")
-		file_ending_mean = "subj{:}_mean.pdf".format(subject)
-		savepath_mean = os.path.join(root,d,file_ending_mean)
-		plt.savefig(savepath_mean)
-		roi_upper = 600
-		roi_lower = 300
-		roi_left = 20
-		roi_right = 100
-
-		# TODO give mask converted shape
-		while True:
-			mask = us.roi(mean_frame, 
-				upper=roi_upper, 
-				lower=roi_lower,
-				left=roi_left,
-				right=roi_right)
-			masked_mean = mean_frame * mask
-			conv_masked = np.flipud(conv.convert(np.flipud(masked_mean)))
-			plt.title("Mean frame and RoI, Spkr {:}".format(subject))
-			plt.imshow(conv_masked, cmap="Greys_r")
-			file_ending_roi = "subj{:}_roi.pdf".format(subject)
-			savepath_roi = os.path.join(root,d,file_ending_roi)
-			plt.savefig(savepath_roi)
-			good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
-
-			# TODO improve typo handling
-			if good_roi.upper() in yes_no:
-				if good_roi.upper() == "Y":
+def main():
+
+	# scan conversion for pca_data images, to be defined below on first
+	# pass through data
+	conv = None
+
+	# read in arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument("directory", help="Experiment directory containing all subjects")
+	#parser.add_argument("n_pca", help="Number of principal components to start with")
+	#parser.add_argument("n_lda", help="Number of linear discriminant functions to output")
+	#parser.add_argument("-v", "--visualize", help="Produce plots of PC loadings on fan",action="store_true")
+	parser.add_argument("--verify", help="How to check cache integrity: full, sample, or trust (skip if already verified and unchanged)", choices=MODES, default="trust")
+	parser.add_argument("-c", "--chunk-size", help="Number of frames despeckled at once (default: sized to fit the frames in cache; lower to save memory)", type=int, default=None)
+	parser.add_argument("-j", "--jobs", help="Number of processes filtering frames in parallel (default 1; 0 for one per CPU)", type=int, default=1)
+	parser.add_argument("--crop", help="Filter only the RoI's bounding box (faster; despeckles slightly differently)", action="store_true")
+	parser.add_argument("-b", "--batch", help="Run without asking for input, using saved RoIs", action="store_true")
+	parser.add_argument("--roi-table", help="Table of RoI bounds for all subjects", default=None)
+	parser.add_argument("--store", help="Directory of a store of processed frames reused by later runs (default: no store)", default=None)
+	parser.add_argument("-s", "--store-size", help="Size bound in MB of the store (default 4096)", type=int, default=DEFAULT_MAX_BYTES // 2**20)
+	args = parser.parse_args()
+
+	# processed frames kept for reuse across runs, if asked for
+	store = ProcStore(args.store, max_bytes=args.store_size * 2**20) if args.store else None
+
+	# RoI bounds for all subjects, if given in one table
+	roi_table = read_roi_table(args.roi_table) if args.roi_table else None
+	skipped = []
+
+	try:
+		expdir = args.directory
+	except IndexError:
+		print("\tDirectory provided doesn't exist")
+		ArgumentParser.print_usage
+		ArgumentParser.print_help
+		sys.exit(2)
+
+	frames_out = "frames_proc.npy"
+	metadata_out = "frames_proc_metadata.npz"
+
+	for root,directories,files in os.walk(expdir):
+
+		# TODO RoI stuff diff. for each subj
+
+		for d in directories:
+
+			subject = re.sub("[^0-9]","",d)
+
+			# saved RoI bounds (or --roi-table entry), required in batch mode
+			saved_roi = lookup_roi(subject, os.path.join(root,d), roi_table)
+			if saved_roi is None and args.batch:
+				print("No saved RoI for {}; skipping it in batch mode".format(d))
+				skipped.append(d)
+				continue
+
+			# time spent in each stage for this subject
+			timer = StageTimer()
+
+			with timer.stage('load'):
+				data_in = os.path.join(root,d,"frames.npy")
+				data = np.load(data_in, mmap_mode='r')
+				md = load_metadata(os.path.join(root,d), "frames")
+
+			# sanity checks on data checksums, skipped if already verified
+			with timer.stage('verify', data.shape[0]):
+				verify_cache(os.path.join(root,d), "frames", data, md, 'sha1',
+							 stage="suzhou-process-cache", mode=args.verify)
+
+			# subset data
+			#training_list = ["IY1", "SH"] # for use later
+			#test_list = ["IZ1"] # for use later
+			vow_mask = (md['pron'].isin(["BIY", "IY", "XIY", "SIY", "BIZX", "IZ", "SIZ", "XIZ", "YZ", "XYZ", "SZ", "SZW"])) & (md['phone'] != "SH") & (md['phone'] != "S")
+			sh_mask = (md['pron'].isin(["XIZ", "XYZ", "XIY", "XIEX", "XEU"])) & (md['phone'] == "SH")
+			s_mask = (md['pron'].isin(["SAAE", "SEI", "SUW", "SIEX", "SOOW", "SZ", "SZW"])) & (md['phone'] == "S")
+			mask = vow_mask | sh_mask | s_mask
+			mask = mask.to_numpy()
+			pca_data = data[mask]
+			pca_md = md[mask]
+			pca_md = pca_md.reset_index(drop=True)
+
+			# define scan conversion (C9-5/10 probe) from first acq for first subj
+			if conv is None:
+				print("Defining Converter ...")
+				conv = scan_table(pca_data[0].shape)
+
+			print("Defining region of interest ...")
+
+			# get mean frame and apply mask
+			with timer.stage('mean', pca_data.shape[0]):
+				mean = mean_frame(pca_data)
+			conv_mean = conv.convert(mean)
+			plt.title("Mean frame, Spkr {:}".format(subject))
+			plt.imshow(conv_mean, cmap="Greys_r")
+			file_ending_mean = "subj{:}_mean.pdf".format(subject)
+			savepath_mean = os.path.join(root,d,file_ending_mean)
+			plt.savefig(savepath_mean)
+			roi_upper = 600
+			roi_lower = 300
+			roi_left = 20
+			roi_right = 100
+			if saved_roi is not None:
+				roi_upper, roi_lower, roi_left, roi_right = [saved_roi[f] for f in ROI_FIELDS]
+
+			# TODO give mask converted shape
+			while True:
+				mask = us.roi(mean, 
+					upper=roi_upper, 
+					lower=roi_lower,
+					left=roi_left,
+					right=roi_right)
+				masked_mean = mean * mask
+				conv_masked = conv.convert(masked_mean)
+				plt.title("Mean frame and RoI, Spkr {:}".format(subject))
+				plt.imshow(conv_masked, cmap="Greys_r")
+				file_ending_roi = "subj{:}_roi.pdf".format(subject)
+				savepath_roi = os.path.join(root,d,file_ending_roi)
+				plt.savefig(savepath_roi)
+				if args.batch:
+					print("Using saved RoI; preview in {}".format(savepath_roi))
 					break
+				good_roi = input("Inspect {:}. Good RoI? (Y/N) ".format(savepath_roi))
+
+				# TODO improve typo handling
+				if good_roi.upper() in yes_no:
+					if good_roi.upper() == "Y":
+						break
+					else:
+						roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
+						roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
+						roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
+						roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
 				else:
-					roi_upper = int(input("Please provide a new upper bound for RoI (currently {:}): ".format(roi_upper)))
-					roi_lower = int(input("Please provide a new lower bound for RoI (currently {:}): ".format(roi_lower)))
-					roi_left = int(input("Please provide a new left bound for RoI (currently {:}): ".format(roi_left)))
-					roi_right = int(input("Please provide a new right bound for RoI (currently {:}): ".format(roi_right)))
-			else:
-				print("Typo, try again ...")
-
-		# preallocate ultrasound frame array for PCA
-		conv_frame = conv.convert(pca_data[0])
-		out_frames = np.empty([pca_data.shape[0]] + list(conv_frame.shape)) * np.nan
-		out_frames = out_frames.astype('uint8')
-
-		adj_radius = int(conv_frame.shape[0]/50) # for median filter
-
-		print("Preprocessing data for PCA ...")
-
-		# make a sample frame for reference
-		in_sample = pca_data[0]
-		masked_samp = in_sample * mask # using mask defined above
-		sradd_samp = us.srad(masked_samp)
-		convd_samp = np.flipud(conv.convert(np.flipud(sradd_samp)))
-		clean_samp = us.clean_frame(convd_samp, median_radius=adj_radius)
-		rescaled_samp = clean_samp * 255
-		sample_frame = rescaled_samp.astype(np.uint8)
-		plt.title("Sample frame, Spkr {:}".format(subject))
-		plt.imshow(sample_frame, cmap="Greys_r")
-		file_ending_sample = "subj{:}_sample.pdf".format(subject)
-		savepath_sample = os.path.join(root,d,file_ending_sample)
-		plt.savefig(savepath_sample)
-		print("Please check sample frame at {}!".format(savepath_sample))
-
-		# fill in preallocated array
-		# TODO parallelize this part?
-		# TODO or perhaps the SRAD function
-
-		filt_hds = []
-		total = out_frames.shape[0]
-
-		for idx,frame in enumerate(pca_data):
-			masked = frame * mask # using mask defined above
-			sradd = us.srad(masked)
-			convd = np.flipud(conv.convert(np.flipud(sradd)))
-			clean = us.clean_frame(convd, median_radius=adj_radius)
-			# copying to out_frames casts to np.uint8; rescaling required
-			rescaled = clean * 255
-			out_frames[idx,:,:] = rescaled
-			print(out_frames[idx].dtype)
-			# new sha1 hex: filtered, conv to np.uint8
-			filt_hds.append(sha1(out_frames[idx].ravel()).hexdigest()) 
-			print("\tAdded frame {} of {}".format(idx+1,total))
-
-		# add new sha1 hex as a column in the df
-		pca_md = pca_md.assign(sha1_filt=pd.Series(filt_hds, index=pca_md.index))
-
-		# make sure there is one metadata row for each image frame
-		assert(len(pca_md) == out_frames.shape[0])
-
-		# for debugging
-		# pca_md.to_csv(os.path.join(root,d,"test.csv"))
-
-		# compare checksums
-		assert(pca_md.loc[0, 'sha1_filt'] == sha1(out_frames[0].ravel()).hexdigest())
-		assert(pca_md.loc[len(pca_md)-1,'sha1_filt'] == sha1(out_frames[-1].ravel()).hexdigest())
+					print("Typo, try again ...")
+
+			# save a RoI file for later (batch) runs
+			write_roi(os.path.join(root,d,roi_filename(subject)),
+					  dict(zip(ROI_FIELDS, [roi_upper, roi_lower, roi_left, roi_right])))
+
+			# preallocate ultrasound frame array for PCA
+			out_cache = MappedFrameCache(os.path.join(root,d,frames_out),
+										 [pca_data.shape[0]] + list(conv.out_shape), np.uint8)
+			out_frames = out_cache.frames
+
+			adj_radius = int(conv.out_shape[0]/50) # for median filter
+
+			print("Preprocessing data for PCA ...")
+
+			# mask (defined above), despeckle, convert and clean each frame
+			# in one pass, cropped to the RoI with --crop (see ultramisc.procframes)
+			pipeline = FramePipeline(conv, mask=mask, median_radius=adj_radius,
+									 clean=us.clean_frame, chunk=args.chunk_size, timer=timer,
+									 crop=args.crop)
+
+			# make a sample frame for reference
+			sample_frame = pipeline.run(pca_data[:1], np.empty((1,) + conv.out_shape, dtype=np.uint8))[0]
+			plt.title("Sample frame, Spkr {:}".format(subject))
+			plt.imshow(sample_frame, cmap="Greys_r")
+			file_ending_sample = "subj{:}_sample.pdf".format(subject)
+			savepath_sample = os.path.join(root,d,file_ending_sample)
+			plt.savefig(savepath_sample)
+			print("Please check sample frame at {}!".format(savepath_sample))
+
+			# fill in preallocated array a chunk at a time, with new sha1
+			# hex of each filtered frame, conv to np.uint8, in --jobs processes
+			filt_hds = process_frames(pca_data, out_frames, pipeline, jobs=args.jobs,
+									  store=store, progress=Progress("Filtered", "frames"),
+									  raw_digests=list(pca_md['sha1']))
+			if store is not None:
+				print("Reused {} of {} frames from {}".format(store.hits, len(filt_hds), store.root))
+				store.hits = store.misses = 0
+
+			# add new sha1 hex as a column in the df
+			pca_md = pca_md.assign(sha1_filt=pd.Series(filt_hds, index=pca_md.index))
+
+			# make sure there is one metadata row for each image frame
+			assert(len(pca_md) == out_frames.shape[0])
+
+			# for debugging
+			# pca_md.to_csv(os.path.join(root,d,"test.csv"))
+
+			# compare checksums
+			assert(pca_md.loc[0, 'sha1_filt'] == sha1(out_frames[0].ravel()).hexdigest())
+			assert(pca_md.loc[len(pca_md)-1,'sha1_filt'] == sha1(out_frames[-1].ravel()).hexdigest())
 		
-		# outputs
-		np.save(os.path.join(root,d,frames_out), out_frames)
-		pca_md.to_pickle(os.path.join(root,d,metadata_out))
+			# outputs
+			with timer.stage('save', pca_data.shape[0]):
+				out_cache.close()
+				write_metadata(os.path.join(root,d,metadata_out), pca_md)
+				write_crop(os.path.join(root,d), "frames_proc", pipeline.geometry())
+				write_manifest(os.path.join(root,d), "frames_proc", stage="suzhou-process-cache")
+			report = timer.report(frames=pca_data.shape[0], jobs=args.jobs)
+			savepath_timing = write_timing(os.path.join(root,d), "frames_proc", report)
+			print("Processed {} frames in {:.1f} s ({} frames/s); timing in {}".format(
+				report['frames'], report['wall'], report['frames_per_sec'], savepath_timing))
+			plt.close("all")
+
+	if skipped:
+		print("Skipped {} subject(s) without a saved RoI: {}".format(len(skipped), ", ".join(skipped)))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -7,11 +7,9 @@
 ##Jennifer Kuo, July 2019
 
 import argparse
-import audiolabel
-import glob
 import os
-import numpy as np
-import re
+
+from ultramisc.tiers import load_tiers
 
 # read in arguments
 parser = argparse.ArgumentParser()
@@ -41,25 +39,22 @@ for textgrid in os.listdir(tg_dir):
 
     if not '.ch1.textgrid' in tg_path.lower():
             continue
-    pm = audiolabel.LabelManager(from_file=tg_path, from_type="praat")
+    tg_tiers = load_tiers(tg_path)
+    phone_tier = tg_tiers['phones']
 
     # var used to check if any 'x' was found in the target word.
 
     adjusted = False
 
     ##loop through all words in each textgrids
-    for word in pm.tier('words'):
-        phones = []
+    for word in tg_tiers['words']:
 
         #ignore frame sentence
         if (word.text in ['we','have','before','it','']):
             continue
         ## for the target word(s):
         ##get all the phones in the target word(s)
-        for t in (np.arange(word.t1, word.t2, 0.01)):
-            phon = pm.tier('phones').label_at(t)
-            phones.append(phon)
-        phones = set(phones)
+        phones = [phone_tier[i] for i in phone_tier.overlapping(word.t1, word.t2)]
 
         ## loop through all the phones in target word.
         for p in phones:
@@ -67,7 +62,7 @@ for textgrid in os.listdir(tg_dir):
             ## if 'x' was found in a phone, check that it corresponds
             ## to the correct part of the target word/phrase. 
             if "x" in p.text:
-                target_word = pm.tier('words').label_at(p.center).text
+                target_word = tg_tiers['words'].label_at(p.center).text
                 if not any(s in p.text.lower() for s in ["tx","dx","rx"]):
                     print("Wrong label in Acq. " + acq_name + ". Label should be on 't', 'd', or 'r'. ")
                     count = count + 1
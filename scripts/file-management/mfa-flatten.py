@@ -5,10 +5,11 @@
 #   expdir - top-level directory for one subject, as output by EchoB/Micro.
 
 import argparse
-import glob
 import os
 import shutil
 
+from ultramisc.catalog import add_catalog_args, open_catalog
+
 # parse argument(s)
 parser = argparse.ArgumentParser()
 # read things in
@@ -16,22 +17,23 @@ parser.add_argument("expdir",
 					help="Experiment directory containing \
 						acquisitions in flat structure"
 					)
+add_catalog_args(parser)
 args = parser.parse_args()
 
 expdir = args.expdir
 
-glob_regexp = os.path.join(expdir,"*","*.raw")
+catalog = open_catalog(expdir, args)
 
 # make new folder
 alignment_in = os.path.join(expdir,"_align")
 os.makedirs(alignment_in)
 
-for rawh in glob.glob(glob_regexp):
-    timestamp = os.path.split(os.path.splitext(rawh)[0])[1]
-    parent = os.path.split(rawh)[0]
+for acq_rec in catalog.acquisitions():
+    timestamp = os.path.split(os.path.splitext(acq_rec.raw)[0])[1]
+    parent = acq_rec.parent
     wav = os.path.join(parent, str(timestamp + ".ch1.wav"))
-    transcript = os.path.join(parent,"transcript.txt")
-    if not os.path.exists(transcript):
+    transcript = acq_rec.transcript
+    if transcript is None:
         continue
     # make a new file handle for the transcript file
     if os.path.splitext(transcript)[0] != timestamp: # keeping this comparison for the future
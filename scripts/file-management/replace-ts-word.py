@@ -4,9 +4,11 @@ replace-ts-word: find and replace words in transcript files.
   dictionaries.
 '''
 
-import os, sys, glob
+import os, sys
 import argparse
 
+from ultramisc.catalog import add_catalog_args, open_catalog
+
 def read_transcript(my_ts_file):
 	with open(my_ts_file, "r") as tsfile:
 		sentence = tsfile.read().rstrip('\n')
@@ -28,24 +30,21 @@ parser.add_argument("-s", "--sub",
 					)
 # pull them together, making an "args" object with 3 attributes
 # args.expdir, args.word, args.sub
+add_catalog_args(parser)
 args = parser.parse_args()
 if args.problem is None or args.sub is None:
 	print("Problem word and/or substitution undefined; exiting.")
 	sys.exit()
 
-# figure out where all .raw files are
+# figure out where all .raw files are: the catalog indexes every
+# subdirectory of our subject dir with a .raw file in it
 expdir = os.path.normpath(args.expdir)
-glob_regex = os.path.join(os.path.normpath(args.expdir), # our subject dir
-						  "*", # wildcard (any directory)
-						  "*.raw" # wildcard (any filename) plus .raw
-						 )
+catalog = open_catalog(expdir, args)
 
-# running glob.glob gives us a list of filepaths matching the regexp above
-# and we iterate through this list, finding all ts files
-for rf in glob.glob(glob_regex):
-	parent = os.path.dirname(rf)
-	tsfile = os.path.join(parent,"transcript.txt")
-	if os.path.exists(tsfile):
+# we iterate through the indexed acquisitions, finding all ts files
+for acq_rec in catalog.acquisitions():
+	tsfile = acq_rec.transcript
+	if tsfile is not None:
 		ts_list = read_transcript(tsfile)
 		print(ts_list)
 		# Python time! expressions like this are called 
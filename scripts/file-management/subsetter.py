@@ -6,11 +6,11 @@
 # TODO test both options (delete, not delete)
 
 import argparse
-import glob
 import os
 import shutil
 import sys
 
+from ultramisc.catalog import add_catalog_args, open_catalog
 from ultramisc.ebutils import read_stimfile, read_listfile
 
 # parse argument(s)
@@ -29,6 +29,7 @@ parser.add_argument("-d",
 						files to new location)",
 					action="store_true"
 					)
+add_catalog_args(parser)
 args = parser.parse_args()
 
 expdir = os.path.normpath(args.expdir)
@@ -58,14 +59,11 @@ else:
 	os.mkdir(copy_dir)# TODO create the copy location
 
 # iterate over directories within expdir with a *.raw file in them
-rawfile_glob_exp = os.path.join(os.path.normpath(args.expdir),
-								"*",
-								"*.raw"
-								)
+catalog = open_catalog(expdir, args)
 
-for rf in glob.glob(rawfile_glob_exp):
-	parent = os.path.dirname(rf)
-	acq = os.path.split(parent)[1]
+for acq_rec in catalog.acquisitions():
+	parent = acq_rec.parent
+	acq = acq_rec.timestamp
 	stimfile = os.path.join(parent,"word.txt")
 
 	try:
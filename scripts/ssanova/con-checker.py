@@ -11,6 +11,8 @@
 
 import os, sys
 
+from ultramisc.discards import discarded
+
 def usage():
 	print(sys.exit(__doc__))
 
@@ -22,10 +24,14 @@ except IndexError:
 
 missing_files = 0
 
+# acquisitions listed in the discard manifest are skipped, too
+discards = discarded(basedir)
+
 # generate the rest of the output file
 for dirs, subdirs, files in os.walk(basedir):
 	# exclude discard, subset, distractor, etc. directories from search. change the set as needed
 	subdirs[:] = [s for s in subdirs if s not in set(['discards','_discards','affricates','_affricates'])]
+	subdirs[:] = [s for s in subdirs if s not in discards]
 	for textgrid in files:
 
 		# only check for .con files for which a .ch1.TextGrid file exists
@@ -4,28 +4,19 @@
 # usage: python eb-extract-frames.py expdir (-f / --flop)
 
 import argparse
-import audiolabel
-import glob
-import numpy as np
 import os
 import re
 import shutil
 
-from operator import itemgetter
 from PIL import Image
-from ultratils.rawreader import RawReader
-from ultratils.pysonix.scanconvert import Converter
 
-from ultramisc.ebutils import read_echob_metadata, read_stimfile
+from ultramisc.catalog import add_catalog_args, open_catalog
+from ultramisc.rawframes import RawFrames
+from ultramisc.scanconv import scan_table
+from ultramisc.sync import SyncIndex
+from ultramisc.tiers import load_tiers
 
-class Header(object):
-    def __init__(self):
-        pass
-class Probe(object):
-    def __init__(self):
-        pass
-
-# empty RawReader and Converter handles
+# empty frame reader and Converter handles
 rdr = None
 conv = None
 
@@ -42,6 +33,7 @@ parser.add_argument("-f",
 					help="Horizontally flip the data", 
 					action="store_true"
 					)
+add_catalog_args(parser)
 args = parser.parse_args()
 
 # read in expdir
@@ -55,45 +47,35 @@ except FileExistsError:
 	shutil.rmtree(output_dir)
 	os.mkdir(output_dir)
 
-# glob expression
-rawfile_glob_exp = os.path.join(expdir,"*","*.raw")
-
-# loop through acqs and:
-for rf in glob.glob(rawfile_glob_exp):
+# acquisition index; changed folders are re-read on every run, files
+# edited in place with --refresh
+catalog = open_catalog(expdir, args)
 
-	parent = os.path.dirname(rf)
-	basename = os.path.split(parent)[1]
+# loop through acqs, using stim.txt to skip non-trials, and:
+for acq_rec in catalog.acquisitions(exclude_stims=["bolus", "practice"]):
 
-	# use stim.txt to skip non-trials
-	stimfile = os.path.join(parent,"stim.txt")
-	stim = read_stimfile(stimfile)
-	if stim == "bolus" or stim == "practice":
-		continue
+	rf = acq_rec.raw
+	parent = acq_rec.parent
+	basename = acq_rec.timestamp
+	stimfile = acq_rec.stimfile
+	stim = acq_rec.stim
 
-	# define RawReader and Converter parameters from first acq
+	# define frame reader and Converter parameters from first acq
 	if conv is None:
 		print("Defining Converter ...")
 		# get image size data; allow for manual input if problems
-		try:
-			nscanlines, npoints, junk = read_echob_metadata(rf)
-		except ValueError: 
+		if acq_rec.nscanlines is not None:
+			nscanlines, npoints, junk = acq_rec.nscanlines, acq_rec.npoints, acq_rec.junk
+		else:
 			print("WARNING: no data in {}.img.txt, please input:".format(basename))
 			nscanlines = int(input("\tnscanlines (usually 127) "))
 			npoints = int(input("\tnpoints (usually 1020) "))
 			junk = int(input("\tjunk (usually 36, or 1020 - 984) "))
 
-		# TODO use metadata instead of hard-coded values
-		header = Header()
-		header.w = nscanlines       # input image width
-		header.h = npoints - junk   # input image height, trimmed
-		header.sf = 4000000         # magic number, sorry!
-		probe = Probe()
-		probe.radius = 10000        # based on '10' in transducer model number
-		probe.numElements = 128     # based on '128' in transducer model number
-		probe.pitch = 185           # based on Ultrasonix C9-5/10 transducer
-		conv = Converter(header, probe)
+		# TODO use metadata instead of hard-coded values (C9-5/10 probe)
+		conv = scan_table((npoints - junk, nscanlines))
 
-	rdr = RawReader(rf, nscanlines=nscanlines, npoints=npoints)
+	rdr = RawFrames(rf, nscanlines=nscanlines, npoints=npoints, junk=junk, flop=args.flop)
 
 	# define "support" file names based on .raw
 	wav = os.path.join(parent,str(basename + ".ch1.wav"))
@@ -102,25 +84,18 @@ for rf in glob.glob(rawfile_glob_exp):
 	sync_tg = os.path.join(parent,str(basename + ".sync.TextGrid"))
 	idx_txt = os.path.join(parent,str(basename + ".idx.txt"))
 
-	# instantiate LabelManager
-	pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
+	# load compiled alignment tiers
+	tg_tiers = load_tiers(tg)
 
 	# read in .sync.txt file and get recording window times
-	sync = os.path.join(parent,str(basename + '.sync.txt'))
-	sync_times = []
-	with open(sync, 'r') as s:
-		for line in s:
-			try:
-				sync_times.append(float(line.strip().split("\t")[0]))
-			except ValueError:
-				pass # ignore line if a header is present 
-	rec_start = sync_times[0]
-	rec_end = sync_times[-1]
+	sync_idx = SyncIndex.from_synctxt(sync)
+	rec_start = sync_idx.start
+	rec_end = sync_idx.end
 
 	# extract frame(s) from .raw file
 	# TODO handle multiple repititions by only taking last rep
-	for v,m in pm.tier('phone').search(vow, return_match=True):
-		pron = pm.tier('word').label_at(v.center).text
+	for v,m in tg_tiers['phone'].search(vow, return_match=True):
+		pron = tg_tiers['word'].label_at(v.center).text
 
 		# skip any tokens from non-target words
 		if pron not in ["BUH", "FUH", "BUW", "BOOW", "BAAE", "BIY"]:
@@ -162,56 +137,27 @@ for rf in glob.glob(rawfile_glob_exp):
 		shutil.copy(sync, copy_dir)
 
 		# get segmental context (non-silence)
-		skip_back = 0
-		while True:
-			if skip_back == 0:
-				before = pm.tier('phone').prev(v).text
-			else:
-				before = pm.tier('phone').prev(v,skip=skip_back).text
-			if before == "sp":
-				skip_back += 1
-			else:
-				break
-
-		skip_ahead = 0
-		while True:
-			if skip_ahead == 0:
-				after = pm.tier('phone').prev(v).text
-			else:
-				after = pm.tier('phone').prev(v,skip=skip_ahead).text
-			if after == "sp":
-				skip_ahead += 1
-			else:
-				break
+		before = tg_tiers['phone'].prev_label(v, silence=["sp"]).text
+		after = tg_tiers['phone'].next_label(v, silence=["sp"]).text
 
 		# TODO store phone, before, after
 		# TODO move these to format-con? you'll actually need them then
 
 		# find frame idx of v.t1 - v.t2 range and of midpoint
-		t1_diff = [abs(v.t1 - t) for t in sync_times]
-		t2_diff = [abs(v.t2 - t) for t in sync_times]
-		tmid_diff = [abs(v.center) - t for t in sync_times]
-		t1_match = min(enumerate(t1_diff), key=itemgetter(1))[0]
-		t2_match = min(enumerate(t2_diff), key=itemgetter(1))[0]
-		tmid_match = min(enumerate(tmid_diff), key=itemgetter(1))[0]
-
-		# extract and convert v.t1 - v.t2 range
-		for idx in range(t1_match, (t2_match+1)):
+		t1_match, t2_match = sync_idx.frame_range(v.t1, v.t2)
+		tmid_match = sync_idx.nearest(v.center)
 
-			# extract frame using RawReader
-			unconv_frame = rdr.get_frame(idx)
+		# extract v.t1 - v.t2 range in one read; junk pixels are
+		# trimmed off of top (and frames flopped) by the reader
+		frame_idxs = range(t1_match, (t2_match+1))
+		trimmed_frames = rdr.get_frames(frame_idxs)
 
-			# trim junk pixels off of top
-			trimmed_frame = unconv_frame[junk:,:]
-			if args.flop:
-				trimmed_frame = np.fliplr(trimmed_frame)
+		# convert extracted range to fan shape, all at once
+		ready_frames = conv.convert(trimmed_frames, dtype=trimmed_frames.dtype)
+		for idx,ready_frame in zip(frame_idxs, ready_frames):
 
 			# TODO filter?
 
-			# convert to fan shape
-			conv_frame = conv.convert(np.flipud(trimmed_frame))
-			ready_frame = np.flipud(conv_frame)
-
 			# create frame handle and save to copy dir
 			fh = basename + "." + str(idx) + ".bmp"
 			out_img = Image.fromarray(ready_frame)
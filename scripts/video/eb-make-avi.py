@@ -14,16 +14,9 @@ import subprocess
 from operator import itemgetter
 from PIL import Image
 from ultratils.rawreader import RawReader
-from ultratils.pysonix.scanconvert import Converter
 
 from ultramisc.ebutils import read_echob_metadata, read_stimfile
-
-class Header(object):
-    def __init__(self):
-        pass
-class Probe(object):
-    def __init__(self):
-        pass
+from ultramisc.scanconv import scan_table
 
 # empty RawReader and Converter handles
 rdr = None
@@ -79,16 +72,8 @@ for rf in glob.glob(rawfile_glob_exp):
 			npoints = int(input("\tnpoints (usually 1020) "))
 			junk = int(input("\tjunk (usually 36, or 1020 - 984) "))
 
-		# TODO use metadata instead of hard-coded values
-		header = Header()
-		header.w = nscanlines       # input image width
-		header.h = npoints - junk   # input image height, trimmed
-		header.sf = 4000000         # magic number, sorry!
-		probe = Probe()
-		probe.radius = 10000        # based on '10' in transducer model number
-		probe.numElements = 128     # based on '128' in transducer model number
-		probe.pitch = 185           # based on Ultrasonix C9-5/10 transducer
-		conv = Converter(header, probe)
+		# TODO use metadata instead of hard-coded values (C9-5/10 probe)
+		conv = scan_table((npoints - junk, nscanlines))
 
 	rdr = RawReader(rf, nscanlines=nscanlines, npoints=npoints)
 
@@ -126,8 +111,7 @@ for rf in glob.glob(rawfile_glob_exp):
 			trimmed_frame = np.fliplr(trimmed_frame)
 
 		# convert to fan shape
-		conv_frame = conv.convert(np.flipud(trimmed_frame))
-		ready_frame = np.flipud(conv_frame)
+		ready_frame = conv.convert(trimmed_frame, dtype=trimmed_frame.dtype)
 
 		# create frame handle and save to copy dir
 		fh = basename + "." + "{0:05d}".format(idx) + ".bmp"
@@ -3,19 +3,19 @@ flap-video-writer: convert designated sequences of ultrasound frames into .AVI m
 '''
 
 import argparse
-import audiolabel
-import glob
 import imgphon.ultrasound as us # TODO reorganize
 import numpy as np
 import os
 import subprocess
 
-from operator import itemgetter
 from PIL import Image # check if configured on VM
-from ultratils.rawreader import RawReader
-from ultratils.pysonix.scanconvert import Converter
 
-from ultramisc.ebutils import read_echob_metadata, read_stimfile
+from ultramisc.catalog import add_catalog_args, open_catalog
+from ultramisc.rawframes import RawFrames
+from ultramisc.scanconv import scan_table
+from ultramisc.sync import load_sync_tiers
+from ultramisc.tiers import load_tiers
+from ultramisc.ebutils import read_stimfile
 
 # read in arguments
 parser = argparse.ArgumentParser()
@@ -28,29 +28,21 @@ parser.add_argument("-f",
 					help="Horizontally flip the data", 
 					action="store_true"
 					)
+add_catalog_args(parser)
 args = parser.parse_args()
 
 expdir = args.expdir
-rawfile_glob_exp = os.path.join(expdir,"*","*.raw")
-
-class Header(object):
-	def __init__(self):
-		pass
-class Probe(object):
-	def __init__(self):
-		pass
+catalog = open_catalog(expdir, args)
 
 conv = None
 
-for rf in glob.glob(rawfile_glob_exp):
-	parent = os.path.dirname(rf)
-	basename = os.path.split(parent)[1]
+# use stim.txt to skip non-trials, flap.txt to skip words without flaps
+for acq_rec in catalog.acquisitions(exclude_stims=["bolus", "practice"]):
+	rf = acq_rec.raw
+	parent = acq_rec.parent
+	basename = acq_rec.timestamp
+	stim = acq_rec.stim
 
-	# use stim.txt to skip non-trials, flap.txt to skip words without flaps
-	stimfile = os.path.join(parent,"stim.txt")
-	stim = read_stimfile(stimfile)
-	if stim == "bolus" or stim == "practice":
-		continue
 	flapfile = os.path.join(parent,"flap.txt")
 	flap_set = read_stimfile(flapfile)
 	if flap_set == "N":
@@ -58,19 +50,11 @@ for rf in glob.glob(rawfile_glob_exp):
 
 	if conv is None:
 		print("Making converter...")
-		nscanlines, npoints, junk = read_echob_metadata(rf)
-		header = Header()
-		header.w = nscanlines       # input image width
-		header.h = npoints - junk   # input image height, trimmed
-		header.sf = 4000000         # magic number, sorry!
-		probe = Probe()
-		probe.radius = 10000        # based on '10' in transducer model number
-		probe.numElements = 128     # based on '128' in transducer model number
-		probe.pitch = 185           # based on Ultrasonix C9-5/10 transducer
-		conv = Converter(header, probe)
+		nscanlines, npoints, junk = acq_rec.nscanlines, acq_rec.npoints, acq_rec.junk
+		conv = scan_table((npoints - junk, nscanlines))   # C9-5/10 probe
 	
 	print("Now working on {}".format(parent))
-	rdr = RawReader(rf, nscanlines=nscanlines, npoints=npoints)
+	rdr = RawFrames(rf, nscanlines=nscanlines, npoints=npoints, junk=junk)
 	
 	wav = os.path.join(parent,str(basename + ".ch1.wav"))
 	tg = os.path.join(parent,str(basename + ".ch1.TextGrid"))
@@ -78,21 +62,21 @@ for rf in glob.glob(rawfile_glob_exp):
 	sync = os.path.join(parent,str(basename + '.sync.txt'))
 	idx_txt = os.path.join(parent,str(basename + ".idx.txt"))
 	
-	# instantiate LabelManager objects for FA transcript and sync pulses
+	# load compiled tiers for FA transcript and sync pulses
 	try: 
-		pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
+		tg_tiers = load_tiers(tg)
 	except FileNotFoundError:
 		print("No alignment TG in {}; skipping".format(basename))
 		continue
 
 	try: 
-		sync_pm = audiolabel.LabelManager(from_file=sync_tg, from_type="praat")
+		sync_idx = load_sync_tiers(sync_tg, tiers=('pulse_idx',), anchor='center')['pulse_idx']
 	except FileNotFoundError:
 		print("No sync TG in {}; skipping".format(basename))
 		continue
 		
 	# search for target words in 'words' tier
-	for wd in pm.tier('words'):
+	for wd in tg_tiers['words']:
 		if not wd.text: # skip intervals in which no word was found
 			continue
 		if wd.text.lower() != stim.lower():
@@ -101,7 +85,7 @@ for rf in glob.glob(rawfile_glob_exp):
 				# take next word's .t2 as word_t2
 				# as in "heard of it", "bird of paradise", "hard of hearing"
 				word_t1 = wd.t1
-				word_t2 = pm.tier('words').next(wd).t2 # invariably "of"
+				word_t2 = tg_tiers['words'].next(wd).t2 # invariably "of"
 			elif wd.text.lower() == 'carta':
 				# take 'carta' even though it doesn't match any stim (which is Magna Carta for this one)
 				word_t1 = wd.t1
@@ -112,7 +96,7 @@ for rf in glob.glob(rawfile_glob_exp):
 			word_t1 = wd.t1
 			word_t2 = wd.t2
 
-		for ph in pm.tier('phones'):
+		for ph in tg_tiers['phones']:
 			if ph.t1 < word_t1:
 				continue
 			if ph.t2 > word_t2:
@@ -120,10 +104,10 @@ for rf in glob.glob(rawfile_glob_exp):
 			if ph.text.upper() not in ["TX", "DX"]:
 				continue
 			# TODO check if no flap found, issue warning
-			before = pm.tier('phones').prev(ph)
+			before = tg_tiers['phones'].prev(ph)
 			if before.text.upper() == "R": # if there's a postvocalic R, then go back an additional interval
-				before = pm.tier('phones').prev(before)
-			after = pm.tier('phones').next(ph)
+				before = tg_tiers['phones'].prev(before)
+			after = tg_tiers['phones'].next(ph)
 			
 			print("Extracting {} {} {} from {}".format(before.text, ph.text, after.text, stim))
 
@@ -138,26 +122,9 @@ for rf in glob.glob(rawfile_glob_exp):
 			# then it extracts images
 			# then it runs ffmpeg
  
-			diff_start = []
-			diff_end = []
-			diff_start_flap = []
-			diff_end_flap = []
-			
-			for frame in sync_pm.tier('pulse_idx'):
-				diff_s = abs(frame.center - start_time)
-				diff_start.append(diff_s)
-				diff_e = abs(frame.center - end_time)
-				diff_end.append(diff_e)
-				diff_sf = abs(frame.center - start_flap)
-				diff_start_flap.append(diff_sf)
-				diff_ef = abs(frame.center - end_flap)
-				diff_end_flap.append(diff_ef)
-
 			# get start/end indices; flap indices
-			start_idx = min(enumerate(diff_start), key=itemgetter(1))[0] - 1
-			end_idx = min(enumerate(diff_end), key=itemgetter(1))[0] - 1
-			start_flap_idx = min(enumerate(diff_start_flap), key=itemgetter(1))[0] - 1
-			end_flap_idx = min(enumerate(diff_end_flap), key=itemgetter(1))[0] - 1
+			nearest = sync_idx.nearest([start_time, end_time, start_flap, end_flap]) - 1
+			start_idx, end_idx, start_flap_idx, end_flap_idx = [int(i) for i in nearest]
 			
 			# make sure there are at least 20 frames after end of flap
 			# credit: Jennifer Kuo
@@ -168,17 +135,14 @@ for rf in glob.glob(rawfile_glob_exp):
 			is_flap = list(range(start_flap_idx, end_flap_idx))
 			is_flap = [ix - start_idx for ix in is_flap]
 			
-			# get frames using RawReader's reader object
-			target_frames = rdr.data[start_idx:end_idx]
-			
-			for idx,fr in enumerate(target_frames):
-
-				# trim junk pixels off of top
-				trimmed_frame = fr[junk:,:]
+			# get frames, with junk pixels trimmed off of top, as a view
+			# into the memory-mapped .raw file
+			target_frames = rdr.frames[start_idx:end_idx]
 
-				# convert to fan shape
-				conv_frame = conv.convert(np.flipud(trimmed_frame))
-				messy_frame = np.flipud(conv_frame)
+			# convert to fan shape, all at once
+			messy_frames = conv.convert(target_frames, dtype=target_frames.dtype)
+			
+			for idx,messy_frame in enumerate(messy_frames):
 				
 				norm_frame = us.normalize(messy_frame)
 				cframe = us.clean_frame(norm_frame, median_radius=15, log_sigma=4)
@@ -0,0 +1,55 @@
+'''
+Check ultramisc.srad against imgphon's srad(), which the process-cache
+  scripts used before, and its stack version against the per-frame one.
+
+The imgphon comparison needs imgphon installed. It runs on synthetic
+  frames (ultramisc.synthetic), and on real ones if ULTRAMISC_TEST_FRAMES
+  names a raw frame cache (e.g. some subject's frames.npy).
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+from ultramisc.srad import srad_chunks, srad_frame, srad_stack
+from ultramisc.synthetic import write_frames
+
+# frames taken from the real cache, if any
+REAL_FRAMES = 4
+
+def synthetic_frames(tmpdir, nframes=4, geometry=(64, 180, 20)):
+    rawfile = os.path.join(str(tmpdir), "frames.raw")
+    depth = np.linspace(60, 120, nframes)
+    write_frames(rawfile, nframes, geometry, depth, np.random.RandomState(0))
+    return np.fromfile(rawfile, dtype=np.uint8).reshape((nframes,) + geometry[:2])
+
+def real_frames():
+    path = os.environ.get("ULTRAMISC_TEST_FRAMES")
+    if not path:
+        pytest.skip("ULTRAMISC_TEST_FRAMES not set")
+    return np.array(np.load(path, mmap_mode='r')[:REAL_FRAMES])
+
+@pytest.fixture(params=['synthetic', 'real'])
+def frames(request, tmpdir):
+    if request.param == 'real':
+        return real_frames()
+    return synthetic_frames(tmpdir)
+
+def test_matches_imgphon(frames):
+    us = pytest.importorskip("imgphon.ultrasound")
+    for frame in frames:
+        want = np.asarray(us.srad(frame), dtype=np.float64)
+        np.testing.assert_allclose(srad_frame(frame), want, rtol=0, atol=1e-6)
+
+def test_stack_matches_frame(frames):
+    want = np.stack([srad_frame(frame) for frame in frames])
+    assert np.array_equal(srad_stack(frames), want)
+    got = np.concatenate([chunk for _,chunk in srad_chunks(frames, chunk=3)])
+    assert np.array_equal(got, want)
+
+def test_float32_tolerance(frames):
+    want = srad_stack(frames)
+    got = srad_stack(frames, dtype=np.float32)
+    assert got.dtype == np.float32
+    assert np.abs(got - want).max() < 0.05
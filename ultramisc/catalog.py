@@ -0,0 +1,363 @@
+'''
+catalog: persistent index of the acquisitions in an experiment directory.
+
+An EchoB experiment directory holds one subdirectory per acquisition,
+  each containing a headerless .raw file and its "support" files
+  (.img.txt, stim.txt, .ch1.TextGrid, .sync.TextGrid, ...). Walking
+  that tree and reopening the small text files on every run is slow
+  on network storage, so the catalog does it once and keeps the result
+  in an SQLite file, by default at the top of the experiment directory.
+  SQLite's locking is unreliable on network file systems (NFS), so the
+  index can instead live in a local directory (catalog_path()).
+
+  Opening a catalog refreshes the index in the cheap 'dirs' mode by
+  default (building it if there is none yet), so that acquisitions
+  added or removed since the last run are noticed. refresh() has three
+  modes:
+
+    'dirs'   one listing of the experiment directory: acquisition
+             directories whose modification time changed (a file in
+             them was added, removed or renamed) are re-read, new ones
+             added and vanished ones dropped. Files edited in place
+             don't change their directory's time and go unnoticed.
+    'files'  as 'dirs', but also stat() the .raw and support files of
+             every acquisition, catching files edited in place.
+    'full'   re-read every acquisition.
+
+  Scripts take --refresh [MODE] for a deeper check and --catalog-dir
+  (add_catalog_args(), open_catalog()).
+
+Usage:
+  cat = Catalog(expdir)
+  for acq in cat.acquisitions(exclude_stims=["bolus", "practice"]):
+      print(acq.timestamp, acq.raw, acq.stim, acq.nscanlines)
+'''
+
+import glob
+import hashlib
+import os
+import sqlite3
+
+from collections import namedtuple
+
+from ultramisc.discards import discarded
+from ultramisc.ebutils import _deaccent, read_echob_metadata, read_stimfile
+
+CATALOG_NAME = "_catalog.sqlite"
+
+# schema version, stored as the database's user_version; an index of
+# another version is rebuilt
+CATALOG_VERSION = 2
+
+REFRESH_MODES = ('dirs', 'files', 'full')
+
+# support files tracked for each acquisition, as (column, suffix or name);
+# suffixes are appended to the acquisition's timestamp
+SUPPORT_FILES = [
+    ('img', ".img.txt"),
+    ('stimfile', "stim.txt"),
+    ('wav', ".ch1.wav"),
+    ('tg', ".ch1.TextGrid"),
+    ('sync', ".sync.txt"),
+    ('sync_tg', ".sync.TextGrid"),
+    ('idx_txt', ".idx.txt"),
+    ('transcript', "transcript.txt"),
+]
+
+_PATH_COLS = ['parent', 'raw'] + [col for col,_ in SUPPORT_FILES]
+
+Acquisition = namedtuple('Acquisition',
+    ['timestamp', 'stim', 'stim_deaccent', 'nscanlines', 'npoints', 'junk']
+    + _PATH_COLS
+    + ['raw_mtime', 'raw_size']
+    + [col + '_mtime' for col,_ in SUPPORT_FILES]
+    + ['dir_mtime']
+)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS acqs (
+    timestamp TEXT PRIMARY KEY,
+    stim TEXT,
+    stim_deaccent TEXT,
+    nscanlines INTEGER,
+    npoints INTEGER,
+    junk INTEGER,
+    {paths},
+    raw_mtime REAL,
+    raw_size INTEGER,
+    {mtimes},
+    dir_mtime REAL
+)
+'''.format(
+    paths=",\n    ".join("{} TEXT".format(c) for c in _PATH_COLS),
+    mtimes=",\n    ".join("{}_mtime REAL".format(c) for c,_ in SUPPORT_FILES)
+)
+
+def _support_name(acq, suffix):
+    '''
+    Support files named with a leading "." are prefixed by the
+      acquisition timestamp; others (stim.txt etc.) are fixed names.
+    '''
+    if suffix.startswith("."):
+        return acq + suffix
+    return suffix
+
+def _mtime(path):
+    '''
+    Return modification time of path, or None if it doesn't exist.
+    '''
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def catalog_path(expdir, cachedir=None):
+    '''
+    Return the index file of expdir: expdir/_catalog.sqlite, or with
+      cachedir, a file in cachedir named after expdir's absolute path
+      (e.g. a local disk, for an experiment on network storage).
+    '''
+    if cachedir is None:
+        return os.path.join(expdir, CATALOG_NAME)
+    key = hashlib.sha1(os.path.abspath(expdir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cachedir, "catalog-{}.sqlite".format(key))
+
+class Catalog(object):
+    '''
+    On-disk index of the acquisitions in an experiment directory.
+    Inputs: expdir, the experiment directory (acquisitions in a flat
+        structure, one subdirectory each);
+      dbfile, location of the index (default: see catalog_path());
+      refresh, a refresh() mode to bring the index up to date with on
+        instantiation (default 'dirs'; True for 'dirs'); with None the
+        index is only built if it is new, and with False never, so that
+        queries don't touch the experiment directory at all.
+    '''
+    def __init__(self, expdir, dbfile=None, refresh='dirs'):
+        self.expdir = os.path.normpath(expdir)
+        if dbfile is None:
+            dbfile = catalog_path(self.expdir)
+        elif os.path.dirname(dbfile):
+            os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+        self.dbfile = dbfile
+        self.conn = sqlite3.connect(dbfile)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        new = version != CATALOG_VERSION
+        if new:
+            self.conn.execute("DROP TABLE IF EXISTS acqs")
+            self.conn.execute(_SCHEMA)
+            self.conn.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+            self.conn.commit()
+        if refresh is True or (refresh is None and new):
+            refresh = 'dirs'
+        if refresh:
+            self.refresh(refresh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _abs(self, relpath):
+        if relpath is None:
+            return None
+        return os.path.join(self.expdir, relpath)
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.expdir)
+
+    def _scan_acq(self, acq, rawfile, dir_mtime):
+        '''
+        Read the support files of one acquisition and return a dict
+          of column values for the index.
+        '''
+        parent = os.path.dirname(rawfile)
+        rec = {
+            'dir_mtime': dir_mtime,
+            'timestamp': acq,
+            'parent': self._rel(parent),
+            'raw': self._rel(rawfile),
+            'raw_mtime': None,
+            'raw_size': None,
+            'stim': None,
+            'stim_deaccent': None,
+            'nscanlines': None,
+            'npoints': None,
+            'junk': None,
+        }
+        st = os.stat(rawfile)
+        rec['raw_mtime'] = st.st_mtime
+        rec['raw_size'] = st.st_size
+        for col,suffix in SUPPORT_FILES:
+            path = os.path.join(parent, _support_name(acq, suffix))
+            mtime = _mtime(path)
+            rec[col] = self._rel(path) if mtime is not None else None
+            rec[col + '_mtime'] = mtime
+
+        if rec['stimfile'] is not None:
+            stim = read_stimfile(self._abs(rec['stimfile']))
+            rec['stim'] = stim
+            rec['stim_deaccent'] = _deaccent(stim)
+        if rec['img'] is not None:
+            try:
+                nscanlines, npoints, junk = read_echob_metadata(rawfile)
+            except (ValueError, KeyError):
+                pass # empty or malformed .img.txt; left as NULL
+            else:
+                rec['nscanlines'] = nscanlines
+                rec['npoints'] = npoints
+                rec['junk'] = junk
+        return rec
+
+    def _is_stale(self, row):
+        '''
+        Check the stored modification times of an indexed acquisition
+          against the file system.
+        '''
+        raw = self._abs(row['raw'])
+        try:
+            st = os.stat(raw)
+        except FileNotFoundError:
+            return True
+        if st.st_mtime != row['raw_mtime'] or st.st_size != row['raw_size']:
+            return True
+        parent = self._abs(row['parent'])
+        for col,suffix in SUPPORT_FILES:
+            path = os.path.join(parent, _support_name(row['timestamp'], suffix))
+            if _mtime(path) != row[col + '_mtime']:
+                return True
+        return False
+
+    def refresh(self, mode='dirs'):
+        '''
+        Bring the index up to date with the experiment directory: new
+          acquisitions are added, acquisitions whose .raw file is gone
+          are dropped, and known ones re-read if they changed.
+        Inputs: mode, how to tell which changed (see REFRESH_MODES and
+          the module docs): 'dirs', by their directory's modification
+          time; 'files', also by those of their files; 'full', re-read
+          them all.
+        Outputs: (added, updated, removed) lists of timestamps.
+        '''
+        if mode not in REFRESH_MODES:
+            raise ValueError("Unknown catalog refresh mode {}".format(mode))
+        self.conn.row_factory = sqlite3.Row
+        known = {r['timestamp']: r for r in self.conn.execute("SELECT * FROM acqs")}
+        self.conn.row_factory = None
+
+        # one listing of the experiment directory, one stat per subdirectory
+        dirs = []
+        with os.scandir(self.expdir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append((entry.name, entry.path, entry.stat().st_mtime))
+
+        added, updated, seen = [], [], set()
+        for acq,dirpath,dir_mtime in sorted(dirs):
+            row = known.get(acq)
+            if row is not None and mode != 'full' and row['dir_mtime'] == dir_mtime:
+                if mode == 'dirs' or not self._is_stale(row):
+                    seen.add(acq)
+                    continue
+            rawfiles = sorted(glob.glob(os.path.join(glob.escape(dirpath), "*.raw")))
+            if not rawfiles:
+                continue
+            seen.add(acq)
+            # more than one .raw file; keep the first
+            rec = self._scan_acq(acq, rawfiles[0], dir_mtime)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO acqs ({}) VALUES ({})".format(
+                    ", ".join(rec.keys()), ", ".join("?" * len(rec))),
+                list(rec.values())
+            )
+            if row is None:
+                added.append(acq)
+            else:
+                updated.append(acq)
+
+        removed = sorted(set(known) - seen)
+        self.conn.executemany("DELETE FROM acqs WHERE timestamp = ?",
+                              [(acq,) for acq in removed])
+        self.conn.commit()
+        return added, updated, removed
+
+    def _to_acquisition(self, row):
+        rec = dict(zip(Acquisition._fields, row))
+        for col in _PATH_COLS:
+            rec[col] = self._abs(rec[col])
+        return Acquisition(**rec)
+
+    def acquisitions(self, exclude_stims=None, deaccent=False, include_discarded=False):
+        '''
+        Return indexed acquisitions as a list of Acquisition tuples,
+          sorted by timestamp. Paths are absolute; missing support
+          files are None, as are geometry fields if .img.txt is empty.
+        Inputs: exclude_stims, stim values to skip (e.g. "bolus");
+          deaccent, if True compare exclude_stims against the
+            deaccented stim instead of the raw stim;
+          include_discarded, if True also return acquisitions listed
+            in the experiment's discard manifest (see ultramisc.discards).
+        '''
+        cols = ", ".join(Acquisition._fields)
+        rows = self.conn.execute(
+            "SELECT {} FROM acqs ORDER BY timestamp".format(cols))
+        out = [self._to_acquisition(r) for r in rows]
+        if not include_discarded:
+            skip = discarded(self.expdir)
+            out = [a for a in out if a.timestamp not in skip]
+        if exclude_stims:
+            exclude_stims = set(exclude_stims)
+            if deaccent:
+                out = [a for a in out if a.stim_deaccent not in exclude_stims]
+            else:
+                out = [a for a in out if a.stim not in exclude_stims]
+        return out
+
+    def get(self, timestamp):
+        '''
+        Return the Acquisition for one timestamp, or None.
+        '''
+        cols = ", ".join(Acquisition._fields)
+        row = self.conn.execute(
+            "SELECT {} FROM acqs WHERE timestamp = ?".format(cols),
+            (timestamp,)).fetchone()
+        if row is None:
+            return None
+        return self._to_acquisition(row)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM acqs").fetchone()[0]
+
+def add_catalog_args(parser):
+    '''
+    Add the catalog options --refresh and --catalog-dir to an
+      argparse parser (see open_catalog()).
+    '''
+    parser.add_argument("--refresh",
+                        nargs="?",
+                        const="files",
+                        choices=REFRESH_MODES,
+                        default=None,
+                        help="How to bring the acquisition catalog up to date: dirs \
+                              (default; changed acquisition folders), files (also \
+                              files edited in place; the default for a bare \
+                              --refresh) or full (re-read everything)"
+                        )
+    parser.add_argument("--catalog-dir",
+                        default=None,
+                        help="Keep the acquisition catalog in this (local) directory \
+                              instead of the experiment directory"
+                        )
+
+def open_catalog(expdir, args, refresh='dirs'):
+    '''
+    Open the catalog of expdir as set by the options of
+      add_catalog_args() in args; refresh, mode used if --refresh
+      wasn't given (default 'dirs').
+    '''
+    return Catalog(expdir, dbfile=catalog_path(expdir, args.catalog_dir),
+                   refresh=args.refresh or refresh)
@@ -0,0 +1,123 @@
+'''
+discards: record discarded acquisitions instead of moving them.
+
+Extraction scripts used to "discard" an acquisition whose target frame
+  couldn't be found by copying its whole directory into a discards
+  folder and deleting the original, mid-run. Instead, a discard is now
+  a line in a tab-delimited manifest at the top of the experiment
+  directory (_discards.txt) giving the acquisition, the reason, and
+  the phone and frame offset involved. Catalog.acquisitions() leaves
+  discarded acquisitions out by default, so every tool that finds
+  acquisitions through the catalog respects the manifest; recording
+  the same discard again is a no-op, so reruns are idempotent.
+
+Acquisitions can still be moved out of the way with relocate(), which
+  renames (or hardlinks) their directory and never copies data.
+'''
+
+import csv
+import errno
+import os
+
+from collections import OrderedDict, namedtuple
+
+DISCARDS_NAME = "_discards.txt"
+
+Discard = namedtuple('Discard', ['acq', 'reason', 'phone', 'frame_offset', 'stage'])
+
+def discards_path(expdir):
+    '''
+    Return the location of the discard manifest of an experiment.
+    '''
+    return os.path.join(expdir, DISCARDS_NAME)
+
+def _field(value):
+    return "" if value is None else str(value)
+
+def read_discards(expdir):
+    '''
+    Return an OrderedDict of acquisition -> list of Discard records
+      (fields as strings), in the order they were recorded.
+    '''
+    out = OrderedDict()
+    try:
+        with open(discards_path(expdir), 'r', newline='') as fh:
+            for row in csv.DictReader(fh, delimiter='\t'):
+                rec = Discard(**{f: row.get(f, "") for f in Discard._fields})
+                out.setdefault(rec.acq, []).append(rec)
+    except FileNotFoundError:
+        pass
+    return out
+
+def discarded(expdir):
+    '''
+    Return the set of discarded acquisition timestamps.
+    '''
+    return set(read_discards(expdir))
+
+def record_discard(expdir, acq, reason, phone=None, frame_offset=None, stage=None):
+    '''
+    Add a discard to the manifest, unless the same one is already there.
+    Inputs: acq, acquisition timestamp; reason, short description;
+      phone, frame_offset: the target that failed and how many frames
+        away from its intended frame the search went; stage, name of
+        the script recording the discard.
+    Returns True if a new record was written.
+    '''
+    rec = Discard(acq, reason, _field(phone), _field(frame_offset), _field(stage))
+    if rec in read_discards(expdir).get(acq, []):
+        return False
+    path = discards_path(expdir)
+    new = not os.path.exists(path)
+    with open(path, 'a', newline='') as fh:
+        w = csv.writer(fh, delimiter='\t', lineterminator='\n')
+        if new:
+            w.writerow(Discard._fields)
+        w.writerow(rec)
+    return True
+
+def clear_discards(expdir, acqs):
+    '''
+    Remove all records for acqs from the manifest (e.g. after fixing
+      an acquisition's alignment), so that it is used again.
+    '''
+    acqs = set(acqs)
+    recs = [r for rs in read_discards(expdir).values() for r in rs if r.acq not in acqs]
+    path = discards_path(expdir)
+    tmp = path + ".tmp"
+    with open(tmp, 'w', newline='') as fh:
+        w = csv.writer(fh, delimiter='\t', lineterminator='\n')
+        w.writerow(Discard._fields)
+        w.writerows(recs)
+    os.replace(tmp, path)
+
+def relocate(parent, dest, link=False):
+    '''
+    Move an acquisition directory to dest without copying any data:
+      with os.rename, or with link=True by hardlinking its files into
+      dest and leaving the original in place.
+    Returns False (and leaves everything as it was) if dest is on
+      another file system, where neither is possible.
+    '''
+    if os.path.exists(dest):
+        raise FileExistsError(errno.EEXIST, "Already exists", dest)
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    try:
+        if not link:
+            os.rename(parent, dest)
+            return True
+        for root, dirs, files in os.walk(parent):
+            target = os.path.join(dest, os.path.relpath(root, parent))
+            os.makedirs(target, exist_ok=True)
+            for f in files:
+                os.link(os.path.join(root, f), os.path.join(target, f))
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if link and os.path.isdir(dest):
+            for root, dirs, files in os.walk(dest, topdown=False):
+                for f in files:
+                    os.remove(os.path.join(root, f))
+                os.rmdir(root)
+        return False
@@ -0,0 +1,450 @@
+'''
+extract: build several frame caches in one pass over an experiment.
+
+The *-cache-frames.py scripts each hard-code one set of targets and walk
+  the whole experiment to build one cache. The engine here reads a spec
+  file naming any number of target sets, and for every acquisition loads
+  the TextGrid, sync pulses and .raw file once, collects the tokens of
+  every target set, and streams each set's frames to its own cache.
+
+A spec is a JSON file (or dict) like:
+
+  {
+    "phone_tier": "phone",
+    "word_tier": "word",
+    "exclude_stims": ["bolus", "practice"],
+    "targets": {
+      "iz": {
+        "phones": "^(IY1|IH1)$",
+        "words": ["IZ", "BIZX", "SIZ", "XIZ", "IY", "BIY", "SIY", "XIY"],
+        "relabel": [
+          {"phone": "^IY1$", "word": ["IZ", "BIZX", "SIZ", "XIZ"], "to": "IZ1"},
+          {"phone": "^IY1$", "word": ["SIEX", "XIEX"], "to": null}
+        ],
+        "context": {"silence": ["sp"]},
+        "timepoints": [0.5],
+        "max_shift": 3
+      }
+    }
+  }
+
+Keys at the top level set defaults for all target sets; each target set
+  may override them. Target set keys:
+
+  phones        regular expression for phone labels (required)
+  words         regular expression or list of words; tokens in other
+                  words are skipped (default: any word)
+  relabel       rules tried in order; the first whose phone (and word,
+                  if given) matches gives the token's phone label, or
+                  drops the token if "to" is null
+  split         regular expression with two groups splitting a phone
+                  label into phone and sup (e.g. tone) columns
+  context       silence: labels skipped when finding before/after;
+                strip: regular expression removed from before/after;
+                require: list of {"side": "before"|"after",
+                  "distance": n, "match": regex} tests on neighbouring
+                  labels, combined according to require_mode ("all"
+                  or "any"); edge_label: label assumed past either end
+                  of the tier (default "sp")
+  timepoints    fractions of the phone interval to take frames at
+                  (default [0.5], the midpoint)
+  series        if true, the frames at all timepoints form one row of
+                  the cache, shape (len(timepoints), height, width);
+                  otherwise each timepoint is its own row
+  frame_offset  added to the frame index found in the sync tier
+  max_shift     if a target frame was not recorded, step back up to
+                  this many frames looking for one
+  on_missing    "acq" (default) drops the target set's tokens from the
+                  whole acquisition when a frame can't be found;
+                  "token" drops only that token
+  output        cache file stem in the experiment directory (default:
+                  frames_<name>; written as <output>.npy and
+                  <output>_metadata.npz, logged in <output>_log.txt)
+  word_column   name of the metadata column holding the word (default
+                  "word"; the Suzhou scripts read "pron")
+
+A target set is skipped (and the skip logged) in any acquisition whose
+  TextGrid lacks its phone or word tier, so one spec can list target
+  sets for experiments with differently named tiers; a target set with
+  no tokens for that reason writes nothing, leaving any cache of its
+  name alone.
+'''
+
+import json
+import os
+import re
+
+from collections import OrderedDict
+from hashlib import sha1
+
+import numpy as np
+
+from ultramisc.catalog import Catalog
+from ultramisc.framecache import FrameCacheWriter
+from ultramisc.manifest import remove_manifest
+from ultramisc.metadata import MetadataBuilder, Schema
+from ultramisc.parallel import imap_ordered
+from ultramisc.rawframes import RawFrames
+from ultramisc.sync import load_sync_tiers
+from ultramisc.tiers import load_tiers
+
+# spec keys that may be given at the top level as defaults
+DEFAULTS = {
+    'phone_tier': 'phone',
+    'word_tier': 'word',
+    'exclude_stims': ['bolus', 'practice'],
+    'words': None,
+    'relabel': [],
+    'split': None,
+    'context': {},
+    'timepoints': [0.5],
+    'series': False,
+    'frame_offset': 0,
+    'max_shift': 0,
+    'on_missing': 'acq',
+    'word_column': 'word',
+}
+
+def _word_matcher(words):
+    '''
+    Compile a word restriction (regex string, list of words or None).
+    '''
+    if words is None:
+        return None
+    if isinstance(words, str):
+        return re.compile(words)
+    return re.compile("^({})$".format('|'.join(re.escape(w) for w in words)))
+
+class TargetSet(object):
+    '''
+    One named set of targets from an extraction spec.
+    Inputs: name, target set name; spec, its dict from the spec file;
+      defaults, top-level spec values to fall back on.
+    '''
+    def __init__(self, name, spec, defaults=None):
+        opts = dict(DEFAULTS)
+        if defaults is not None:
+            opts.update({k: v for k,v in defaults.items() if k in DEFAULTS})
+        unknown = set(spec) - set(DEFAULTS) - {'phones', 'output'}
+        if unknown:
+            raise ValueError("Unknown key(s) {} in target set {}".format(
+                sorted(unknown), name))
+        opts.update(spec)
+        if 'phones' not in opts:
+            raise ValueError("Target set {} has no phones".format(name))
+        if opts['on_missing'] not in ('acq', 'token'):
+            raise ValueError("on_missing must be 'acq' or 'token' in target set {}".format(name))
+
+        self.name = name
+        self.output = opts.get('output', "frames_" + name)
+        self.phone_tier = opts['phone_tier']
+        self.word_tier = opts['word_tier']
+        self.exclude_stims = [s.lower() for s in opts['exclude_stims']]
+        self.phones = re.compile(opts['phones'])
+        self.words = _word_matcher(opts['words'])
+        self.relabel = [(re.compile(r['phone']), _word_matcher(r.get('word')), r['to'])
+                        for r in opts['relabel']]
+        self.split = None if opts['split'] is None else re.compile(opts['split'])
+
+        context = opts['context']
+        self.silence = list(context.get('silence', []))
+        self.strip = None if context.get('strip') is None else re.compile(context['strip'])
+        self.require = [(r['side'], int(r.get('distance', 1)), re.compile(r['match']))
+                        for r in context.get('require', [])]
+        self.require_any = context.get('require_mode', 'all') == 'any'
+        self.edge_label = context.get('edge_label', 'sp')
+
+        self.timepoints = [float(t) for t in opts['timepoints']]
+        self.series = bool(opts['series'])
+        self.frame_offset = int(opts['frame_offset'])
+        self.max_shift = int(opts['max_shift'])
+        self.on_missing = opts['on_missing']
+        self.word_column = opts['word_column']
+
+    @property
+    def schema(self):
+        '''
+        Metadata Schema of this target set's cache.
+        '''
+        columns = [('timestamp', 'category'), ('time', 'float'), ('timepoint', 'float'),
+                   ('pulseidx', 'int'), ('rawdataidx', 'int'),
+                   ('width', 'int'), ('height', 'int'), ('phone', 'category')]
+        if self.split is not None:
+            columns.append(('sup', 'category'))
+        columns += [('stim', 'category'), (self.word_column, 'category'),
+                    ('before', 'category'), ('after', 'category'),
+                    ('sha1', 'hash'), ('sha1_dtype', 'category')]
+        return Schema(columns)
+
+    def wants_stim(self, stim):
+        return (stim or "").lower() not in self.exclude_stims
+
+    def label(self, phone, word):
+        '''
+        Return the output phone label for a token, or None to drop it.
+        '''
+        for phone_re,word_re,to in self.relabel:
+            if phone_re.match(phone) and (word_re is None or word_re.match(word)):
+                return to
+        return phone
+
+    def _neighbour(self, tier, lab, side, distance):
+        if side == 'before':
+            nb = tier.prev(lab, skip=distance - 1)
+        else:
+            nb = tier.next(lab, skip=distance - 1)
+        return self.edge_label if nb is None else nb.text
+
+    def context_ok(self, tier, lab):
+        '''
+        Apply the context requirements to label lab in tier.
+        '''
+        if len(self.require) == 0:
+            return True
+        tests = (m.match(self._neighbour(tier, lab, side, dist)) is not None
+                 for side,dist,m in self.require)
+        return any(tests) if self.require_any else all(tests)
+
+    def context(self, tier, lab):
+        '''
+        Return (before, after) labels of lab, skipping silence.
+        '''
+        out = []
+        for nb in (tier.prev_label(lab, silence=self.silence),
+                   tier.next_label(lab, silence=self.silence)):
+            text = self.edge_label if nb is None else nb.text
+            if self.strip is not None:
+                text = self.strip.sub('', text)
+            out.append(text)
+        return tuple(out)
+
+def load_spec(spec):
+    '''
+    Return a list of TargetSets from a spec file name or dict.
+    '''
+    if isinstance(spec, str):
+        with open(spec, 'r') as fh:
+            spec = json.load(fh, object_pairs_hook=OrderedDict)
+    if 'targets' not in spec or len(spec['targets']) == 0:
+        raise ValueError("Spec lists no target sets")
+    defaults = {k: v for k,v in spec.items() if k != 'targets'}
+    sets = [TargetSet(name, ts, defaults) for name,ts in spec['targets'].items()]
+    outputs = [ts.output for ts in sets]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Target sets must have distinct outputs")
+    return sets
+
+def _find_frame(rdr, idx, max_shift):
+    '''
+    Step back from frame idx until a recorded frame is found; return
+      (idx, shift), or (None, shift) if none within max_shift frames.
+    '''
+    shift = 0
+    while not rdr.has_frame(idx):
+        idx -= 1
+        shift += 1
+        if shift > max_shift:
+            return None, shift
+    return idx, shift
+
+def _extract_set(ts, acq_rec, stim, tiers, sync_idx, rdr, geometry):
+    '''
+    Collect one target set's tokens from one acquisition.
+    Returns (frames or None, MetadataBuilder or None, log lines).
+    '''
+    nscanlines, npoints, junk = geometry
+    acq = acq_rec.timestamp
+    phone_tier = tiers[ts.phone_tier]
+    word_tier = tiers[ts.word_tier]
+    idxs = []
+    recs = []
+    log = []
+
+    for lab in phone_tier.search(ts.phones):
+        word_lab = word_tier.label_at(lab.center)
+        word = "" if word_lab is None else word_lab.text
+        if ts.words is not None and not ts.words.match(word):
+            continue
+        phone = ts.label(lab.text, word)
+        if phone is None:
+            continue
+        if not ts.context_ok(phone_tier, lab):
+            continue
+        before, after = ts.context(phone_tier, lab)
+        sup = None
+        if ts.split is not None:
+            m = ts.split.match(phone)
+            if m:
+                phone, sup = m.groups()
+            else:
+                sup = "NA"
+
+        times = [lab.t1 + tp * (lab.t2 - lab.t1) for tp in ts.timepoints]
+        pulse = sync_idx['pulse_idx'].nearest(times) + ts.frame_offset
+        rawdata = sync_idx['raw_data_idx'].nearest(times) + ts.frame_offset
+
+        found = []
+        for p in pulse:
+            idx, shift = _find_frame(rdr, int(p), ts.max_shift)
+            if idx is None:
+                break
+            if shift > 0:
+                log.append("\t".join([acq, stim, phone, "changed by {:}".format(shift), "N/A"]) + "\n")
+            found.append((idx, shift))
+        if len(found) < len(pulse):
+            log.append("\t".join([acq, stim, phone, "discarded", "no frame"]) + "\n")
+            if ts.on_missing == 'acq':
+                return None, None, log
+            continue
+
+        rows = [list(range(len(times)))] if ts.series else [[i] for i in range(len(times))]
+        for row in rows:
+            first = row[0]
+            idxs.append([found[i][0] for i in row])
+            rec = {
+                'timestamp': acq,
+                'time': times[first],
+                'timepoint': ts.timepoints[first],
+                'pulseidx': found[first][0],
+                'rawdataidx': int(rawdata[first]) - found[first][1],
+                'width': nscanlines,
+                'height': npoints - junk,
+                'phone': phone,
+                'stim': stim,
+                ts.word_column: word,
+                'before': before,
+                'after': after,
+            }
+            if ts.split is not None:
+                rec['sup'] = sup
+            recs.append(rec)
+
+    if len(idxs) == 0:
+        return None, None, log
+    flat = rdr.get_frames(np.ravel(idxs))
+    frames = flat.reshape((len(idxs), -1) + flat.shape[1:]) if ts.series else flat
+    md = MetadataBuilder(ts.schema, capacity=len(recs))
+    for frame,rec in zip(frames, recs):
+        md.append(rec, sha1=sha1(frame.ravel()).hexdigest(), sha1_dtype=frame.dtype)
+    return frames, md, log
+
+def extract_acq(job):
+    '''
+    Collect all target sets' tokens from one acquisition, loading its
+      TextGrid, sync pulses and .raw file once. Runs in a worker process
+      when extract() is called with jobs > 1.
+    Inputs: job, tuple of (Acquisition, [TargetSet], geometry, flop).
+    Outputs: dict with 'acq', 'msgs' (progress messages), 'sets', a
+      dict of target set name -> (frames or None, metadata, log lines),
+      and 'skipped', names of target sets whose tiers the TextGrid lacks.
+    '''
+    acq_rec, targets, geometry, flop = job
+    acq = acq_rec.timestamp
+    stim = acq_rec.stim or ""
+    result = {'acq': acq, 'msgs': ["Now working on " + acq], 'sets': {}, 'skipped': []}
+
+    targets = [ts for ts in targets if ts.wants_stim(stim)]
+    if len(targets) == 0:
+        return result
+    try:
+        tiers = load_tiers(acq_rec.tg)
+    except FileNotFoundError:
+        result['msgs'].append("No alignment TG in {}; skipping".format(acq))
+        return result
+    try:
+        sync_idx = load_sync_tiers(acq_rec.sync_tg, tiers=('pulse_idx', 'raw_data_idx'))
+    except FileNotFoundError:
+        result['msgs'].append("No sync TG in {}; skipping".format(acq))
+        return result
+
+    nscanlines, npoints, junk = geometry
+    rdr = RawFrames(acq_rec.raw, nscanlines=nscanlines, npoints=npoints, junk=junk, flop=flop)
+    for ts in targets:
+        missing = [name for name in (ts.phone_tier, ts.word_tier) if name not in tiers]
+        if missing:
+            log = "\t".join([acq, stim, "NA", "skipped", "no {} tier".format("/".join(missing))]) + "\n"
+            result['sets'][ts.name] = (None, None, [log])
+            result['skipped'].append(ts.name)
+            continue
+        result['sets'][ts.name] = _extract_set(ts, acq_rec, stim, tiers, sync_idx, rdr, geometry)
+    rdr.close()
+    return result
+
+def extract(expdir, spec, flop=False, jobs=1, geometry=None, verbose=True):
+    '''
+    Build one frame cache per target set in spec, in a single pass over
+      the acquisitions in expdir.
+    Inputs: expdir, experiment directory; spec, spec file name or dict;
+      flop, horizontally mirror frames; jobs, worker processes (see
+      ultramisc.parallel); geometry, (nscanlines, npoints, junk) to use
+      if the first acquisition's .img.txt is empty; verbose, print
+      progress messages.
+    Outputs: dict of target set name -> number of rows cached; nothing
+      is written for a target set with no rows whose tiers were missing.
+    '''
+    targets = load_spec(spec)
+    catalog = Catalog(expdir)
+    acqs = catalog.acquisitions()
+    catalog.close()
+
+    if len(acqs) > 0 and acqs[0].nscanlines is not None:
+        geometry = (acqs[0].nscanlines, acqs[0].npoints, acqs[0].junk)
+    elif len(acqs) > 0 and geometry is None:
+        raise ValueError("No frame geometry in {}.img.txt".format(acqs[0].timestamp))
+
+    writers = {}
+    mds = {}
+    logs = {}
+    skipped = dict.fromkeys((ts.name for ts in targets), 0)
+    for ts in targets:
+        # frames and log are only moved into place once a target set
+        # has something to cache (see below)
+        writers[ts.name] = FrameCacheWriter(os.path.join(expdir, ts.output + ".npy"))
+        mds[ts.name] = MetadataBuilder(ts.schema)
+        logs[ts.name] = os.path.join(expdir, ts.output + "_log.txt")
+        with open(logs[ts.name] + ".part", "w") as header:
+            header.write("acq"+"\t"+"stim"+"\t"+"phone"+"\t"+"status"+"\t"+"problem"+"\n")
+
+    try:
+        jobs_in = [(acq_rec, targets, geometry, flop) for acq_rec in acqs]
+        for result in imap_ordered(extract_acq, jobs_in, jobs=jobs):
+            if verbose:
+                for msg in result['msgs']:
+                    print(msg)
+            for name in result['skipped']:
+                skipped[name] += 1
+            for name,(frames,set_md,log) in result['sets'].items():
+                if len(log) > 0:
+                    with open(logs[name] + ".part", "a") as fh:
+                        fh.writelines(log)
+                if frames is not None:
+                    writers[name].extend(frames)
+                    mds[name].extend(set_md)
+    except BaseException:
+        for ts in targets:
+            writers[ts.name].abort()
+            os.remove(logs[ts.name] + ".part")
+        raise
+
+    counts = {}
+    for ts in targets:
+        md = mds[ts.name]
+        counts[ts.name] = len(md)
+        if len(md) == 0 and skipped[ts.name] > 0:
+            # tiers missing (e.g. a target set for another project):
+            # leave any cache of that name alone
+            writers[ts.name].abort()
+            os.remove(logs[ts.name] + ".part")
+            if verbose:
+                print("{}: no tier {} or {} in {} acquisition(s); nothing written".format(
+                    ts.name, ts.phone_tier, ts.word_tier, skipped[ts.name]))
+            continue
+        remove_manifest(expdir, ts.output)
+        writers[ts.name].close()
+        assert(len(md) == writers[ts.name].count)
+        md.write(os.path.join(expdir, ts.output + "_metadata.npz"))
+        os.replace(logs[ts.name] + ".part", logs[ts.name])
+        if verbose and skipped[ts.name] > 0:
+            print("{}: skipped {} acquisition(s) without tier {} or {} (see {})".format(
+                ts.name, skipped[ts.name], ts.phone_tier, ts.word_tier, logs[ts.name]))
+    return counts
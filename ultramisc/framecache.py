@@ -0,0 +1,332 @@
+'''
+framecache: writing and reading frame caches (frames.npy and friends).
+
+The *-cache-frames.py scripts collect one frame (or frame series) per
+  token. FrameCacheWriter streams those frames straight to a .npy file
+  on disk as they are found, so memory use stays flat and each frame is
+  written exactly once, no matter how large the cache gets. The result
+  is an ordinary .npy file, readable with np.load().
+
+A cache written this way can later be reopened to append more frames
+  in place (FrameCacheWriter.resume), and a sources file next to it
+  (frames.npy -> frames_sources.json) records which acquisitions, in
+  which state, contributed to it, so that scripts can update a cache
+  by extracting only new or changed acquisitions.
+
+Processing a cache needs neither the whole input nor the whole output
+  in memory: the input can be opened with np.load(..., mmap_mode='r'),
+  mean_frame() averages it a chunk of frames at a time, and
+  MappedFrameCache is an output cache of known shape, memory-mapped
+  (np.lib.format.open_memmap) so that frames can be written to it in
+  any order and are paged out to disk as they are written.
+'''
+
+import json
+import os
+import struct
+
+import numpy as np
+
+class FrameCacheWriter(object):
+    '''
+    Append-only writer for a .npy frame cache.
+    Inputs: path, the .npy file to create (e.g. expdir/frames.npy);
+      frame_shape, shape of a single frame (default: taken from the
+        first frame appended);
+      dtype, data type of the cache (default: that of the first frame).
+    Frames are written to path + ".part", which is renamed to path by
+      close(); an interrupted run never leaves a truncated cache behind.
+    Usage:
+      with FrameCacheWriter("frames.npy") as w:
+          for frame in frames:
+              w.append(frame)
+    '''
+    def __init__(self, path, frame_shape=None, dtype=None):
+        self.path = path
+        self.partpath = path + ".part"
+        self.frame_shape = None if frame_shape is None else tuple(frame_shape)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.count = 0
+        self._fh = None
+        self._header_size = None
+        self._closed = False
+        self._resumed_size = None # file size when reopened by resume()
+
+    @classmethod
+    def resume(cls, path):
+        '''
+        Reopen a finished .npy cache to append frames to it in place.
+          The header is only updated by close(); abort() truncates the
+          file back to its original frames.
+        Raises ValueError if the file's header has no room for a larger
+          frame count (e.g. it was written by np.save()); rewrite the
+          cache with a new FrameCacheWriter instead.
+        '''
+        with open(path, 'rb') as fh:
+            version = np.lib.format.read_magic(fh)
+            if version != (1, 0):
+                raise ValueError("Can't append to .npy version {}".format(version))
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(fh)
+            header_size = fh.tell()
+        if fortran or len(shape) < 2:
+            raise ValueError("{} is not a frame cache".format(path))
+        w = cls(path, frame_shape=shape[1:], dtype=dtype)
+        w._header_size = header_size
+        w._header(10**13 - 1) # raises ValueError if a count won't fit
+        w.partpath = path
+        w.count = shape[0]
+        w._fh = open(path, 'r+b')
+        w._resumed_size = header_size + shape[0] * dtype.itemsize * int(np.prod(shape[1:]))
+        w._fh.seek(w._resumed_size)
+        w._fh.truncate()
+        return w
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def shape(self):
+        '''
+        Shape of the cache written so far.
+        '''
+        if self.frame_shape is None:
+            return (self.count,)
+        return (self.count,) + self.frame_shape
+
+    def _header(self, nframes):
+        '''
+        Build a version 1.0 .npy header for nframes frames, padded with
+          spaces to exactly self._header_size bytes.
+        '''
+        d = {'descr': np.lib.format.dtype_to_descr(self.dtype),
+             'fortran_order': False,
+             'shape': (nframes,) + self.frame_shape}
+        hdr = repr(d).encode('latin1')
+        prefix_len = len(np.lib.format.magic(1, 0)) + 2 # magic + uint16 length
+        npad = self._header_size - prefix_len - len(hdr) - 1
+        if npad < 0:
+            raise ValueError("Cache header does not fit in reserved space")
+        hdr = hdr + b' ' * npad + b'\n'
+        return np.lib.format.magic(1, 0) + struct.pack('<H', len(hdr)) + hdr
+
+    def _open(self, frame):
+        if self.frame_shape is None:
+            self.frame_shape = tuple(frame.shape)
+        if self.dtype is None:
+            self.dtype = frame.dtype
+        # reserve room for a header with a count of up to 13 digits;
+        # the real header is written over it by close()
+        self._header_size = 64
+        nmax = 10**13 - 1
+        while True:
+            try:
+                self._header(nmax)
+                break
+            except ValueError:
+                self._header_size += 64
+        self._fh = open(self.partpath, 'wb')
+        self._fh.write(b'\0' * self._header_size)
+
+    def append(self, frame):
+        '''
+        Write one frame to the cache; return its index.
+        '''
+        frame = np.asarray(frame)
+        if self._fh is None:
+            self._open(frame)
+        if tuple(frame.shape) != self.frame_shape:
+            raise ValueError("Frame of shape {} does not match cache frame shape {}".format(
+                frame.shape, self.frame_shape))
+        self._fh.write(np.ascontiguousarray(frame, dtype=self.dtype).data)
+        self.count += 1
+        return self.count - 1
+
+    def extend(self, frames):
+        '''
+        Write a stack of frames (first axis indexes frames) to the cache.
+        '''
+        frames = np.asarray(frames)
+        if len(frames) == 0:
+            return
+        if self._fh is None:
+            self._open(frames[0])
+        if tuple(frames.shape[1:]) != self.frame_shape:
+            raise ValueError("Frames of shape {} do not match cache frame shape {}".format(
+                frames.shape[1:], self.frame_shape))
+        self._fh.write(np.ascontiguousarray(frames, dtype=self.dtype).data)
+        self.count += len(frames)
+
+    def close(self):
+        '''
+        Finalize the .npy header and move the cache into place.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        if self._fh is None:
+            # nothing appended; write an empty cache
+            shape = (0,) if self.frame_shape is None else (0,) + self.frame_shape
+            dtype = np.uint8 if self.dtype is None else self.dtype
+            np.save(self.path, np.empty(shape, dtype=dtype))
+            return
+        self._fh.flush()
+        self._fh.seek(0)
+        self._fh.write(self._header(self.count))
+        self._fh.close()
+        self._fh = None
+        if self.partpath != self.path:
+            os.replace(self.partpath, self.path)
+
+    def abort(self):
+        '''
+        Discard everything written so far.
+        '''
+        self._closed = True
+        if self._resumed_size is not None:
+            # appending in place: cut the file back to its old frames
+            self._fh.truncate(self._resumed_size)
+            self._fh.close()
+            self._fh = None
+            return
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if os.path.exists(self.partpath):
+            os.remove(self.partpath)
+
+class MappedFrameCache(object):
+    '''
+    Memory-mapped .npy frame cache of fixed shape, filled in place.
+    Inputs: path, the .npy file to create; shape, (N, ...) shape of
+      the cache; dtype, its data type.
+    Attributes: frames, the memory-mapped array to write frames into.
+    Like FrameCacheWriter, frames are written to path + ".part", which
+      close() moves to path; abort() (or an exception in a with block)
+      removes it.
+    '''
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.partpath = path + ".part"
+        self.frames = np.lib.format.open_memmap(self.partpath, mode='w+',
+                                                dtype=np.dtype(dtype), shape=tuple(shape))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        '''
+        Write the frames out and move the cache into place.
+        '''
+        if self.frames is None:
+            return
+        self.frames.flush()
+        self.frames = None
+        os.replace(self.partpath, self.path)
+
+    def abort(self):
+        '''
+        Discard the cache.
+        '''
+        self.frames = None
+        if os.path.exists(self.partpath):
+            os.remove(self.partpath)
+
+# size of the float64 partial sums mean_frame() works in
+MEAN_CHUNK_BYTES = 64 * 1024 * 1024
+
+def mean_frame(frames, chunk=None):
+    '''
+    Return the float64 mean frame of frames (N, ...), e.g. a memory
+      map, summed chunk frames at a time (default: as many as fit in
+      MEAN_CHUNK_BYTES of float64), so that only one chunk of frames
+      is ever in memory.
+    '''
+    if frames.shape[0] == 0:
+        raise ValueError("Can't average an empty stack of frames")
+    if chunk is None:
+        chunk = max(1, MEAN_CHUNK_BYTES // max(1, 8 * int(np.prod(frames.shape[1:]))))
+    total = np.zeros(frames.shape[1:], dtype=np.float64)
+    for start in range(0, frames.shape[0], chunk):
+        total += frames[start:start + chunk].sum(axis=0, dtype=np.float64)
+    total /= frames.shape[0]
+    return total
+
+SOURCES_VERSION = 1
+
+# Acquisition fields compared to decide whether an acquisition changed
+SOURCE_FIELDS = ['raw_mtime', 'raw_size', 'img_mtime', 'stimfile_mtime',
+                 'tg_mtime', 'sync_mtime', 'sync_tg_mtime']
+
+def sources_path(frames_out):
+    '''
+    Return the sources file name for cache frames_out.
+    '''
+    return os.path.splitext(frames_out)[0] + "_sources.json"
+
+def acq_state(acq_rec):
+    '''
+    Return the state of an acquisition as recorded in a sources file:
+      modification times (and .raw size) of the files it is built from,
+      taken from its catalog entry (see ultramisc.catalog).
+    '''
+    return {f: getattr(acq_rec, f) for f in SOURCE_FIELDS}
+
+def read_sources(frames_out):
+    '''
+    Return (params, acqs) from the sources file of cache frames_out:
+      the extraction parameters and a dict of timestamp -> acq_state();
+      (None, None) if there is no usable sources file.
+    '''
+    try:
+        with open(sources_path(frames_out), 'r') as fh:
+            src = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None, None
+    if src.get('version') != SOURCES_VERSION:
+        return None, None
+    return src['params'], src['acqs']
+
+def write_sources(frames_out, params, acqs):
+    '''
+    Record the extraction parameters and contributing acquisitions
+      (timestamp -> acq_state()) of cache frames_out.
+    '''
+    sp = sources_path(frames_out)
+    tmp = sp + ".tmp"
+    with open(tmp, 'w') as fh:
+        json.dump({'version': SOURCES_VERSION, 'params': params, 'acqs': acqs},
+                  fh, indent=1, sort_keys=True)
+    os.replace(tmp, sp)
+
+def diff_sources(old_acqs, acq_recs):
+    '''
+    Compare recorded sources with the current acquisitions.
+    Inputs: old_acqs, timestamp -> state dict from read_sources();
+      acq_recs, current Acquisition tuples.
+    Outputs: (new, changed, removed) lists of timestamps.
+    '''
+    new, changed = [], []
+    current = set()
+    for acq_rec in acq_recs:
+        current.add(acq_rec.timestamp)
+        if acq_rec.timestamp not in old_acqs:
+            new.append(acq_rec.timestamp)
+        elif old_acqs[acq_rec.timestamp] != acq_state(acq_rec):
+            changed.append(acq_rec.timestamp)
+    removed = sorted(set(old_acqs) - current)
+    return new, changed, removed
@@ -0,0 +1,244 @@
+'''
+framestore: single-file frame cache container with lazy, partial reads.
+
+A frame cache has traditionally been two files: frames.npy and its
+  metadata (frames_metadata.npz or .pickle, see ultramisc.metadata;
+  after processing, frames_proc.npy and frames_proc_metadata.*).
+  Getting at a subset of frames meant loading both in full.
+
+A .ucache container holds the frames, typed metadata columns and the
+  per-frame hashes in one file:
+
+  8 bytes   magic, b'UMCACHE' + format version
+  8 bytes   length of the JSON header (little-endian uint64)
+  8 bytes   offset of the data area (little-endian uint64)
+  ...       JSON header describing every array and column
+  ...       data area: page-aligned, uncompressed arrays
+
+Every array is memory-mapped on demand, so selecting rows by metadata
+  (e.g. store.select(phone=['n', 'ng'])) touches only the small
+  metadata columns, and store.read(rows) only the selected frames.
+  String columns are stored as categorical codes plus a category list;
+  hash columns (sha1, sha1_filt) as fixed-width byte strings.
+
+An existing .npy + metadata pair can be opened with the same interface
+  (FrameStore.from_legacy) and converted with convert_legacy().
+'''
+
+import json
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from ultramisc.metadata import decode_column, encode_metadata, metadata_path, read_metadata
+
+MAGIC = b'UMCACHE\x01'
+STORE_EXT = ".ucache"
+ALIGN = 4096
+_PREFIX = struct.Struct('<8sQQ')
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+class FrameStore(object):
+    '''
+    Read access to a frame cache: frames plus typed metadata columns.
+    Use FrameStore.open() for a .ucache container or
+      FrameStore.from_legacy() for a .npy + metadata pickle pair.
+    Attributes: frames, (possibly memory-mapped) frame array;
+      nrows, number of frames; columns, list of metadata column names.
+    '''
+    def __init__(self, frames, columns, path=None):
+        self._frames = frames
+        self._cols = {c['name']: c for c in columns}
+        self.columns = [c['name'] for c in columns]
+        self.path = path
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Open a .ucache container. Nothing but the header is read until
+          frames or columns are accessed.
+        '''
+        with open(path, 'rb') as fh:
+            magic, hlen, data_start = _PREFIX.unpack(fh.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a frame cache container".format(path))
+            header = json.loads(fh.read(hlen).decode('utf-8'))
+
+        def mapped(spec):
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:
+                return np.empty(shape, dtype=np.dtype(spec['dtype']))
+            return np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r',
+                             offset=data_start + spec['offset'], shape=shape)
+
+        frames = mapped(header['frames'])
+        columns = []
+        for col in header['columns']:
+            columns.append({'name': col['name'], 'kind': col['kind'],
+                            'array': mapped(col['array']),
+                            'categories': col['categories']})
+        return cls(frames, columns, path=path)
+
+    @classmethod
+    def from_legacy(cls, frames_npy, metadata_file):
+        '''
+        Open a .npy frame cache and its metadata (columnar .npz or
+          pickled DataFrame) with the same interface; the metadata is
+          read in full.
+        '''
+        frames = np.load(frames_npy, mmap_mode='r')
+        md = read_metadata(metadata_file)
+        return cls(frames, encode_metadata(md), path=frames_npy)
+
+    @property
+    def frames(self):
+        return self._frames
+
+    @property
+    def nrows(self):
+        return self._frames.shape[0]
+
+    def __len__(self):
+        return self.nrows
+
+    def codes(self, name):
+        '''
+        Return the integer codes and category list of a string column.
+        '''
+        col = self._cols[name]
+        if col['kind'] != 'category':
+            raise ValueError("Column {} is not categorical".format(name))
+        return col['array'], col['categories']
+
+    def column(self, name, rows=None):
+        '''
+        Return the decoded values of one metadata column (optionally only
+          for rows): string columns as str arrays, hashes as hex strings.
+        '''
+        col = self._cols[name]
+        arr = col['array'] if rows is None else col['array'][rows]
+        if col['kind'] == 'category':
+            cats = np.array(col['categories'], dtype=str)
+            return cats[np.asarray(arr)]
+        if col['kind'] == 'hash':
+            return np.char.decode(np.asarray(arr), 'ascii')
+        return np.asarray(arr)
+
+    def mask(self, **criteria):
+        '''
+        Return a boolean row mask for criteria given as column=values,
+          e.g. mask(phone=['n', 'ng'], before=['i']); all must hold.
+        '''
+        keep = np.ones(self.nrows, dtype=bool)
+        for name,values in criteria.items():
+            if isinstance(values, str) or np.ndim(values) == 0:
+                values = [values]
+            col = self._cols[name]
+            if col['kind'] == 'category':
+                values = set(map(str, values))
+                wanted = [i for i,c in enumerate(col['categories']) if c in values]
+                keep &= np.isin(col['array'], wanted)
+            elif col['kind'] == 'hash':
+                keep &= np.isin(col['array'], np.asarray(values, dtype=bytes))
+            else:
+                keep &= np.isin(col['array'], values)
+        return keep
+
+    def select(self, **criteria):
+        '''
+        Return sorted indices of rows matching criteria (see mask()).
+        '''
+        return np.flatnonzero(self.mask(**criteria))
+
+    def metadata(self, rows=None, columns=None):
+        '''
+        Return metadata for rows (default all) as a DataFrame, with
+          string columns as pandas Categoricals.
+        '''
+        if columns is None:
+            columns = self.columns
+        data = {name: decode_column(self._cols[name], rows=rows) for name in columns}
+        return pd.DataFrame(data, columns=list(columns))
+
+    def read(self, rows=None, columns=None):
+        '''
+        Return (frames, metadata) for rows (default all); only the
+          selected frames are read from disk.
+        '''
+        if rows is None:
+            frames = np.asarray(self._frames)
+        else:
+            frames = self._frames[np.asarray(rows)]
+        return frames, self.metadata(rows=rows, columns=columns)
+
+def write_store(path, frames, metadata, chunk_rows=256):
+    '''
+    Write frames and their metadata to a .ucache container.
+    Inputs: path, output file;
+      frames, (N, ...) array (a memory-mapped array is copied through
+        in chunks of chunk_rows frames, never loaded in full);
+      metadata, DataFrame or MetadataBuilder with one row per frame.
+    '''
+    if len(metadata) != frames.shape[0]:
+        raise ValueError("{} metadata rows for {} frames".format(
+            len(metadata), frames.shape[0]))
+    columns = encode_metadata(metadata)
+
+    # lay out the data area: frames first, then one array per column
+    specs = []
+    offset = 0
+    def place(shape, dtype):
+        nonlocal offset
+        spec = {'dtype': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'shape': list(shape), 'offset': offset}
+        offset = _align(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return spec
+    header = {'frames': place(frames.shape, frames.dtype), 'columns': []}
+    for col in columns:
+        header['columns'].append({'name': col['name'], 'kind': col['kind'],
+                                  'categories': col['categories'],
+                                  'array': place(col['array'].shape, col['array'].dtype)})
+
+    hbytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(hbytes))
+
+    tmp = path + ".part"
+    with open(tmp, 'wb') as fh:
+        fh.write(_PREFIX.pack(MAGIC, len(hbytes), data_start))
+        fh.write(hbytes)
+        fh.seek(data_start + header['frames']['offset'])
+        for start in range(0, frames.shape[0], chunk_rows):
+            fh.write(np.ascontiguousarray(frames[start:start + chunk_rows]).data)
+        for col,spec in zip(columns, header['columns']):
+            fh.seek(data_start + spec['array']['offset'])
+            fh.write(np.ascontiguousarray(col['array']).data)
+        fh.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+def convert_legacy(frames_npy, metadata_file, path=None):
+    '''
+    Convert a .npy + metadata pair into a .ucache container next to it
+      (frames.npy -> frames.ucache); return the container path.
+    '''
+    if path is None:
+        path = os.path.splitext(frames_npy)[0] + STORE_EXT
+    frames = np.load(frames_npy, mmap_mode='r')
+    write_store(path, frames, read_metadata(metadata_file))
+    return path
+
+def open_frame_cache(dirpath, stem="frames"):
+    '''
+    Open the frame cache called stem in dirpath: the container
+      stem.ucache if present, otherwise stem.npy and its metadata
+      (stem_metadata.npz or stem_metadata.pickle).
+    '''
+    container = os.path.join(dirpath, stem + STORE_EXT)
+    if os.path.exists(container):
+        return FrameStore.open(container)
+    return FrameStore.from_legacy(
+        os.path.join(dirpath, stem + ".npy"),
+        metadata_path(dirpath, stem))
@@ -0,0 +1,133 @@
+'''
+integrity: hash frames and check them against cache metadata.
+
+Each frame cache stores a hex digest of every frame in its metadata
+  (sha1 for raw frames, sha1_filt for processed ones). Checking those
+  one row at a time with iterrows() is a serial Python loop over every
+  frame. frame_digests() hashes frames in a pool of threads instead
+  (hashlib releases the GIL while hashing large buffers), and
+  verify_frames() compares all the digests to the metadata column at
+  once and reports every mismatching row, not just the first.
+
+The metadata columns hold SHA-1 digests, which is the default here.
+  Any other hashlib algorithm (e.g. 'blake2b') can be requested with
+  digest=..., and 'xxh3_128' / 'xxh64' if the optional xxhash package
+  is installed; these are faster, but their digests are of course only
+  comparable with digests made by the same algorithm.
+'''
+
+import hashlib
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_DIGEST = 'sha1'
+
+# number of frames each thread hashes at a time
+CHUNK_FRAMES = 64
+
+class IntegrityError(ValueError):
+    '''
+    Raised when frames don't match their recorded digests.
+    Attributes: rows, int array of the mismatching row numbers.
+    '''
+    def __init__(self, msg, rows):
+        super(IntegrityError, self).__init__(msg)
+        self.rows = rows
+
+def _hasher(digest):
+    '''
+    Return a function mapping a buffer to its hex digest.
+    '''
+    if digest.startswith('xxh'):
+        if xxhash is None:
+            raise ValueError("Digest {} needs the xxhash package".format(digest))
+        fn = getattr(xxhash, digest)
+        return lambda buf: fn(buf).hexdigest()
+    hashlib.new(digest) # raises ValueError for unknown algorithms
+    return lambda buf: hashlib.new(digest, buf).hexdigest()
+
+def frame_digest(frame, digest=DEFAULT_DIGEST):
+    '''
+    Return the hex digest of one frame's data in C order; for SHA-1
+      this is sha1(frame.ravel()).hexdigest().
+    '''
+    return _hasher(digest)(np.ascontiguousarray(frame).data)
+
+def _threads(threads):
+    if threads is None:
+        return min(32, os.cpu_count() or 1)
+    return max(1, threads)
+
+def frame_digests(frames, digest=DEFAULT_DIGEST, threads=None, rows=None):
+    '''
+    Hash many frames in parallel threads.
+    Inputs: frames, array (or memory-mapped array) whose first axis
+        indexes frames;
+      digest, hash algorithm name;
+      threads, number of threads (default: one per CPU, at most 32);
+      rows, optional row numbers to hash (default all).
+    Outputs: array of hex digest strings, one per row hashed.
+    '''
+    hasher = _hasher(digest)
+    if rows is None:
+        rows = np.arange(frames.shape[0])
+    rows = np.asarray(rows, dtype=np.intp)
+
+    def run(chunk):
+        return [hasher(np.ascontiguousarray(frames[r]).data) for r in chunk]
+
+    chunks = [rows[i:i + CHUNK_FRAMES] for i in range(0, len(rows), CHUNK_FRAMES)]
+    out = []
+    nthreads = _threads(threads)
+    if nthreads == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            out.extend(run(chunk))
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            for hexes in pool.map(run, chunks):
+                out.extend(hexes)
+    return np.array(out, dtype=str)
+
+def mismatched_rows(frames, expected, digest=DEFAULT_DIGEST, threads=None, rows=None):
+    '''
+    Return row numbers (int array) where the digest of frames doesn't
+      equal expected; expected has one digest per row checked.
+    '''
+    if rows is None:
+        rows = np.arange(frames.shape[0])
+    rows = np.asarray(rows, dtype=np.intp)
+    expected = np.asarray(expected, dtype=str)
+    if len(expected) != len(rows):
+        raise ValueError("{} digests for {} frames".format(len(expected), len(rows)))
+    got = frame_digests(frames, digest=digest, threads=threads, rows=rows)
+    return rows[got != expected]
+
+def verify_frames(frames, md, column='sha1', digest=DEFAULT_DIGEST, threads=None, rows=None):
+    '''
+    Check frames against a digest column of their metadata DataFrame;
+      md row i (by position) describes frames[i].
+    Inputs: column, metadata column of hex digests (e.g. sha1_filt);
+      rows, optional row numbers to check (default all).
+    Raises ValueError if metadata and frames differ in length, and
+      IntegrityError listing every mismatching row otherwise.
+    '''
+    if len(md) != frames.shape[0]:
+        raise ValueError("{} metadata rows for {} frames".format(len(md), frames.shape[0]))
+    expected = np.asarray(md[column].values, dtype=str)
+    if rows is not None:
+        expected = expected[np.asarray(rows, dtype=np.intp)]
+    bad = mismatched_rows(frames, expected, digest=digest, threads=threads, rows=rows)
+    if len(bad) > 0:
+        shown = ", ".join(str(r) for r in bad[:20])
+        if len(bad) > 20:
+            shown += ", ..."
+        raise IntegrityError("{} of {} frames don't match {}: rows {}".format(
+            len(bad), len(expected), column, shown), bad)
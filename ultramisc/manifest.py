@@ -0,0 +1,240 @@
+'''
+manifest: record and check the integrity of frame caches between stages.
+
+Every stage of the pipeline (process-cache, the PCA/LDA scripts) used
+  to re-hash the frames it had just loaded. A manifest stored next to
+  a cache (frames_proc -> frames_proc_manifest.json) records, for each
+  of the cache's files, its size, modification time, a digest of every
+  chunk and a digest of the whole file (the digest of its chunk
+  digests, so that chunks can be hashed in parallel), plus the stages
+  that have verified the cache and how.
+
+verify_cache() then checks a cache in one of three modes:
+
+  full    hash every chunk of every file and every frame against its
+            metadata digest column
+  sample  hash a random sample of chunks and frames
+  trust   skip hashing entirely if the cache has been verified before
+            and none of its files' sizes or modification times have
+            changed since; otherwise fall back to a full check
+
+A cache without a manifest always gets a full check, after which its
+  manifest is written; repeated runs on an unchanged, verified cache
+  then cost a few stat() calls. Scripts that (re)write a cache remove
+  its manifest first (remove_manifest()). A cache whose files have
+  changed since its manifest was written anyway (e.g. rewritten by an
+  older script) gets a full check of its frames against the metadata
+  digests in any mode; if they match, the cache was rebuilt
+  consistently and the manifest is written anew.
+'''
+
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ultramisc.framestore import STORE_EXT
+from ultramisc.integrity import DEFAULT_DIGEST, IntegrityError, _hasher, _threads, verify_frames
+from ultramisc.metadata import metadata_path
+
+MANIFEST_VERSION = 1
+
+# size of the chunks each cache file is hashed in
+CHUNK_BYTES = 16 * 1024 * 1024
+
+MODES = ['full', 'sample', 'trust']
+
+def manifest_path(dirpath, stem):
+    '''
+    Return the manifest file name for the cache called stem in dirpath.
+    '''
+    return os.path.join(dirpath, stem + "_manifest.json")
+
+def cache_files(dirpath, stem):
+    '''
+    Return the files making up the cache called stem in dirpath: the
+      container stem.ucache if present, else stem.npy and its metadata.
+    '''
+    container = os.path.join(dirpath, stem + STORE_EXT)
+    if os.path.exists(container):
+        return [container]
+    return [os.path.join(dirpath, stem + ".npy"), metadata_path(dirpath, stem)]
+
+def _chunk_digests(path, size, digest, threads, chunks=None):
+    '''
+    Hash the given chunk numbers of path (default all) in threads.
+    '''
+    hasher = _hasher(digest)
+    nchunks = max(1, -(-size // CHUNK_BYTES))
+    if chunks is None:
+        chunks = range(nchunks)
+
+    def run(i):
+        with open(path, 'rb') as fh:
+            fh.seek(i * CHUNK_BYTES)
+            return hasher(fh.read(CHUNK_BYTES))
+
+    chunks = list(chunks)
+    nthreads = _threads(threads)
+    if nthreads == 1 or len(chunks) <= 1:
+        return [run(i) for i in chunks]
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        return list(pool.map(run, chunks))
+
+def _file_entry(path, digest, threads):
+    st = os.stat(path)
+    chunks = _chunk_digests(path, st.st_size, digest, threads)
+    return {
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'chunks': chunks,
+        'digest': _hasher(digest)("".join(chunks).encode('ascii')),
+    }
+
+def read_manifest(dirpath, stem):
+    '''
+    Return the manifest dict of a cache, or None if there is no usable
+      manifest.
+    '''
+    try:
+        with open(manifest_path(dirpath, stem), 'r') as fh:
+            man = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if man.get('version') != MANIFEST_VERSION:
+        return None
+    return man
+
+def _save(dirpath, stem, man):
+    mp = manifest_path(dirpath, stem)
+    tmp = mp + ".tmp"
+    with open(tmp, 'w') as fh:
+        json.dump(man, fh, indent=1, sort_keys=True)
+    os.replace(tmp, mp)
+
+def write_manifest(dirpath, stem, stage, mode='full', digest=DEFAULT_DIGEST, threads=None):
+    '''
+    Hash the files of a cache and write its manifest, recording stage
+      as having verified it (use when a stage has just written the
+      cache and computed its frame digests itself).
+    Returns the manifest dict.
+    '''
+    files = {}
+    for path in cache_files(dirpath, stem):
+        files[os.path.basename(path)] = _file_entry(path, digest, threads)
+    man = {
+        'version': MANIFEST_VERSION,
+        'digest': digest,
+        'chunk_bytes': CHUNK_BYTES,
+        'files': files,
+        'verified': {stage: {'mode': mode, 'time': time.time()}},
+    }
+    _save(dirpath, stem, man)
+    return man
+
+def remove_manifest(dirpath, stem):
+    '''
+    Remove the manifest of the cache called stem in dirpath, if any;
+      call before rewriting the cache.
+    '''
+    try:
+        os.remove(manifest_path(dirpath, stem))
+    except FileNotFoundError:
+        pass
+
+def _unchanged(dirpath, stem, man):
+    '''
+    True if the cache's files are those in the manifest, each with its
+      recorded size and mtime.
+    '''
+    if set(man['files']) != set(os.path.basename(p) for p in cache_files(dirpath, stem)):
+        return False
+    for name,entry in man['files'].items():
+        try:
+            st = os.stat(os.path.join(dirpath, name))
+        except OSError:
+            return False
+        if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+            return False
+    return True
+
+def _check_files(dirpath, stem, man, threads, sample, rng):
+    '''
+    Re-hash all (sample=None) or a sample of chunks of each file and
+      compare with the manifest; raise IntegrityError on mismatch.
+    '''
+    if set(man['files']) != set(os.path.basename(p) for p in cache_files(dirpath, stem)):
+        raise IntegrityError("Files of cache {} don't match its manifest".format(stem), np.array([], dtype=np.intp))
+    if man['chunk_bytes'] != CHUNK_BYTES:
+        raise IntegrityError("Manifest of {} uses another chunk size".format(stem), np.array([], dtype=np.intp))
+    for name,entry in man['files'].items():
+        path = os.path.join(dirpath, name)
+        size = os.stat(path).st_size
+        if size != entry['size']:
+            raise IntegrityError("{} has changed size".format(name), np.array([], dtype=np.intp))
+        nchunks = len(entry['chunks'])
+        if sample is None or sample >= nchunks:
+            chunks = np.arange(nchunks)
+        else:
+            chunks = np.sort(rng.choice(nchunks, size=sample, replace=False))
+        got = _chunk_digests(path, size, man['digest'], threads, chunks=chunks)
+        bad = chunks[np.asarray(got) != np.asarray(entry['chunks'])[chunks]]
+        if len(bad) > 0:
+            raise IntegrityError("{} chunk(s) of {} don't match its manifest: {}".format(
+                len(bad), name, bad.tolist()), bad)
+
+def verify_cache(dirpath, stem, frames, md, column, stage, mode='trust',
+                 sample=64, threads=None, seed=None):
+    '''
+    Check a loaded cache against its manifest and its metadata digests,
+      and record stage as having verified it.
+    Inputs: dirpath, stem: location and name of the cache
+        (e.g. subject directory, "frames_proc");
+      frames, md: the cache's frames and metadata DataFrame;
+      column, metadata column holding frame digests (sha1, sha1_filt);
+      stage, name of the verifying stage (e.g. script name);
+      mode, one of 'full', 'sample', 'trust' (see above);
+      sample, number of chunks per file and of frames to check in
+        'sample' mode; seed, random seed for the sample.
+    Outputs: the mode actually used ('trust' falls back to 'full', as
+      does any mode when the cache has no manifest or its files have
+      changed since).
+    Raises ValueError if frames and metadata don't line up, and
+      IntegrityError if any digest doesn't match.
+    '''
+    if mode not in MODES:
+        raise ValueError("Unknown verification mode {}".format(mode))
+    if len(md) != frames.shape[0]:
+        raise ValueError("{} metadata rows for {} frames".format(len(md), frames.shape[0]))
+    man = read_manifest(dirpath, stem)
+    if man is not None and not _unchanged(dirpath, stem, man):
+        # rewritten since the manifest was: check every frame against
+        # the metadata, and record the new files if they match
+        man = None
+
+    if man is None:
+        mode = 'full'
+    elif mode == 'trust':
+        if len(man['verified']) > 0:
+            man['verified'][stage] = {'mode': 'trust', 'time': time.time()}
+            _save(dirpath, stem, man)
+            return 'trust'
+        mode = 'full'
+
+    rng = np.random.RandomState(seed)
+    if mode == 'sample' and sample < frames.shape[0]:
+        rows = np.sort(rng.choice(frames.shape[0], size=sample, replace=False))
+    else:
+        rows = None
+    verify_frames(frames, md, column=column, threads=threads, rows=rows)
+
+    if man is None:
+        write_manifest(dirpath, stem, stage, mode=mode, threads=threads)
+        return mode
+    _check_files(dirpath, stem, man, threads, sample if mode == 'sample' else None, rng)
+    man['verified'][stage] = {'mode': mode, 'time': time.time()}
+    _save(dirpath, stem, man)
+    return mode
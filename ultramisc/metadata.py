@@ -0,0 +1,394 @@
+'''
+metadata: typed, columnar frame metadata.
+
+The cache scripts used to collect one OrderedDict per frame, turn the
+  list into a DataFrame with from_records() and pickle it; downstream
+  scripts then picked out the descriptive columns by position
+  (md.iloc[:,0:11]). MetadataBuilder instead fills preallocated,
+  typed columns as frames are found: numbers in NumPy arrays, strings
+  such as phone, stim, pron, before and after as integer codes into a
+  table of categories, and frame hashes as fixed-width bytes.
+
+Metadata is written as a columnar .npz file next to the cache
+  (frames.npy -> frames_metadata.npz) and read back as a DataFrame
+  with pandas Categoricals for the string columns. load_metadata()
+  reads either that or an older frames_metadata.pickle, and
+  descriptive() selects the non-hash columns by name.
+'''
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+METADATA_VERSION = 1
+
+# metadata columns holding per-frame hex digests
+HASH_COLUMNS = ["sha1", "sha1_filt"]
+
+# columns describing the hashes rather than the tokens
+BOOKKEEPING_COLUMNS = HASH_COLUMNS + ["sha1_dtype"]
+
+KINDS = ['category', 'int', 'float', 'hash']
+
+class Schema(object):
+    '''
+    Ordered, typed list of metadata columns.
+    Inputs: columns, list of (name, kind) pairs; kind is one of
+      'category' (strings stored as codes), 'int', 'float' or 'hash'.
+    '''
+    def __init__(self, columns):
+        for name,kind in columns:
+            if kind not in KINDS:
+                raise ValueError("Unknown kind {} for column {}".format(kind, name))
+        self.columns = list(columns)
+        self.names = [name for name,_ in columns]
+        self._kinds = dict(columns)
+
+    def __contains__(self, name):
+        return name in self._kinds
+
+    def kind(self, name):
+        return self._kinds[name]
+
+    def index(self, name):
+        return self.names.index(name)
+
+    @property
+    def descriptive(self):
+        '''
+        Names of the columns describing tokens (all but hash columns).
+        '''
+        return [n for n in self.names if n not in BOOKKEEPING_COLUMNS]
+
+# schemas of the caches written by the cache-frames scripts
+SUZHOU_SCHEMA = Schema([
+    ('timestamp', 'category'),
+    ('time', 'float'),
+    ('pulseidx', 'int'),
+    ('rawdataidx', 'int'),
+    ('width', 'int'),
+    ('height', 'int'),
+    ('phone', 'category'),
+    ('stim', 'category'),
+    ('pron', 'category'),
+    ('before', 'category'),
+    ('after', 'category'),
+    ('sha1', 'hash'),
+    ('sha1_dtype', 'category'),
+])
+
+NASALCODA_SCHEMA = Schema([
+    ('speaker', 'category'),
+    ('timestamp', 'category'),
+    ('time', 'float'),
+    ('pulseidx', 'int'),
+    ('width', 'int'),
+    ('height', 'int'),
+    ('phone', 'category'),
+    ('sup', 'category'),
+    ('stim', 'category'),
+    ('before', 'category'),
+    ('after', 'category'),
+    ('sha1', 'hash'),
+    ('sha1_dtype', 'category'),
+])
+
+class MetadataBuilder(object):
+    '''
+    Append-only builder for typed frame metadata.
+    Inputs: schema, a Schema; capacity, initial number of rows to
+      allocate (columns double in size as needed).
+    Usage:
+      md = MetadataBuilder(SUZHOU_SCHEMA)
+      md.append(timestamp=acq, time=t, phone=phone, ...)
+      md.write("frames_metadata.npz")
+    '''
+    def __init__(self, schema, capacity=1024):
+        self.schema = schema
+        self.count = 0
+        self._capacity = max(1, capacity)
+        self._arrays = {}
+        self._categories = {}
+        for name,kind in schema.columns:
+            if kind == 'category':
+                self._arrays[name] = np.empty(self._capacity, dtype=np.int32)
+                self._categories[name] = {}
+            elif kind == 'int':
+                self._arrays[name] = np.empty(self._capacity, dtype=np.int64)
+            elif kind == 'float':
+                self._arrays[name] = np.empty(self._capacity, dtype=np.float64)
+            else:
+                self._arrays[name] = np.empty(self._capacity, dtype='S40')
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, needed):
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        for name,arr in self._arrays.items():
+            new = np.empty(capacity, dtype=arr.dtype)
+            new[:self.count] = arr[:self.count]
+            self._arrays[name] = new
+        self._capacity = capacity
+
+    def _code(self, name, value):
+        cats = self._categories[name]
+        value = "" if value is None else str(value)
+        code = cats.get(value)
+        if code is None:
+            code = cats[value] = len(cats)
+        return code
+
+    def append(self, row=None, **values):
+        '''
+        Add one row, given as a mapping and/or keyword arguments; every
+          column of the schema must be given. Returns the row index.
+        '''
+        if row is not None:
+            values = dict(row, **values)
+        missing = [n for n in self.schema.names if n not in values]
+        extra = [n for n in values if n not in self.schema]
+        if missing or extra:
+            raise ValueError("Row doesn't match schema (missing {}, unknown {})".format(
+                missing, extra))
+        if self.count == self._capacity:
+            self._grow(self.count + 1)
+        i = self.count
+        for name,kind in self.schema.columns:
+            value = values[name]
+            if kind == 'category':
+                self._arrays[name][i] = self._code(name, value)
+            elif kind == 'hash':
+                value = value.encode('ascii') if isinstance(value, str) else value
+                arr = self._arrays[name]
+                if len(value) > arr.dtype.itemsize:
+                    self._arrays[name] = arr.astype('S{}'.format(len(value)))
+                self._arrays[name][i] = value
+            else:
+                self._arrays[name][i] = value
+        self.count += 1
+        return i
+
+    def extend(self, rows):
+        '''
+        Add rows from an iterable of mappings, or whole columns at once
+          from another builder or a DataFrame with the schema's columns.
+        '''
+        if isinstance(rows, MetadataBuilder):
+            self._extend_columns(len(rows), rows.column)
+        elif isinstance(rows, pd.DataFrame):
+            self._extend_columns(len(rows), lambda name: np.asarray(rows[name].values))
+        else:
+            for row in rows:
+                self.append(row)
+
+    def _extend_columns(self, n, column):
+        '''
+        Append n rows whose values column(name) returns for each column.
+        '''
+        if n == 0:
+            return
+        if self.count + n > self._capacity:
+            self._grow(self.count + n)
+        start, stop = self.count, self.count + n
+        for name,kind in self.schema.columns:
+            values = column(name)
+            if len(values) != n:
+                raise ValueError("Column {} has {} rows, not {}".format(name, len(values), n))
+            if kind == 'category':
+                strs = np.array(["" if v is None else str(v) for v in values], dtype=object)
+                uniq, inverse = np.unique(strs, return_inverse=True)
+                lookup = np.array([self._code(name, u) for u in uniq], dtype=np.int32)
+                self._arrays[name][start:stop] = lookup[inverse]
+            elif kind == 'hash':
+                values = np.asarray(values, dtype=bytes)
+                if values.dtype.itemsize > self._arrays[name].dtype.itemsize:
+                    self._arrays[name] = self._arrays[name].astype(values.dtype)
+                self._arrays[name][start:stop] = values
+            else:
+                self._arrays[name][start:stop] = values
+        self.count = stop
+
+    def rows(self):
+        '''
+        Iterate over rows as dicts (slow; for merging and debugging).
+        '''
+        decoded = {name: self.column(name) for name in self.schema.names}
+        for i in range(self.count):
+            yield {name: decoded[name][i] for name in self.schema.names}
+
+    def categories(self, name):
+        '''
+        Return the category strings of a column, in code order.
+        '''
+        cats = self._categories[name]
+        out = [None] * len(cats)
+        for value,code in cats.items():
+            out[code] = value
+        return out
+
+    def codes(self, name):
+        '''
+        Return the integer codes of a category column (a view).
+        '''
+        return self._arrays[name][:self.count]
+
+    def column(self, name):
+        '''
+        Return the decoded values of one column as an array.
+        '''
+        kind = self.schema.kind(name)
+        arr = self._arrays[name][:self.count]
+        if kind == 'category':
+            return np.array(self.categories(name), dtype=object)[arr]
+        if kind == 'hash':
+            return np.char.decode(arr, 'ascii')
+        return arr.copy()
+
+    def to_frame(self):
+        '''
+        Return the metadata as a DataFrame, with Categorical columns for
+          strings.
+        '''
+        data = {}
+        for name,kind in self.schema.columns:
+            if kind == 'category':
+                data[name] = pd.Categorical.from_codes(self.codes(name), self.categories(name))
+            else:
+                data[name] = self.column(name)
+        return pd.DataFrame(data, columns=self.schema.names)
+
+    def encode(self):
+        '''
+        Return the columns in the encoded form used by write_metadata().
+        '''
+        out = []
+        for name,kind in self.schema.columns:
+            arr = self._arrays[name][:self.count]
+            if kind == 'category':
+                out.append({'name': name, 'kind': 'category', 'array': arr,
+                            'categories': self.categories(name)})
+            elif kind == 'hash':
+                out.append({'name': name, 'kind': 'hash', 'array': arr, 'categories': None})
+            else:
+                out.append({'name': name, 'kind': 'numeric', 'array': arr, 'categories': None})
+        return out
+
+    def write(self, path):
+        write_metadata(path, self)
+
+def encode_column(name, values):
+    '''
+    Return (kind, array, categories) for one DataFrame column: 'hash'
+      for the hash columns, 'numeric' for numbers and booleans, and
+      'category' (integer codes plus category list) for anything else.
+    '''
+    if isinstance(values, pd.Categorical) or str(getattr(values, 'dtype', '')) == 'category':
+        values = pd.Categorical(values)
+        if name not in HASH_COLUMNS:
+            cats = [str(c) for c in values.categories]
+            codes = np.asarray(values.codes, dtype=np.int32)
+            if (codes < 0).any():
+                cats.append("")
+                codes = np.where(codes < 0, len(cats) - 1, codes).astype(np.int32)
+            return 'category', codes, cats
+        values = np.asarray(values, dtype=object)
+    values = np.asarray(values)
+    if name in HASH_COLUMNS:
+        return 'hash', np.asarray(values, dtype=bytes), None
+    if values.dtype.kind in 'biuf':
+        return 'numeric', values, None
+    strs = np.array([str(v) for v in values], dtype=str)
+    categories, codes = np.unique(strs, return_inverse=True)
+    return 'category', codes.astype(np.int32), [str(c) for c in categories]
+
+def encode_metadata(md):
+    '''
+    Encode a metadata DataFrame (or MetadataBuilder) as an ordered list
+      of column dicts with name, kind, array and categories.
+    '''
+    if isinstance(md, MetadataBuilder):
+        return md.encode()
+    cols = []
+    for name in md.columns:
+        kind, arr, categories = encode_column(name, md[name].values)
+        cols.append({'name': str(name), 'kind': kind,
+                     'array': arr, 'categories': categories})
+    return cols
+
+def decode_column(col, rows=None):
+    '''
+    Return a DataFrame-ready column from an encoded column dict.
+    '''
+    arr = col['array'] if rows is None else col['array'][rows]
+    arr = np.asarray(arr)
+    if col['kind'] == 'category':
+        return pd.Categorical.from_codes(arr, col['categories'])
+    if col['kind'] == 'hash':
+        return np.char.decode(arr, 'ascii')
+    return arr
+
+def write_metadata(path, md):
+    '''
+    Write metadata (a DataFrame or MetadataBuilder) to a columnar .npz.
+    '''
+    columns = encode_metadata(md)
+    header = {'version': METADATA_VERSION,
+              'columns': [{'name': c['name'], 'kind': c['kind'],
+                           'categories': c['categories']} for c in columns]}
+    arrays = {'header': np.array(json.dumps(header))}
+    for i,c in enumerate(columns):
+        arrays['col{}'.format(i)] = c['array']
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp, path)
+
+def read_columns(path):
+    '''
+    Return the encoded columns (list of dicts) of a .npz metadata file.
+    '''
+    with np.load(path, allow_pickle=False) as npz:
+        header = json.loads(str(npz['header']))
+        if header.get('version') != METADATA_VERSION:
+            raise ValueError("Unsupported metadata version in {}".format(path))
+        columns = []
+        for i,c in enumerate(header['columns']):
+            columns.append(dict(c, array=npz['col{}'.format(i)]))
+    return columns
+
+def read_metadata(path):
+    '''
+    Read a metadata file, columnar (.npz) or pickled DataFrame.
+    '''
+    if path.endswith(".npz"):
+        columns = read_columns(path)
+        return pd.DataFrame({c['name']: decode_column(c) for c in columns},
+                            columns=[c['name'] for c in columns])
+    return pd.read_pickle(path)
+
+def metadata_path(dirpath, stem="frames"):
+    '''
+    Return the metadata file of the cache called stem in dirpath:
+      stem_metadata.npz if present, otherwise stem_metadata.pickle.
+    '''
+    columnar = os.path.join(dirpath, stem + "_metadata.npz")
+    if os.path.exists(columnar):
+        return columnar
+    return os.path.join(dirpath, stem + "_metadata.pickle")
+
+def load_metadata(dirpath, stem="frames"):
+    '''
+    Read the metadata of the cache called stem in dirpath.
+    '''
+    return read_metadata(metadata_path(dirpath, stem))
+
+def descriptive(md):
+    '''
+    Return md without its hash columns (sha1, sha1_filt, sha1_dtype).
+    '''
+    return md[[c for c in md.columns if c not in BOOKKEEPING_COLUMNS]].copy()
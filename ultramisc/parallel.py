@@ -0,0 +1,68 @@
+'''
+parallel: farm per-acquisition work out to a pool of processes.
+
+Extraction scripts spend most of their time on independent work per
+  acquisition (parsing TextGrids, looking up sync pulses, reading and
+  hashing frames). imap_ordered() runs a function over acquisitions in
+  worker processes and hands the results back in input order, so caches
+  built from them come out identical to a serial run.
+
+Functions passed to imap_ordered() must be defined at module level (they
+  are pickled by name), and scripts using it need an
+  if __name__ == "__main__": guard so that worker processes can import
+  them without re-running the script.
+'''
+
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+def cpu_jobs(jobs):
+    '''
+    Resolve a --jobs argument: 0 or a negative number means one job
+      per CPU, None means 1.
+    '''
+    if jobs is None:
+        return 1
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+def imap_ordered(func, items, jobs=1, backlog=2, initializer=None, initargs=()):
+    '''
+    Yield func(item) for each of items, in the order of items.
+    Inputs: func, a picklable (module-level) function;
+      items, an iterable of picklable arguments;
+      jobs, number of worker processes; with 1, func runs in this
+        process and nothing is pickled;
+      backlog, number of items queued per worker; results that finish
+        early are held until their turn, so at most jobs * backlog
+        results are in memory at once;
+      initializer, optional function called with initargs once in each
+        worker (or in this process, with 1 job) before any items, e.g.
+        to set up state shared by all items.
+    Exceptions raised by func are re-raised here, in order.
+    '''
+    jobs = cpu_jobs(jobs)
+    if jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield func(item)
+        return
+
+    items = iter(items)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer,
+                             initargs=initargs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= jobs * backlog:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(pool.submit(func, item))
+                break
+            yield result
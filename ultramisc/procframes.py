@@ -0,0 +1,449 @@
+'''
+procframes: process-cache's frame filtering, over frame ranges in
+  parallel worker processes.
+
+process-cache.py cleans every frame of a cache the same way: mask,
+  despeckle (ultramisc.srad), fan-convert (ultramisc.scanconv), clean
+  (imgphon's clean_frame) and rescale to uint8. A FramePipeline does
+  all of that, configured once per subject, a chunk of frames at a
+  time: the masked frames, the despeckling and the converted frames
+  all live in scratch arrays (float64 by default, see ultramisc.srad)
+  allocated on first use and reused for every chunk, and cleaned frames are rescaled in place and cast
+  straight into the caller's uint8 output.
+
+By default the whole masked frame is filtered. With crop, only the
+  bounding box of the region of interest is: frames are cropped to
+  the box before despeckling, the box is converted with a table
+  cropped to match (ScanTable.crop) into the bounding box of the fan
+  pixels it reaches, and only that box is cleaned and written; the
+  rest of each output frame is zero. The crop geometry is stored next
+  to the processed cache (write_crop()), so that PCA can be run on the
+  fan box only (read_crop(), crop_frames()). A cropped frame is still
+  scaled to [0, 1] from 0 to its maximum, as the masked frame would
+  be, but SRAD's speckle scale (q0) is taken over the crop rather than
+  the whole masked frame, so filtered pixels differ from those of an
+  uncropped run.
+
+Frames are independent, so process_frames() splits the stack into
+  ranges of frames and, with jobs > 1, hands the ranges to worker
+  processes (each with its own copy of the pipeline).
+
+No frames are pickled on the way. Workers read their input frames
+  from the cache's memory map if the stack is one (np.load(...,
+  mmap_mode='r')), otherwise from a copy in shared memory, and write
+  output frames straight into a shared memory block that becomes out
+  (or into out itself, if it is a memory map too, e.g. a
+  ultramisc.framecache.MappedFrameCache, so that no output is held in
+  memory); all they send back are the sha1 digests of their frames, which are
+  gathered in frame order. Each frame goes through exactly the same
+  operations whatever the number of jobs, so output and digests are
+  byte-identical to a serial run.
+
+With a ProcStore (ultramisc.procstore), frames filtered before with
+  the same pipeline settings are read back from the store rather than
+  filtered again, and newly filtered frames are added to it; only the
+  remaining frames are handed to the workers.
+
+A pipeline times its stages (mask, srad, convert, clean, hash, store)
+  with a StageTimer (ultramisc.timing); workers' times are merged into
+  it as their ranges come back.
+'''
+
+import functools
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ultramisc.integrity import frame_digest, frame_digests
+from ultramisc.parallel import cpu_jobs, imap_ordered
+from ultramisc.srad import DTYPE, LAMBDA, N_ITER, SCRATCH_ARRAYS, default_chunk, normalize, srad_inplace
+from ultramisc.timing import StageTimer
+
+# most frames per range handed to a worker at a time; smaller stacks
+# are split into about RANGES_PER_JOB ranges per worker
+RANGE_FRAMES = 64
+RANGES_PER_JOB = 4
+
+# suffix of the crop geometry file written next to a cache
+CROP_SUFFIX = "_crop.json"
+
+# version of the filtering, part of every ProcStore key; bump it with
+# any change that alters the frames a pipeline produces
+PIPELINE_VERSION = 3
+
+# per-worker state, set up by _init_worker()
+_worker = {}
+
+def roi_box(mask):
+    '''
+    Return the bounding box (top, bottom, left, right; bottom and right
+      exclusive) of the nonzero pixels of mask, or None if there is
+      nothing to crop (no mask, or no zero rows or columns around it).
+    '''
+    if mask is None:
+        return None
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    if not len(rows):
+        raise ValueError("Region of interest is empty")
+    box = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+    if box == (0, mask.shape[0], 0, mask.shape[1]):
+        return None
+    return box
+
+class FramePipeline(object):
+    '''
+    One subject's frame filtering: mask, despeckle, fan-convert, clean
+      and rescale to [0, 255].
+    Inputs: conv, ScanTable; mask, optional (H, W) array each frame is
+        multiplied by; crop, if True, crop frames to the mask's bounding
+        box (see roi_box()) and filter only that;
+      median_radius, passed to clean;
+      clean, function from a converted float frame to a frame scaled
+        to [0, 1] (default imgphon's clean_frame);
+      chunk, frames despeckled at once (default: see
+        ultramisc.srad.default_chunk()); n_iter, lbda, SRAD settings;
+      dtype, working precision (default ultramisc.srad.DTYPE);
+      timer, StageTimer the stages are timed with (default a new one).
+    '''
+    def __init__(self, conv, mask=None, median_radius=None, clean=None, chunk=None,
+                 n_iter=N_ITER, lbda=LAMBDA, timer=None, crop=False, dtype=DTYPE):
+        if clean is None:
+            from imgphon import ultrasound as us
+            clean = us.clean_frame
+        self.clean_name = "{}.{}".format(clean.__module__, clean.__qualname__)
+        self.median_radius = median_radius
+        if median_radius is not None:
+            clean = functools.partial(clean, median_radius=median_radius)
+        self.dtype = np.dtype(dtype)
+        if chunk is None:
+            chunk = default_chunk(conv.in_shape, self.dtype)
+        if chunk < 1:
+            raise ValueError("Chunk size must be at least 1")
+        self.conv = conv
+        self.mask = None if mask is None else np.asarray(mask)
+        self.box = roi_box(self.mask) if crop else None
+        self.fan_box = None
+        self.table = conv
+        if self.box is not None:
+            top, bottom, left, right = self.box
+            self.table, self.fan_box = conv.crop(self.box)
+            self.mask = self.mask[top:bottom, left:right]
+        if self.mask is not None and self.mask.all():
+            self.mask = None
+        self.clean = clean
+        self.chunk = chunk
+        self.n_iter = n_iter
+        self.lbda = lbda
+        self.timer = StageTimer() if timer is None else timer
+        self._scratch = None
+
+    def __getstate__(self):
+        # scratch arrays aren't sent to worker processes
+        state = dict(self.__dict__)
+        state['_scratch'] = None
+        return state
+
+    def geometry(self):
+        '''
+        Return the crop geometry as a dict (see write_crop()), or None
+          if frames aren't cropped.
+        '''
+        if self.box is None:
+            return None
+        return {'in_shape': list(self.conv.in_shape), 'out_shape': list(self.conv.out_shape),
+                'box': list(self.box), 'fan_box': list(self.fan_box)}
+
+    def params(self):
+        '''
+        Return a dict of everything that determines this pipeline's
+          output frames (conversion, mask, cleaning and SRAD settings,
+          code version), for ProcStore keys.
+        '''
+        table = self.conv.key
+        if table is None:
+            sha = hashlib.sha1(np.ascontiguousarray(self.conv.index).data)
+            sha.update(np.ascontiguousarray(self.conv.weights).data)
+            table = sha.hexdigest()
+        mask = None
+        if self.mask is not None:
+            mask = hashlib.sha1(np.ascontiguousarray(self.mask, dtype=np.float32).data).hexdigest()
+        package = sys.modules.get(self.clean_name.split('.')[0])
+        return {'version': PIPELINE_VERSION, 'table': table,
+                'in_shape': list(self.conv.in_shape), 'out_shape': list(self.conv.out_shape),
+                'box': None if self.box is None else list(self.box), 'mask': mask,
+                'clean': self.clean_name, 'clean_version': getattr(package, '__version__', None),
+                'median_radius': self.median_radius, 'n_iter': self.n_iter, 'lbda': self.lbda,
+                'dtype': self.dtype.str}
+
+    def region(self, out):
+        '''
+        Zero the part of out (N, out_h, out_w) this pipeline never
+          writes (outside the fan box); return the view it fills.
+        '''
+        if self.fan_box is None:
+            return out
+        top, bottom, left, right = self.fan_box
+        out[:, :top] = 0
+        out[:, bottom:] = 0
+        out[:, top:bottom, :left] = 0
+        out[:, top:bottom, right:] = 0
+        return out[:, top:bottom, left:right]
+
+    def scratch(self):
+        '''
+        Return this pipeline's scratch arrays (of dtype), allocating them
+          on first use: (masked frames, SRAD scratch, conversion scratch,
+          converted frames), each sized for one chunk (of cropped frames).
+        '''
+        if self._scratch is None:
+            shape = (self.chunk,) + self.table.in_shape
+            self._scratch = (np.empty(shape, dtype=self.dtype),
+                             [np.empty(shape, dtype=self.dtype) for _ in range(SCRATCH_ARRAYS)],
+                             self.table.scratch(self.chunk, self.dtype),
+                             np.empty((self.chunk,) + self.table.out_shape, dtype=self.dtype))
+        return self._scratch
+
+    def run(self, frames, out):
+        '''
+        Filter frames (N, H, W) into out (N, out_h, out_w), usually
+          uint8, a chunk at a time; return out.
+        '''
+        if out.shape != (frames.shape[0],) + self.conv.out_shape:
+            raise ValueError("Output of shape {} can't hold {} frames of shape {}".format(
+                out.shape, frames.shape[0], self.conv.out_shape))
+        img_buf, srad_buf, conv_buf, fan_buf = self.scratch()
+        dest = self.region(out)
+        for start in range(0, frames.shape[0], self.chunk):
+            block = frames[start:start + self.chunk]
+            if self.box is not None:
+                block = block[:, self.box[0]:self.box[1], self.box[2]:self.box[3]]
+            n = block.shape[0]
+            img = img_buf[:n]
+            with self.timer.stage('mask', n):
+                # a cropped frame had masked-out (zero) pixels around it
+                if self.mask is None:
+                    normalize(block, self.dtype, out=img, zero=self.box is not None)
+                else:
+                    np.multiply(block, self.mask, out=img, casting='unsafe')
+                    normalize(img, self.dtype, out=img, zero=self.box is not None)
+            with self.timer.stage('srad', n):
+                srad_inplace(img, self.n_iter, self.lbda, scratch=[s[:n] for s in srad_buf])
+            with self.timer.stage('convert', n):
+                fans = self.table.convert(img, out=fan_buf[:n], scratch=conv_buf)
+            with self.timer.stage('clean', n):
+                for offset,fan in enumerate(fans):
+                    clean = self.clean(fan)
+                    # rescale in place; copying to out casts to its dtype
+                    if clean.dtype.kind == 'f':
+                        clean *= 255
+                    else:
+                        clean = clean * 255
+                    np.copyto(dest[start + offset], clean, casting='unsafe')
+        return out
+
+def write_crop(dirpath, stem, geometry):
+    '''
+    Store the crop geometry of the cache called stem in dirpath (a dict
+      from FramePipeline.geometry(): frame shapes in_shape and
+      out_shape, raw-frame box and converted-frame fan_box, each [top,
+      bottom, left, right]); with None, remove any stored geometry.
+    '''
+    path = os.path.join(dirpath, stem + CROP_SUFFIX)
+    if geometry is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as out:
+        json.dump(geometry, out, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def read_crop(dirpath, stem):
+    '''
+    Return the crop geometry stored with the cache called stem in
+      dirpath, or None if its frames weren't cropped.
+    '''
+    path = os.path.join(dirpath, stem + CROP_SUFFIX)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+def crop_frames(frames, geometry):
+    '''
+    Return the view of frames (N, out_h, out_w) inside the fan box of
+      geometry (from read_crop()); frames themselves if it's None.
+    '''
+    if geometry is None:
+        return frames
+    if list(frames.shape[1:]) != geometry['out_shape']:
+        raise ValueError("Frames of shape {} don't match crop geometry for {}".format(
+            frames.shape[1:], tuple(geometry['out_shape'])))
+    top, bottom, left, right = geometry['fan_box']
+    return frames[:, top:bottom, left:right]
+
+def filter_range(frames, out, start, stop, pipeline):
+    '''
+    Filter frames[start:stop] into out[start:stop] with pipeline (a
+      FramePipeline).
+    Outputs: list of the sha1 hex digests of out[start:stop].
+    '''
+    pipeline.run(frames[start:stop], out[start:stop])
+    with pipeline.timer.stage('hash', stop - start):
+        return [frame_digest(out[idx]) for idx in range(start, stop)]
+
+def _mapped(arr):
+    '''
+    Return True if arr is a whole memory-mapped file.
+    '''
+    return isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap)
+
+def _describe(arr, blocks):
+    '''
+    Return a picklable description of arr for _attach(): its memory
+      map's file, or a shared memory copy (appended to blocks).
+    '''
+    if _mapped(arr):
+        return {'path': arr.filename, 'offset': arr.offset,
+                'shape': arr.shape, 'dtype': arr.dtype.str}
+    block = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    blocks.append(block)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+    return {'name': block.name, 'shape': arr.shape, 'dtype': arr.dtype.str}
+
+def _attach(spec, mode='r'):
+    '''
+    Open an array described by _describe(); return (array, shared
+      memory block or None).
+    '''
+    if 'path' in spec:
+        arr = np.memmap(spec['path'], dtype=spec['dtype'], mode=mode,
+                        offset=spec['offset'], shape=tuple(spec['shape']))
+        return arr, None
+    block = shared_memory.SharedMemory(name=spec['name'])
+    return np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=block.buf), block
+
+def _init_worker(frames_spec, out_spec, pipeline):
+    _worker['frames'], _worker['frames_block'] = _attach(frames_spec)
+    _worker['out'], _worker['out_block'] = _attach(out_spec, mode='r+')
+    _worker['pipeline'] = pipeline
+
+def _filter_span(span):
+    # each range is timed afresh; its totals are merged by the parent
+    pipeline = _worker['pipeline']
+    pipeline.timer = StageTimer()
+    digests = filter_range(_worker['frames'], _worker['out'], span[0], span[1], pipeline)
+    return digests, pipeline.timer.stages
+
+def _spans(rows, size):
+    '''
+    Split sorted row numbers into (start, stop) ranges of consecutive
+      rows, each at most size long.
+    '''
+    spans = []
+    for row in rows:
+        if spans and spans[-1][1] == row and row - spans[-1][0] < size:
+            spans[-1][1] = row + 1
+        else:
+            spans.append([row, row + 1])
+    return [tuple(span) for span in spans]
+
+def process_frames(frames, out, pipeline, jobs=1, progress=None, store=None,
+                   raw_digests=None):
+    '''
+    Filter every frame of frames into out with pipeline (a
+      FramePipeline), in jobs worker processes.
+    Inputs: progress, optional function called with (frames done, total
+        frames) after each range of frames;
+      store, optional ProcStore (ultramisc.procstore) to read frames
+        filtered before from, and to add newly filtered frames to;
+      raw_digests, optional sha1 hex digests of frames (e.g. their
+        verified metadata column), used for store keys instead of
+        hashing every frame.
+    Outputs: list of the sha1 hex digests of out's frames, in order.
+    '''
+    total = frames.shape[0]
+    if out.shape[0] != total:
+        raise ValueError("Output has {} frames, input {}".format(out.shape[0], total))
+    digests = [None] * total
+    todo = range(total)
+    if store is not None:
+        if raw_digests is None:
+            with pipeline.timer.stage('hash', total):
+                raw_digests = frame_digests(frames)
+        elif len(raw_digests) != total:
+            raise ValueError("{} digests given for {} frames".format(len(raw_digests), total))
+        keys = store.keys(raw_digests, pipeline.params())
+        dest = pipeline.region(out)
+        with pipeline.timer.stage('store', total):
+            todo = [idx for idx in range(total) if not store.get(keys[idx], dest[idx])]
+        with pipeline.timer.stage('hash', total - len(todo)):
+            for idx in sorted(set(range(total)) - set(todo)):
+                digests[idx] = frame_digest(out[idx])
+        if progress is not None and len(todo) < total:
+            progress(total - len(todo), total)
+    done = total - len(todo)
+    if not todo:
+        return digests
+
+    jobs = min(cpu_jobs(jobs), len(todo))
+    size = min(RANGE_FRAMES, max(1, -(-len(todo) // (jobs * RANGES_PER_JOB))))
+    spans = _spans(todo, size)
+
+    if jobs == 1:
+        for start,stop in spans:
+            digests[start:stop] = filter_range(frames, out, start, stop, pipeline)
+            done += stop - start
+            if progress is not None:
+                progress(done, total)
+    else:
+        _process_spans(frames, out, pipeline, jobs, spans, digests, progress, done)
+
+    if store is not None:
+        with pipeline.timer.stage('store', len(todo)):
+            for idx in todo:
+                store.put(keys[idx], dest[idx])
+            store.evict()
+    return digests
+
+def _process_spans(frames, out, pipeline, jobs, spans, digests, progress, done):
+    '''
+    Filter the frames in spans in jobs worker processes, for
+      process_frames().
+    '''
+    total = frames.shape[0]
+    blocks = []
+    shared_out = None
+    try:
+        frames_spec = _describe(frames, blocks)
+        if _mapped(out):
+            # workers write straight into the output's file
+            out.flush()
+            out_spec = _describe(out, blocks)
+        else:
+            out_block = shared_memory.SharedMemory(create=True, size=max(1, out.nbytes))
+            blocks.append(out_block)
+            out_spec = {'name': out_block.name, 'shape': out.shape, 'dtype': out.dtype.str}
+            shared_out = np.ndarray(out.shape, dtype=out.dtype, buffer=out_block.buf)
+        results = imap_ordered(_filter_span, spans, jobs=jobs, initializer=_init_worker,
+                               initargs=(frames_spec, out_spec, pipeline))
+        for (start,stop),(result,stages) in zip(spans, results):
+            digests[start:stop] = result
+            pipeline.timer.merge(stages)
+            if shared_out is not None:
+                out[start:stop] = shared_out[start:stop]
+            done += stop - start
+            if progress is not None:
+                progress(done, total)
+    finally:
+        shared_out = None
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,186 @@
+'''
+procstore: content-addressed store of processed frames.
+
+Rerunning process-cache.py after changing only the RoI or the median
+  radius, or on a cache that shares frames with one processed before,
+  filtered every frame again. A ProcStore keeps each processed frame
+  under a key made from the sha1 of the raw frame and the settings of
+  the pipeline that filtered it (FramePipeline.params(): conversion
+  table, mask, cleaning and SRAD settings, code version), so that
+  process_frames() (ultramisc.procframes) only filters frames whose
+  key isn't in the store yet. Changing any setting changes every key;
+  frames filtered with the old settings are simply never asked for
+  again and age out of the store.
+
+The scripts only keep a store when given one (--store DIR), as it
+  can grow to max_bytes. It is a directory (in the library, by default
+  procframes in the directory of cached conversion tables, see
+  ultramisc.scanconv.cache_dir()) with one .npy file per frame, in
+  subdirectories named after the first two characters of the key. Only
+  the part of a frame a pipeline fills (the fan box of a cropped
+  pipeline) is stored. A file's modification time is its last use:
+  reading a frame touches it, and evict() removes the least recently
+  used frames until the store fits in max_bytes (with room to spare,
+  see EVICT_FRACTION). The store's size is measured once per ProcStore
+  and then estimated from the frames put since, so evict() only scans
+  the store when it may be over the bound.
+  Files are written to a temporary name and renamed, so several runs
+  can share a store; a frame evicted or damaged under a reader is just
+  a miss.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from ultramisc.scanconv import cache_dir
+
+# name of the store in the cache directory
+STORE_DIRNAME = "procframes"
+
+# default size bound
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# fraction of the bound evict() trims a full store to, leaving room for
+# frames put before it needs scanning again
+EVICT_FRACTION = 0.9
+
+FRAME_EXT = ".npy"
+
+def params_key(params):
+    '''
+    Return the hex digest of a dict of pipeline settings.
+    '''
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ProcStore(object):
+    '''
+    Processed frames by key, bounded in size by least recently used
+      eviction.
+    Inputs: root, store directory (default: see module docs);
+      max_bytes, size the store is trimmed to by evict().
+    Attributes: hits, misses, counts of get() calls found and not found.
+    '''
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        if root is None:
+            root = os.path.join(cache_dir(), STORE_DIRNAME)
+        if max_bytes < 0:
+            raise ValueError("Store size bound must not be negative")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes stored, measured by the last scan plus frames put since
+        self._size = None
+
+    def __repr__(self):
+        return "ProcStore({!r}, max_bytes={})".format(self.root, self.max_bytes)
+
+    def keys(self, raw_digests, params):
+        '''
+        Return the keys of frames with sha1 hex digests raw_digests,
+          processed with settings params (a dict, see
+          FramePipeline.params()).
+        '''
+        pkey = params_key(params)
+        return [hashlib.sha1((raw + pkey).encode('ascii')).hexdigest() for raw in raw_digests]
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + FRAME_EXT)
+
+    def get(self, key, out):
+        '''
+        Read the frame stored under key into out and mark it used;
+          return False, leaving out alone, if there is none (of out's
+          shape and dtype).
+        '''
+        path = self.path(key)
+        try:
+            frame = np.load(path)
+        except FileNotFoundError:
+            frame = None
+        except (OSError, ValueError):
+            # damaged (e.g. truncated by a full disk)
+            self._remove(path)
+            frame = None
+        if frame is None or frame.shape != out.shape or frame.dtype != out.dtype:
+            self.misses += 1
+            return False
+        out[...] = frame
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return True
+
+    def put(self, key, frame):
+        '''
+        Store frame under key.
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as fh:
+            np.save(fh, np.ascontiguousarray(frame))
+            size = fh.tell()
+        os.replace(tmp, path)
+        if self._size is not None:
+            self._size += size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        '''
+        Return (last use, size, path) of every stored frame.
+        '''
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(FRAME_EXT):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        '''
+        Return the total size of the stored frames in bytes.
+        '''
+        self._size = sum(size for _,size,_ in self._entries())
+        return self._size
+
+    def evict(self, max_bytes=None):
+        '''
+        Remove the least recently used frames until the store holds at
+          most max_bytes (default self.max_bytes), or if it held more,
+          EVICT_FRACTION of it; return the number of frames removed.
+          The store is only scanned if its estimated
+          size is over max_bytes (or not known yet); frames other runs
+          added to a shared store are counted at the next scan.
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if self._size is not None and self._size <= max_bytes:
+            return 0
+        entries = self._entries()
+        total = sum(size for _,size,_ in entries)
+        target = max_bytes if total <= max_bytes else int(max_bytes * EVICT_FRACTION)
+        removed = 0
+        for _,size,path in sorted(entries):
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        self._size = total
+        return removed
@@ -0,0 +1,103 @@
+'''
+rawframes: memory-mapped access to headerless EchoB .raw files.
+
+A legacy EchoB .raw file is a flat sequence of 8-bit frames with no
+  header; each frame is stored scan line by scan line (nscanlines
+  lines of npoints samples). RawFrames maps the whole file once and
+  exposes it as a (frames, npoints, nscanlines) array, the same
+  orientation returned by ultratils' RawReader.get_frame(), without
+  reading anything until frames are actually indexed.
+'''
+
+import numpy as np
+
+from ultramisc.ebutils import read_echob_metadata
+
+class RawFrames(object):
+    '''
+    Zero-copy reader for a headerless EchoB .raw file.
+    Inputs: rawfile, path to the .raw file;
+      nscanlines, npoints, junk: frame geometry; any left as None are
+        read from the .img.txt file using read_echob_metadata();
+      flop, if True horizontally mirror frames (probe used backwards).
+    Attributes:
+      data, the untrimmed (frames, npoints, nscanlines) uint8 view;
+      frames, the same view with junk rows trimmed and flop applied;
+      nframes, number of complete frames in the file.
+    '''
+    def __init__(self, rawfile, nscanlines=None, npoints=None, junk=None, flop=False):
+        if nscanlines is None or npoints is None or junk is None:
+            md_nscanlines, md_npoints, md_junk = read_echob_metadata(rawfile)
+            nscanlines = md_nscanlines if nscanlines is None else nscanlines
+            npoints = md_npoints if npoints is None else npoints
+            junk = md_junk if junk is None else junk
+        self.rawfile = rawfile
+        self.nscanlines = nscanlines
+        self.npoints = npoints
+        self.junk = junk
+        self.flop = flop
+
+        framesize = nscanlines * npoints
+        flat = np.memmap(rawfile, dtype=np.uint8, mode='r')
+        self.nframes = flat.shape[0] // framesize
+        # ignore any trailing partial frame left by an interrupted acquisition
+        ondisk = flat[:self.nframes * framesize].reshape(
+            [self.nframes, nscanlines, npoints])
+        self.data = ondisk.transpose(0, 2, 1)
+        frames = self.data[:, junk:, :]
+        if flop:
+            frames = frames[:, :, ::-1]
+        self.frames = frames
+
+    def __len__(self):
+        return self.nframes
+
+    @property
+    def frame_shape(self):
+        '''
+        Shape of a single trimmed frame, (npoints - junk, nscanlines).
+        '''
+        return self.frames.shape[1:]
+
+    def has_frames(self, idxs):
+        '''
+        Return boolean array, True where idxs refer to recorded frames.
+        '''
+        idxs = np.asarray(idxs)
+        return (idxs >= 0) & (idxs < self.nframes)
+
+    def has_frame(self, idx):
+        return bool(self.has_frames(idx))
+
+    def get_frames(self, idxs):
+        '''
+        Gather trimmed (and flopped, if set) frames at idxs in a single
+          vectorized read.
+        Inputs: idxs, a sequence of frame indices (any order, repeats ok).
+        Outputs: C-contiguous (len(idxs), npoints - junk, nscanlines)
+          uint8 array.
+        Raises IndexError if any index is outside the recorded range;
+          check with has_frames() first to handle missing frames.
+        '''
+        idxs = np.asarray(idxs, dtype=np.intp)
+        bad = ~self.has_frames(idxs)
+        if bad.any():
+            raise IndexError("No frame(s) at {} in {} ({} frames)".format(
+                idxs[bad].tolist(), self.rawfile, self.nframes))
+        return np.ascontiguousarray(self.frames[idxs])
+
+    def get_frame(self, idx):
+        '''
+        Return a single trimmed frame as a view into the mapped file.
+        '''
+        if not self.has_frame(idx):
+            raise IndexError("No frame at {} in {} ({} frames)".format(
+                idx, self.rawfile, self.nframes))
+        return self.frames[idx]
+
+    def close(self):
+        '''
+        Drop references to the mapped file.
+        '''
+        self.data = None
+        self.frames = None
@@ -0,0 +1,85 @@
+'''
+roifile: saved region-of-interest bounds for the process-cache scripts.
+
+The process-cache scripts mask each subject's frames to a rectangular
+  region of interest, given as upper, lower, left and right bounds
+  (rows and columns of the trimmed raw frame, as for imgphon's roi()).
+  Once a subject's bounds are settled they are saved in the subject's
+  folder as subj<N>_roi.txt, a two-line tab-separated table:
+
+    upper	lower	left	right
+    600	200	20	50
+
+Bounds for many subjects can also be given in one RoI table: the same
+  columns plus a subject column holding either the subject number or
+  the subject's folder name, tab- or comma-separated. lookup_roi()
+  finds a subject's bounds in a table or saved file, so that the
+  scripts can run in batch without asking for them.
+'''
+
+import os
+
+import pandas as pd
+
+ROI_FIELDS = ('upper', 'lower', 'left', 'right')
+
+def roi_filename(subject):
+    '''
+    Return the name of the saved RoI file for subject.
+    '''
+    return "subj{}_roi.txt".format(subject)
+
+def _bounds(row, source):
+    try:
+        return {f: int(row[f]) for f in ROI_FIELDS}
+    except (KeyError, ValueError, TypeError):
+        raise ValueError("{} doesn't give integer RoI bounds {}".format(
+            source, ", ".join(ROI_FIELDS)))
+
+def read_roi(path):
+    '''
+    Read RoI bounds from a file written by write_roi(); return a dict.
+    '''
+    table = pd.read_csv(path, sep="\t")
+    if len(table) != 1:
+        raise ValueError("{} should hold one row of RoI bounds".format(path))
+    return _bounds(table.iloc[0], path)
+
+def write_roi(path, bounds):
+    '''
+    Save RoI bounds (a dict with keys ROI_FIELDS) to path.
+    '''
+    with open(path, "w") as out:
+        out.write('\t'.join(ROI_FIELDS) + '\n')
+        out.write('\t'.join([str(bounds[f]) for f in ROI_FIELDS]))
+
+def read_roi_table(path):
+    '''
+    Read a table of RoI bounds for many subjects.
+    Outputs: dict mapping each subject (as a string) to its bounds.
+    '''
+    table = pd.read_csv(path, sep=None, engine="python", dtype={'subject': str})
+    if 'subject' not in table.columns:
+        raise ValueError("RoI table {} has no subject column".format(path))
+    rois = {}
+    for _,row in table.iterrows():
+        subject = row['subject'].strip()
+        if subject in rois:
+            raise ValueError("RoI table {} lists subject {} twice".format(path, subject))
+        rois[subject] = _bounds(row, "{} (subject {})".format(path, subject))
+    return rois
+
+def lookup_roi(subject, subjdir, table=None):
+    '''
+    Return the RoI bounds of subject: its entry in table (from
+      read_roi_table(), under the subject or its folder name) if any,
+      otherwise its saved RoI file in subjdir; None if there is neither.
+    '''
+    if table is not None:
+        for key in (str(subject), os.path.basename(os.path.normpath(subjdir))):
+            if key in table:
+                return table[key]
+    path = os.path.join(subjdir, roi_filename(subject))
+    if os.path.exists(path):
+        return read_roi(path)
+    return None
@@ -0,0 +1,345 @@
+'''
+scanconv: fan (scan) conversion of whole frame stacks by lookup table.
+
+The scripts convert trimmed EchoB frames to fan shape with ultratils'
+  Converter, built from the C9-5/10 header and probe values below, one
+  frame at a time and wrapped in flips:
+
+    np.flipud(conv.convert(np.flipud(frame)))
+
+That conversion is linear: each output pixel is a fixed weighted sum
+  of a few neighbouring input pixels, the same for every frame of a
+  given geometry. A ScanTable holds those sums (for each output pixel
+  inside the fan, the flat indices of its input pixels and their
+  weights, with the flips already folded in), so a stack of any length
+  is converted with one gather per weight, and no flipping:
+
+    table = scan_table(frames.shape[1:])
+    fans = table.convert(frames)          # (N, H, W) -> (N, out_h, out_w)
+
+The table is not derived from a model of the probe but read off the
+  Converter itself (ScanTable.from_function): the converter is run on
+  a few dozen probe images (lattices of single pixels, plus images of
+  the row and column numbers locating each output pixel's source), and
+  the recovered table is checked against it on random frames. Its
+  output therefore matches the converter's up to float32 rounding of
+  the weights, whatever interpolation the converter uses, as long as
+  each output pixel draws on input pixels no more than a few apart.
+
+Building a table takes a few seconds, so scan_table() keeps the tables
+  it builds on disk (see cache_dir()), keyed by a hash of the geometry;
+  later runs with the same frame size and probe load them instead.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# bump when the table layout or construction changes, invalidating
+# tables cached on disk
+TABLE_VERSION = 1
+
+# header and probe values for the Ultrasonix C9-5/10 transducer
+C9_5_10 = {
+    'sf': 4000000,          # magic number, sorry!
+    'radius': 10000,        # based on '10' in transducer model number
+    'num_elements': 128,    # based on '128' in transducer model number
+    'pitch': 185,           # based on Ultrasonix C9-5/10 transducer
+}
+
+# spacing of the single-pixel lattices used to probe a converter: must
+# exceed twice the reach of its interpolation kernel (8 allows 4x4)
+LATTICE = 8
+
+# maximum absolute difference (relative to the input range) allowed
+# between a table and the converter it was read from
+TOLERANCE = 1e-4
+
+class ScanTable(object):
+    '''
+    Lookup table for a linear frame-to-fan conversion.
+    Attributes: in_shape, (H, W) of input frames; out_shape, (out_h,
+      out_w) of converted frames; pixels, (M,) flat output indices of
+      pixels inside the fan; index, weights, (M, K) flat input indices
+      and weights summed into each (padded with weight 0).
+    '''
+    def __init__(self, in_shape, out_shape, pixels, index, weights, key=None):
+        self.in_shape = tuple(int(n) for n in in_shape)
+        self.out_shape = tuple(int(n) for n in out_shape)
+        self.pixels = np.asarray(pixels, dtype=np.int64)
+        self.index = np.asarray(index, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.key = key
+        if self.index.shape != self.weights.shape or self.index.shape[0] != len(self.pixels):
+            raise ValueError("Table index, weights and pixels don't match")
+
+    def __repr__(self):
+        return "ScanTable({} -> {}, {} pixels x {} weights)".format(
+            self.in_shape, self.out_shape, len(self.pixels), self.index.shape[1])
+
+    def scratch(self, n, dtype=np.float32):
+        '''
+        Return scratch arrays for converting up to n frames at a time
+          with sums in dtype (see convert()).
+        '''
+        return tuple(np.empty((n, len(self.pixels)), dtype=dtype) for _ in range(2))
+
+    def convert(self, frames, out=None, dtype=None, scratch=None):
+        '''
+        Convert a frame (H, W) or stack of frames (N, H, W) to fan shape.
+        Inputs: out, optional array (of the output shape) to write into;
+          dtype, output type (default float32, or float64 for float64
+          frames). Sums are taken in float32 (float64 for float64
+          output) and rounded to the nearest integer for integer output;
+          scratch, optional arrays from scratch() to take the sums in,
+          so that converting many chunks allocates nothing per chunk.
+        Outputs: converted frame(s), zero outside the fan.
+        '''
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[np.newaxis]
+        if frames.shape[1:] != self.in_shape:
+            raise ValueError("Table converts frames of shape {}, got {}".format(
+                self.in_shape, frames.shape[1:]))
+        if dtype is None:
+            dtype = out.dtype if out is not None else np.result_type(frames.dtype, np.float32)
+        dtype = np.dtype(dtype)
+        work = np.float64 if dtype == np.float64 else np.float32
+        n = frames.shape[0]
+        flat = frames.reshape(n, -1)
+        if scratch is None:
+            scratch = self.scratch(n, work)
+        acc, term = (s[:n] for s in scratch)
+
+        # one gather per weight, summed in place
+        _take(flat, self.index[:, 0], acc)
+        acc *= self.weights[:, 0]
+        for k in range(1, self.index.shape[1]):
+            _take(flat, self.index[:, k], term)
+            term *= self.weights[:, k]
+            acc += term
+        if dtype.kind in 'iu':
+            np.rint(acc, out=acc)
+
+        # write straight into out if it can hold the sums as they are
+        direct = out is not None and out.dtype == dtype and out.flags.c_contiguous
+        fans = out if direct else np.empty((n,) + self.out_shape, dtype=dtype)
+        flat_fans = fans.reshape(n, -1)
+        flat_fans.fill(0)
+        flat_fans[:, self.pixels] = acc
+        if out is not None and not direct:
+            out[...] = fans[0] if single else fans
+            return out
+        if single and not direct:
+            return fans[0]
+        return fans
+
+    def crop(self, box):
+        '''
+        Restrict the table to input frames cropped to box (top, bottom,
+          left, right; bottom and right exclusive), as if the pixels
+          outside it were zero.
+        Outputs: (table, fan_box): the table converting cropped frames to
+          the bounding box of the output pixels they reach, and that box
+          (top, bottom, left, right) within the full output.
+        '''
+        top, bottom, left, right = box
+        rows, cols = np.divmod(self.index, self.in_shape[1])
+        inside = (rows >= top) & (rows < bottom) & (cols >= left) & (cols < right) \
+            & (self.weights != 0)
+        keep = inside.any(axis=1)
+        if not keep.any():
+            raise ValueError("Crop {} is outside the fan".format(box))
+        index = np.where(inside, (rows - top) * (right - left) + (cols - left), 0)[keep]
+        weights = np.where(inside, self.weights, 0)[keep]
+
+        out_rows, out_cols = np.divmod(self.pixels[keep], self.out_shape[1])
+        fan_box = (int(out_rows.min()), int(out_rows.max()) + 1,
+                   int(out_cols.min()), int(out_cols.max()) + 1)
+        pixels = (out_rows - fan_box[0]) * (fan_box[3] - fan_box[2]) + (out_cols - fan_box[2])
+        table = ScanTable((bottom - top, right - left),
+                          (fan_box[1] - fan_box[0], fan_box[3] - fan_box[2]),
+                          pixels, index, weights)
+        return table, fan_box
+
+    def save(self, path):
+        '''
+        Write the table to an .npz file (atomically).
+        '''
+        header = {'version': TABLE_VERSION, 'in_shape': self.in_shape,
+                  'out_shape': self.out_shape, 'key': self.key}
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, header=np.array(json.dumps(header)), pixels=self.pixels,
+                     index=self.index, weights=self.weights)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a table written by save().
+        '''
+        with np.load(path) as npz:
+            header = json.loads(str(npz['header']))
+            if header['version'] != TABLE_VERSION:
+                raise ValueError("{} has table version {}, expected {}".format(
+                    path, header['version'], TABLE_VERSION))
+            return cls(header['in_shape'], header['out_shape'], npz['pixels'],
+                       npz['index'], npz['weights'], key=header['key'])
+
+    @classmethod
+    def from_function(cls, func, in_shape, lattice=LATTICE, check=3, key=None):
+        '''
+        Read the table of a linear conversion off the conversion itself.
+        Inputs: func, function from an (H, W) float64 frame to a 2D
+          array; in_shape, (H, W); lattice, probe spacing (see LATTICE);
+          check, number of random frames to compare the table and func on.
+        Outputs: ScanTable. Raises ValueError if func turns out not to
+          be a (local) linear map.
+        '''
+        h, w = in_shape
+        rows, cols = np.mgrid[0:h, 0:w].astype(np.float64)
+        total = np.asarray(func(np.ones((h, w))), dtype=np.float64)
+        out_shape = total.shape
+
+        # each output pixel's source location: the weighted mean row and
+        # column of the input pixels it draws on
+        inside = total != 0
+        src_row = np.zeros(out_shape)
+        src_col = np.zeros(out_shape)
+        src_row[inside] = np.asarray(func(rows), dtype=np.float64)[inside] / total[inside]
+        src_col[inside] = np.asarray(func(cols), dtype=np.float64)[inside] / total[inside]
+
+        # lattice probe (a, b) lights every input pixel (a + lattice*i,
+        # b + lattice*j); each output pixel it reaches draws on exactly
+        # one of those, the one nearest its source location
+        pix, src, wts = [], [], []
+        for a in range(lattice):
+            for b in range(lattice):
+                probe = np.zeros((h, w))
+                probe[a::lattice, b::lattice] = 1
+                resp = np.asarray(func(probe), dtype=np.float64)
+                hit = np.flatnonzero(resp)
+                if not len(hit):
+                    continue
+                if not inside.flat[hit].all():
+                    raise ValueError("Conversion isn't local: output pixels with zero \
+total weight respond to probe ({}, {})".format(a, b))
+                i = a + lattice * np.round((src_row.flat[hit] - a) / lattice).astype(np.int64)
+                j = b + lattice * np.round((src_col.flat[hit] - b) / lattice).astype(np.int64)
+                np.clip(i, a, a + lattice * ((h - 1 - a) // lattice), out=i)
+                np.clip(j, b, b + lattice * ((w - 1 - b) // lattice), out=j)
+                pix.append(hit)
+                src.append(i * w + j)
+                wts.append(resp.flat[hit])
+        if not pix:
+            raise ValueError("Conversion output is empty")
+        pix, src, wts = (np.concatenate(x) for x in (pix, src, wts))
+
+        # pad each output pixel's weights out to the same count
+        order = np.lexsort((src, pix))
+        pix, src, wts = pix[order], src[order], wts[order]
+        pixels, first, counts = np.unique(pix, return_index=True, return_counts=True)
+        rank = np.arange(len(pix)) - np.repeat(first, counts)
+        index = np.zeros((len(pixels), counts.max()), dtype=np.int64)
+        weights = np.zeros((len(pixels), counts.max()), dtype=np.float32)
+        slot = np.repeat(np.arange(len(pixels)), counts)
+        index[slot, rank] = src
+        weights[slot, rank] = wts
+
+        table = cls(in_shape, out_shape, pixels, index, weights, key=key)
+        rng = np.random.RandomState(0)
+        for _ in range(check):
+            frame = rng.random_sample((h, w))
+            want = np.asarray(func(frame), dtype=np.float64)
+            err = np.abs(table.convert(frame, dtype=np.float64) - want).max()
+            if err > TOLERANCE:
+                raise ValueError("Table differs from conversion by up to {:.3g}; \
+conversion isn't linear or reaches further than {} pixels".format(err, lattice // 2))
+        return table
+
+def _take(flat, index, out):
+    '''
+    Gather columns index of flat into out (of any float type).
+    '''
+    if flat.dtype == out.dtype:
+        np.take(flat, index, axis=1, out=out)
+    else:
+        out[...] = np.take(flat, index, axis=1)
+
+def cache_dir():
+    '''
+    Directory for cached tables: $ULTRAMISC_CACHE, else ultramisc in
+      $XDG_CACHE_HOME (default ~/.cache).
+    '''
+    if os.environ.get('ULTRAMISC_CACHE'):
+        return os.environ['ULTRAMISC_CACHE']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ultramisc")
+
+def geometry_key(in_shape, probe=C9_5_10, flip=True):
+    '''
+    Hex digest identifying a conversion: frame shape, probe values,
+      flips and table version.
+    '''
+    geometry = dict(probe, in_shape=[int(n) for n in in_shape], flip=bool(flip),
+                    version=TABLE_VERSION)
+    return hashlib.sha1(json.dumps(geometry, sort_keys=True).encode('utf-8')).hexdigest()
+
+def ultratils_converter(in_shape, probe=C9_5_10, flip=True):
+    '''
+    Build ultratils' Converter for frames of in_shape (H, W) and return
+      its conversion as a function of one frame, flipped (as the
+      scripts did) if flip.
+    '''
+    from ultratils.pysonix.scanconvert import Converter
+
+    class Header(object):
+        pass
+    class Probe(object):
+        pass
+    header = Header()
+    header.w = in_shape[1]      # input image width
+    header.h = in_shape[0]      # input image height, trimmed
+    header.sf = probe['sf']
+    prb = Probe()
+    prb.radius = probe['radius']
+    prb.numElements = probe['num_elements']
+    prb.pitch = probe['pitch']
+    conv = Converter(header, prb)
+
+    if flip:
+        return lambda frame: np.flipud(conv.convert(np.flipud(frame)))
+    return conv.convert
+
+def scan_table(in_shape, probe=C9_5_10, flip=True, cachedir=None):
+    '''
+    Return the ScanTable converting frames of in_shape (H, W) to fan
+      shape for probe: loaded from cachedir (default cache_dir()) if
+      built before, otherwise built from ultratils' Converter and saved.
+    With flip (the default), the table gives what the scripts have
+      always computed, np.flipud(conv.convert(np.flipud(frame))).
+    '''
+    key = geometry_key(in_shape, probe, flip)
+    if cachedir is None:
+        cachedir = cache_dir()
+    path = os.path.join(cachedir, "scanconv-{}.npz".format(key[:16]))
+    if os.path.exists(path):
+        try:
+            table = ScanTable.load(path)
+            if table.key == key:
+                return table
+        except (OSError, ValueError, KeyError):
+            pass
+
+    table = ScanTable.from_function(ultratils_converter(in_shape, probe, flip),
+                                    in_shape, key=key)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        table.save(path)
+    except OSError as e:
+        print("\tCouldn't cache scan conversion table in {}: {}".format(cachedir, e))
+    return table
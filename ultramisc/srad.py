@@ -0,0 +1,246 @@
+'''
+srad: speckle reducing anisotropic diffusion on whole frame stacks.
+
+The process-cache scripts despeckle each frame with imgphon's srad(),
+  one frame at a time: 300 iterations of a dozen full-frame array
+  operations, in float64, inside a Python loop over frames. That loop
+  is most of the cost of processing a cache.
+
+srad_stack() runs the same filter (Yu & Acton's discretization, with
+  the speckle scale taken from the whole frame, as in imgphon) on an
+  (N, H, W) stack at once: every operation broadcasts over all the
+  frames of a chunk and writes into scratch arrays that are allocated
+  once per chunk rather than once per operation.
+
+srad_frame() is the plain per-frame float64 version, kept as the
+  reference the stack version is checked against (and which
+  tests/test_srad.py checks against imgphon's srad() itself). The
+  stack version works in float64 by default (DTYPE), in which it gives
+  bit-identical results. float32 (dtype=np.float32) is about twice as
+  fast but not equivalent: 300 iterations amplify its rounding, so
+  results differ by up to about 0.03 (some 5% of the output range on
+  noise-like frames), enough to change most pixels once rescaled to
+  uint8.
+
+The filter is limited by memory bandwidth, so chunks are best kept
+  small enough for their scratch arrays to stay in cache; by default
+  srad_chunks() sizes them to do so (one full frame, or a handful of
+  ROI crops, at a time).
+'''
+
+import numpy as np
+
+# default filter settings, as in imgphon.ultrasound.srad
+N_ITER = 300
+LAMBDA = 0.05
+
+# default working precision of the stack version (see above)
+DTYPE = np.float64
+
+# guards against division by zero
+EPS = 1e-7
+
+# target size of each scratch array when choosing a chunk size
+SCRATCH_BYTES = 256 * 1024
+
+# number of scratch arrays srad_inplace() works in
+SCRATCH_ARRAYS = 7
+
+def normalize(stack, dtype, out=None, zero=False):
+    '''
+    Scale each frame of stack (N, H, W) to [0, 1], in a new array of
+      dtype or in out; with zero, the range scaled from always includes
+      0, as it would if the frames had any zero (e.g. masked) pixels.
+    '''
+    if out is None:
+        out = stack.astype(dtype)
+    else:
+        np.copyto(out, stack, casting='unsafe')
+    lo = out.min(axis=(1, 2), keepdims=True)
+    hi = out.max(axis=(1, 2), keepdims=True)
+    if zero:
+        np.minimum(lo, 0, out=lo)
+        np.maximum(hi, 0, out=hi)
+    span = hi - lo
+    span[span == 0] = 1
+    out -= lo
+    out /= span
+    return out
+
+def srad_frame(frame, n_iter=N_ITER, lbda=LAMBDA):
+    '''
+    Despeckle one frame (H, W) with SRAD, in float64.
+    Inputs: n_iter, number of diffusion iterations; lbda, step size.
+    Outputs: filtered, log-compressed float64 frame.
+    '''
+    img = normalize(np.asarray(frame)[np.newaxis], np.float64)[0]
+    M, N = img.shape
+
+    # neighbour indices, replicating the edges
+    iN = np.concatenate(([0], np.arange(0, M - 1)))
+    iS = np.concatenate((np.arange(1, M), [M - 1]))
+    jW = np.concatenate(([0], np.arange(0, N - 1)))
+    jE = np.concatenate((np.arange(1, N), [N - 1]))
+
+    # log uncompress (also removes zeros)
+    img = np.exp(img)
+
+    for _ in range(n_iter):
+        # speckle scale
+        q0_squared = (np.std(img) / np.mean(img)) ** 2
+
+        dN = img[iN, :] - img
+        dS = img[iS, :] - img
+        dW = img[:, jW] - img
+        dE = img[:, jE] - img
+
+        # normalized gradient magnitude and laplacian
+        G2 = (dN**2 + dS**2 + dW**2 + dE**2) / (img**2 + EPS)
+        L = (dN + dS + dW + dE) / (img + EPS)
+
+        # instantaneous coefficient of variation
+        num = (0.5 * G2) - ((1.0 / 16) * (L**2))
+        den = (1 + (0.25 * L)) ** 2
+        q_squared = num / (den + EPS)
+
+        # diffusion coefficient
+        den = (q_squared - q0_squared) / (q0_squared * (1 + q0_squared))
+        c = 1.0 / (1 + den)
+        cS = c[iS, :]
+        cE = c[:, jE]
+
+        # divergence and update
+        D = (cS * dS) + (c * dN) + (cE * dE) + (c * dW)
+        img = img + (lbda / 4.0) * D
+
+    return np.log(img)
+
+def srad_stack(frames, n_iter=N_ITER, lbda=LAMBDA, dtype=DTYPE):
+    '''
+    Despeckle a stack of frames with SRAD, all frames at once.
+    Inputs: frames, (N, H, W) array (or a single (H, W) frame);
+      n_iter, number of diffusion iterations; lbda, step size;
+      dtype, working precision.
+    Outputs: filtered, log-compressed stack of the same shape, in dtype.
+    Memory use is about ten times that of frames in dtype; see
+      srad_chunks() for filtering a large stack in bounded memory.
+    '''
+    frames = np.asarray(frames)
+    if frames.ndim == 2:
+        return srad_stack(frames[np.newaxis], n_iter, lbda, dtype)[0]
+    if frames.ndim != 3:
+        raise ValueError("Expected an (N, H, W) stack, got shape {}".format(frames.shape))
+    return srad_inplace(normalize(frames, dtype), n_iter, lbda)
+
+def srad_inplace(img, n_iter=N_ITER, lbda=LAMBDA, scratch=None):
+    '''
+    Despeckle a stack of frames already scaled to [0, 1] in place; the
+      working precision is that of img.
+    Inputs: img, (N, H, W) float array, overwritten with the filtered,
+        log-compressed stack; n_iter, lbda, as for srad_stack();
+      scratch, optional SCRATCH_ARRAYS arrays of img's shape and dtype
+        to work in (allocated here otherwise), so that a caller
+        filtering many chunks can allocate them once.
+    Outputs: img.
+    '''
+    dtype = img.dtype.type
+    np.exp(img, out=img)
+
+    # scratch arrays, reused by every iteration
+    if scratch is None:
+        scratch = [np.empty_like(img) for _ in range(SCRATCH_ARRAYS)]
+    dN, dS, dW, dE, c, a, b = scratch
+    quarter, half, sixteenth = dtype(0.25), dtype(0.5), dtype(1.0 / 16)
+    eps, step = dtype(EPS), dtype(lbda / 4.0)
+
+    for _ in range(n_iter):
+        # speckle scale of each frame, shape (N, 1, 1); reduced frame
+        # by frame, as the summation order of axis reductions differs
+        q0_squared = np.array([(f.std() / f.mean()) ** 2 for f in img],
+                              dtype=dtype)[:, np.newaxis, np.newaxis]
+
+        # differences to the four neighbours (zero across the edges)
+        dN[:, 0, :] = 0
+        np.subtract(img[:, :-1, :], img[:, 1:, :], out=dN[:, 1:, :])
+        dS[:, -1, :] = 0
+        np.negative(dN[:, 1:, :], out=dS[:, :-1, :])
+        dW[:, :, 0] = 0
+        np.subtract(img[:, :, :-1], img[:, :, 1:], out=dW[:, :, 1:])
+        dE[:, :, -1] = 0
+        np.negative(dW[:, :, 1:], out=dE[:, :, :-1])
+
+        # a: normalized gradient magnitude G2
+        np.square(dN, out=a)
+        for d in (dS, dW, dE):
+            np.square(d, out=b)
+            a += b
+        np.square(img, out=b)
+        b += eps
+        a /= b
+        # b: normalized laplacian L
+        np.add(dN, dS, out=b)
+        b += dW
+        b += dE
+        np.add(img, eps, out=c)
+        b /= c
+
+        # a: q_squared = (G2/2 - L^2/16) / ((1 + L/4)^2 + eps)
+        a *= half
+        np.square(b, out=c)
+        c *= sixteenth
+        a -= c
+        b *= quarter
+        b += 1
+        np.square(b, out=b)
+        b += eps
+        a /= b
+
+        # c: diffusion coefficient
+        a -= q0_squared
+        a /= q0_squared * (1 + q0_squared)
+        a += 1
+        np.reciprocal(a, out=c)
+
+        # a: divergence, summed in the same order as srad_frame()
+        # (cS*dS + c*dN + cE*dE + c*dW); dS and dE are scaled in place
+        dS[:, :-1, :] *= c[:, 1:, :]
+        dS[:, -1, :] *= c[:, -1, :]
+        np.multiply(c, dN, out=a)
+        a += dS
+        dE[:, :, :-1] *= c[:, :, 1:]
+        dE[:, :, -1] *= c[:, :, -1]
+        a += dE
+        np.multiply(c, dW, out=b)
+        a += b
+
+        a *= step
+        img += a
+
+    np.log(img, out=img)
+    return img
+
+def default_chunk(frame_shape, dtype=DTYPE):
+    '''
+    Return the number of frames of frame_shape to filter at once.
+    '''
+    frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+    return max(1, SCRATCH_BYTES // max(1, frame_bytes))
+
+def srad_chunks(frames, chunk=None, mask=None, n_iter=N_ITER, lbda=LAMBDA, dtype=DTYPE):
+    '''
+    Despeckle a stack chunk frames at a time with srad_stack(),
+      yielding (start, filtered chunk) pairs, so that memory use is
+      bounded by the chunk size rather than the size of the stack.
+    Inputs: frames, (N, H, W) array or memmap;
+      chunk, frames per chunk (default: see default_chunk());
+      mask, optional (H, W) array each frame is multiplied by first.
+    '''
+    if chunk is None:
+        chunk = default_chunk(frames.shape[1:], dtype)
+    if chunk < 1:
+        raise ValueError("Chunk size must be at least 1")
+    for start in range(0, frames.shape[0], chunk):
+        block = frames[start:start + chunk]
+        if mask is not None:
+            block = block * mask
+        yield start, srad_stack(block, n_iter, lbda, dtype)
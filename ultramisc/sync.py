@@ -0,0 +1,146 @@
+'''
+sync: map audio timepoints to ultrasound frame indices.
+
+Each acquisition's sync pulses (.sync.TextGrid tiers such as pulse_idx
+  and raw_data_idx, or the first column of .sync.txt) give the time of
+  every ultrasound frame. A SyncIndex loads these times once per
+  acquisition into a sorted array and answers "which frame is nearest
+  to time t" for whole arrays of timepoints with np.searchsorted,
+  instead of scanning every frame for every target.
+
+Frame indices returned are positions in the sync tier, which is how
+  the extraction scripts index frames in the .raw file.
+'''
+
+import numpy as np
+
+from ultramisc.tiers import Tier, load_tiers
+
+# labels marking pulses with no ultrasound data (dropped frames)
+NA_LABELS = ["NA", "na", "", None]
+
+class SyncIndex(object):
+    '''
+    Sorted frame times for one acquisition.
+    Inputs: times, sequence of frame times in seconds, one per frame;
+      labels, optional sequence of frame labels of the same length;
+        frames labelled with one of NA_LABELS are marked as dropped.
+    Attributes: times, float64 array; na, boolean array, True for
+      dropped frames.
+    '''
+    def __init__(self, times, labels=None):
+        times = np.asarray(times, dtype=np.float64)
+        if times.ndim != 1 or len(times) == 0:
+            raise ValueError("SyncIndex needs a non-empty 1D sequence of times")
+        if np.any(np.diff(times) < 0):
+            raise ValueError("Sync times are not in ascending order")
+        self.times = times
+        if labels is None:
+            self.na = np.zeros(len(times), dtype=bool)
+        else:
+            if len(labels) != len(times):
+                raise ValueError("Got {} labels for {} sync times".format(
+                    len(labels), len(times)))
+            self.na = np.array([l in NA_LABELS for l in labels], dtype=bool)
+        self._valid_idx = np.flatnonzero(~self.na)
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_tier(cls, tier, anchor='t1'):
+        '''
+        Build from a compiled Tier or an audiolabel tier (any iterable
+          of labels with t1, t2, center and text attributes).
+        Inputs: anchor, the label attribute giving each frame's time;
+          the extraction scripts use 't1', the video scripts 'center'.
+        '''
+        if isinstance(tier, Tier):
+            return cls(getattr(tier, anchor), tier.text)
+        times = []
+        labels = []
+        for lab in tier:
+            times.append(getattr(lab, anchor))
+            labels.append(lab.text)
+        return cls(times, labels)
+
+    @classmethod
+    def from_synctxt(cls, sync_txt):
+        '''
+        Build from the first (time) column of a .sync.txt file;
+          header lines are ignored.
+        '''
+        times = []
+        with open(sync_txt, 'r') as s:
+            for line in s:
+                try:
+                    times.append(float(line.strip().split("\t")[0]))
+                except ValueError:
+                    pass # ignore line if a header is present
+        return cls(times)
+
+    def nearest(self, timepoints, skip_na=False):
+        '''
+        Return index of the frame nearest to each timepoint. Ties go to
+          the earlier frame.
+        Inputs: timepoints, a scalar or array of times in seconds;
+          skip_na, if True only consider frames not marked as dropped.
+        Outputs: an int (scalar input) or int array of frame indices.
+        '''
+        scalar = np.ndim(timepoints) == 0
+        t = np.atleast_1d(np.asarray(timepoints, dtype=np.float64))
+        if skip_na:
+            if len(self._valid_idx) == 0:
+                raise ValueError("All sync frames are marked NA")
+            times = self.times[self._valid_idx]
+        else:
+            times = self.times
+
+        right = np.searchsorted(times, t, side='left')
+        right = np.clip(right, 0, len(times) - 1)
+        left = np.clip(right - 1, 0, len(times) - 1)
+        use_left = np.abs(t - times[left]) <= np.abs(times[right] - t)
+        idx = np.where(use_left, left, right)
+
+        if skip_na:
+            idx = self._valid_idx[idx]
+        if scalar:
+            return int(idx[0])
+        return idx
+
+    def frame_range(self, t1, t2, skip_na=False):
+        '''
+        Return (start, end) indices of the frames nearest to t1 and t2,
+          inclusive. Accepts scalars or arrays of interval bounds.
+        '''
+        return self.nearest(t1, skip_na=skip_na), self.nearest(t2, skip_na=skip_na)
+
+    def is_na(self, idxs):
+        '''
+        Return boolean (array), True where idxs refer to dropped frames.
+        '''
+        return self.na[idxs]
+
+    @property
+    def start(self):
+        '''
+        Time of first frame (start of the recording window).
+        '''
+        return self.times[0]
+
+    @property
+    def end(self):
+        '''
+        Time of last frame (end of the recording window).
+        '''
+        return self.times[-1]
+
+def load_sync_tiers(sync_tg, tiers=('pulse_idx', 'raw_data_idx'), anchor='t1'):
+    '''
+    Read a .sync.TextGrid once (through its compiled sidecar, see
+      ultramisc.tiers) and return a dict of SyncIndex objects, one for
+      each of the requested tiers.
+    '''
+    compiled = load_tiers(sync_tg, tiers=tiers)
+    return {name: SyncIndex.from_tier(compiled[name], anchor=anchor)
+            for name in tiers}
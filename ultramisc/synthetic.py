@@ -0,0 +1,308 @@
+'''
+synthetic: generate synthetic EchoB experiment directories.
+
+Benchmarking or testing the cache, process and PCA/LDA stages needs
+  an experiment directory, and participant data can't be shipped
+  around. make_experiment() writes one with the same layout and file
+  formats as a real one: a folder per subject holding one folder per
+  acquisition, each with
+
+  <ts>.raw            headerless 8-bit frames, scan line by scan line
+  <ts>.img.txt        frame geometry, as read by read_echob_metadata()
+  stim.txt            the stimulus word
+  <ts>.sync.txt       frame times, pulse and raw data indices
+  <ts>.sync.TextGrid  point tiers pulse_idx and raw_data_idx
+  <ts>.ch1.TextGrid   word and phone tiers of a carrier phrase
+
+The frames are speckle noise with a bright band standing in for the
+  tongue surface, whose depth follows the phone being "said", so PCA
+  and LDA have something to separate. Labels follow one of two styles:
+  'suzhou' (word/phone tiers, ARPAbet phones, the Suzhou target words)
+  or 'nasalcoda' (words/phones tiers, MFA Mandarin phones, words ending
+  in a nasal; words.txt and segments.txt are written for the cache
+  script). Compiled tier sidecars (see ultramisc.tiers) are written
+  too by default, so the TextGrids can be used without audiolabel.
+
+Everything is generated from seed, and every file gets the same
+  modification time (FILE_MTIME; the sidecars record their TextGrid's),
+  so the same arguments always give byte-identical directories.
+'''
+
+import os
+import zlib
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ultramisc.tiers import Tier, write_sidecar
+
+# word label -> phones, and (before, after) carrier words, for each style
+STYLES = {
+    'suzhou': {
+        'word_tier': 'word',
+        'phone_tier': 'phone',
+        'words': [
+            ('IZ', ['IY1']), ('BIZX', ['B', 'IY1']), ('SIZ', ['S', 'IY1']),
+            ('XIZ', ['SH', 'IY1']), ('IY', ['IY1']), ('BIY', ['B', 'IY1']),
+            ('SIY', ['S', 'IY1']), ('XIY', ['SH', 'IY1']), ('YZ', ['IY1']),
+            ('XYZ', ['SH', 'IY1']), ('EU', ['IH1']), ('XEU', ['SH', 'IH1']),
+            ('SZ', ['S', 'IH1']), ('SZW', ['S', 'IH1']), ('SEI', ['S', 'EY1']),
+            ('FUW', ['F', 'UW1']),
+        ],
+        'carriers': (('KAH', ['K', 'AH0']), ('TAH', ['T', 'AH0'])),
+    },
+    'nasalcoda': {
+        'word_tier': 'words',
+        'phone_tier': 'phones',
+        'words': [
+            ('fan', ['f', 'a1', 'n']), ('fang', ['f', 'a1', 'ng']),
+            ('ban', ['b', 'a4', 'n']), ('bang', ['b', 'a4', 'ng']),
+            ('sen', ['s', 'e1', 'n']), ('sheng', ['sh', 'e1', 'ng']),
+            ('lin', ['l', 'i2', 'n']), ('ling', ['l', 'i2', 'ng']),
+        ],
+        'carriers': (('shuo', ['sh', 'uo1']), None),
+        'segments': ['a1', 'a4', 'e1', 'i2', 'n', 'ng'],
+    },
+}
+
+# default frame geometry (nscanlines, npoints, junk) and frame rate
+GEOMETRY = (127, 1020, 36)
+FRAME_RATE = 60.0
+
+# number of frames generated at a time
+CHUNK_FRAMES = 32
+
+# modification time of every generated file (2015-01-01 00:00 UTC)
+FILE_MTIME = 1420070400
+
+def _phone_depth(phone, lo, hi):
+    '''
+    Deterministic tongue depth (sample index in lo..hi) for a phone.
+    '''
+    return lo + zlib.crc32(phone.encode('utf-8')) % max(1, hi - lo)
+
+def _textgrid_tier(name, xmin, xmax, items, points=False):
+    '''
+    Return the long-format TextGrid lines of one tier; items are
+      (t1, t2, text) intervals, or (t, text) points if points is set.
+    '''
+    def q(text):
+        return '"' + text.replace('"', '""') + '"'
+    lines = [
+        '        class = "{}" '.format("TextTier" if points else "IntervalTier"),
+        '        name = {} '.format(q(name)),
+        '        xmin = {!r} '.format(xmin),
+        '        xmax = {!r} '.format(xmax),
+        '        {}: size = {} '.format("points" if points else "intervals", len(items)),
+    ]
+    for i,item in enumerate(items):
+        if points:
+            t, text = item
+            lines.append('        points [{}]:'.format(i + 1))
+            lines.append('            number = {!r} '.format(t))
+            lines.append('            mark = {} '.format(q(text)))
+        else:
+            t1, t2, text = item
+            lines.append('        intervals [{}]:'.format(i + 1))
+            lines.append('            xmin = {!r} '.format(t1))
+            lines.append('            xmax = {!r} '.format(t2))
+            lines.append('            text = {} '.format(q(text)))
+    return lines
+
+def write_textgrid(path, xmin, xmax, tiers):
+    '''
+    Write a Praat TextGrid (long text format).
+    Inputs: xmin, xmax: time domain; tiers, list of (name, items,
+      points) with items as in _textgrid_tier().
+    '''
+    lines = [
+        'File type = "ooTextFile"',
+        'Object class = "TextGrid"',
+        '',
+        'xmin = {!r} '.format(xmin),
+        'xmax = {!r} '.format(xmax),
+        'tiers? <exists> ',
+        'size = {} '.format(len(tiers)),
+        'item []: ',
+    ]
+    for i,(name, items, points) in enumerate(tiers):
+        lines.append('    item [{}]:'.format(i + 1))
+        lines.extend(_textgrid_tier(name, xmin, xmax, items, points))
+    with open(path, 'w') as fh:
+        fh.write("\n".join(lines) + "\n")
+
+def _compile(name, items, points=False):
+    '''
+    Build a compiled Tier from the same items given to write_textgrid().
+    '''
+    if points:
+        t1 = [t for t,_ in items]
+        t2 = [np.nan] * len(items)
+        text = [x for _,x in items]
+    else:
+        t1 = [t for t,_,_ in items]
+        t2 = [t for _,t,_ in items]
+        text = [x for _,_,x in items]
+    labels, codes = np.unique(np.array(text, dtype=str), return_inverse=True)
+    return Tier(name, t1, t2, codes, labels)
+
+def _utterance(style, word, phones, start, end):
+    '''
+    Lay out carrier phrase and target word between start and end.
+    Returns (word items, phone items), as (t1, t2, text) intervals.
+    '''
+    before, after = STYLES[style]['carriers']
+    chunks = [c for c in (before, (word, phones), after) if c is not None]
+    nphones = sum(len(p) for _,p in chunks)
+    step = (end - start) / nphones
+    words = []
+    phone_items = []
+    t = start
+    for w,ps in chunks:
+        w_start = t
+        for p in ps:
+            phone_items.append((t, t + step, p))
+            t += step
+        words.append((w_start, t, w))
+    return words, phone_items
+
+def _pad(items, xmin, xmax, label):
+    '''
+    Fill the gaps before the first and after the last interval.
+    '''
+    out = []
+    if items[0][0] > xmin:
+        out.append((xmin, items[0][0], label))
+    out.extend(items)
+    if items[-1][1] < xmax:
+        out.append((items[-1][1], xmax, label))
+    return out
+
+def write_frames(rawfile, nframes, geometry, depth, rng):
+    '''
+    Write nframes synthetic frames to a headerless .raw file.
+    Inputs: geometry, (nscanlines, npoints, junk); depth, float array of
+      the band's depth (sample index) at each frame; rng, RandomState.
+    '''
+    nscanlines, npoints, junk = geometry
+    # band is curved across the scan lines, deepest in the middle
+    bow = 0.1 * (npoints - junk) * np.sin(np.pi * np.arange(nscanlines) / nscanlines)
+    points = np.arange(npoints, dtype=np.float32)
+    with open(rawfile, 'wb') as fh:
+        for start in range(0, nframes, CHUNK_FRAMES):
+            stop = min(nframes, start + CHUNK_FRAMES)
+            frames = rng.randint(0, 64, size=(stop - start, nscanlines, npoints)).astype(np.uint8)
+            surface = (depth[start:stop, None] - bow[None, :]).astype(np.float32)
+            band = np.abs(points[None, None, :] - surface[:, :, None]) < 4
+            frames[band] += 160
+            frames.tofile(fh)
+
+def make_acquisition(parent, timestamp, word, phones, style='suzhou',
+                     nframes=120, geometry=GEOMETRY, fps=FRAME_RATE,
+                     sidecars=True, seed=0):
+    '''
+    Write one acquisition directory, parent/timestamp.
+    Inputs: word, phones: target word label and its phones; style, key
+      of STYLES; nframes, number of ultrasound frames; geometry,
+      (nscanlines, npoints, junk); fps, frame rate; sidecars, also
+      write compiled tier sidecars; seed, random seed.
+    Outputs: path of the acquisition directory.
+    '''
+    nscanlines, npoints, junk = geometry
+    st = STYLES[style]
+    rng = np.random.RandomState(seed)
+    acqdir = os.path.join(parent, timestamp)
+    os.makedirs(acqdir)
+    base = os.path.join(acqdir, timestamp)
+
+    # frames start shortly after the audio does, and the utterance
+    # sits in the middle of the recording window
+    t0 = 0.05
+    times = t0 + np.arange(nframes) / fps
+    xmax = float(times[-1] + 1.0 / fps + t0)
+    span = times[-1] - times[0]
+    words, phone_items = _utterance(style, word, phones,
+                                    float(times[0] + 0.15 * span), float(times[0] + 0.85 * span))
+
+    # band depth follows the phone at each frame, smoothed over ~50 ms
+    lo, hi = junk + (npoints - junk) // 4, junk + 3 * (npoints - junk) // 4
+    targets = np.full(nframes, (lo + hi) / 2.0)
+    for t1,t2,p in phone_items:
+        targets[(times >= t1) & (times < t2)] = _phone_depth(p, lo, hi)
+    width = max(1, int(0.05 * fps))
+    depth = np.convolve(np.pad(targets, width, mode='edge'),
+                        np.ones(2 * width + 1) / (2 * width + 1), mode='same')[width:-width]
+    write_frames(base + ".raw", nframes, geometry, depth, rng)
+
+    with open(base + ".img.txt", 'w') as fh:
+        fh.write("Height\tPitch\tWidth\n{}\t{}\t{}\n".format(nscanlines, npoints, npoints - junk))
+    with open(os.path.join(acqdir, "stim.txt"), 'w') as fh:
+        fh.write(word.lower() + "\n")
+
+    with open(base + ".sync.txt", 'w') as fh:
+        fh.write("seconds\tpulse_idx\traw_data_idx\n")
+        fh.writelines("{!r}\t{}\t{}\n".format(float(t), i, i) for i,t in enumerate(times))
+    pulses = [(float(t), str(i)) for i,t in enumerate(times)]
+    sync_tiers = [('pulse_idx', pulses, True), ('raw_data_idx', pulses, True)]
+    write_textgrid(base + ".sync.TextGrid", 0.0, xmax, sync_tiers)
+
+    label_tiers = [(st['word_tier'], _pad(words, 0.0, xmax, ""), False),
+                   (st['phone_tier'], _pad(phone_items, 0.0, xmax, "sp"), False)]
+    write_textgrid(base + ".ch1.TextGrid", 0.0, xmax, label_tiers)
+
+    # fixed modification times, as the sidecars record the TextGrids'
+    for name in os.listdir(acqdir):
+        os.utime(os.path.join(acqdir, name), (FILE_MTIME, FILE_MTIME))
+
+    if sidecars:
+        for tg,tiers in ((base + ".sync.TextGrid", sync_tiers),
+                         (base + ".ch1.TextGrid", label_tiers)):
+            write_sidecar(tg, {name: _compile(name, items, points)
+                               for name,items,points in tiers})
+    return acqdir
+
+def make_experiment(expdir, subjects=1, acqs=10, nframes=120, geometry=GEOMETRY,
+                    style='suzhou', fps=FRAME_RATE, sidecars=True, seed=0):
+    '''
+    Write a synthetic experiment directory.
+    Inputs: expdir, directory to create (must not exist yet);
+      subjects, number of subject folders (subj1, subj2, ...);
+      acqs, acquisitions per subject, cycling through the style's
+        target words; nframes, frames per acquisition;
+      geometry, (nscanlines, npoints, junk); style, 'suzhou' or
+        'nasalcoda'; fps, frame rate; sidecars, also write compiled
+        tier sidecars; seed, random seed.
+    Outputs: dict with 'subjects' (list of subject directories),
+      'acqs' and 'frames' (totals) and 'bytes' (size of the .raw data).
+    '''
+    if style not in STYLES:
+        raise ValueError("Unknown style {}; use one of {}".format(style, sorted(STYLES)))
+    st = STYLES[style]
+    os.makedirs(expdir)
+    if 'segments' in st:
+        with open(os.path.join(expdir, "words.txt"), 'w') as fh:
+            fh.writelines(w + "\n" for w,_ in st['words'])
+        with open(os.path.join(expdir, "segments.txt"), 'w') as fh:
+            fh.writelines(s + "\n" for s in st['segments'])
+
+    nscanlines, npoints, junk = geometry
+    start = datetime(2015, 1, 1, 10, 0, 0)
+    subjdirs = []
+    for s in range(subjects):
+        subjdir = os.path.join(expdir, "subj{}".format(s + 1))
+        os.makedirs(subjdir)
+        for a in range(acqs):
+            word, phones = st['words'][a % len(st['words'])]
+            ts = (start + timedelta(days=s, seconds=30 * a)).strftime("%Y-%m-%dT%H_%M_%S")
+            make_acquisition(subjdir, ts, word, phones, style=style, nframes=nframes,
+                             geometry=geometry, fps=fps, sidecars=sidecars,
+                             seed=seed + s * acqs + a)
+        subjdirs.append(subjdir)
+    total = subjects * acqs * nframes
+    return {
+        'subjects': subjdirs,
+        'acqs': subjects * acqs,
+        'frames': total,
+        'bytes': total * nscanlines * npoints,
+    }
@@ -0,0 +1,346 @@
+'''
+tiers: compiled, array-backed TextGrid tiers with an on-disk sidecar cache.
+
+Parsing a Praat TextGrid with audiolabel is slow, especially for
+  .sync.TextGrid files, which hold one interval per ultrasound frame.
+  load_tiers() parses a TextGrid once, compiles each tier into NumPy
+  arrays (t1, t2, integer label codes and a table of label strings),
+  and stores them in a sidecar .npz file next to the TextGrid
+  (acq.ch1.TextGrid -> acq.ch1.tiers.npz). Later calls load the sidecar
+  instead, as long as the TextGrid's modification time and size, or
+  failing that its SHA-1 hash, still match the ones recorded. Where the
+  sidecar can't be written (e.g. a read-only data directory), the
+  TextGrid is simply parsed every time.
+
+Tier objects support the parts of audiolabel's tier interface used in
+  the scripts here (iteration, search, label_at, prev, next), so they
+  can stand in for pm.tier(name). They also answer the same questions
+  for whole arrays at once (labels_at, overlapping, prev_nonsilent,
+  next_nonsilent) using binary search over the sorted label times.
+'''
+
+import json
+import os
+import re
+
+from collections import namedtuple
+from hashlib import sha1
+
+import numpy as np
+
+SIDECAR_VERSION = 1
+
+# labels treated as silence when looking for segmental context
+SILENCE_LABELS = ["sp", "sil", ""]
+
+class Label(namedtuple('Label', ['t1', 't2', 'text', 'idx'])):
+    '''
+    A single label in a compiled tier; idx is its position in the tier.
+    '''
+    __slots__ = ()
+
+    @property
+    def center(self):
+        if self.t2 is None:
+            return self.t1
+        return (self.t1 + self.t2) / 2.0
+
+class Tier(object):
+    '''
+    Array-backed TextGrid tier.
+    Inputs: name, tier name;
+      t1, t2: label start and end times (t2 is NaN for point tiers);
+      codes: integer index of each label's text into labels;
+      labels: array of unique label strings.
+    '''
+    def __init__(self, name, t1, t2, codes, labels):
+        self.name = name
+        self.t1 = np.asarray(t1, dtype=np.float64)
+        self.t2 = np.asarray(t2, dtype=np.float64)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.labels = np.asarray(labels, dtype=str)
+
+    @classmethod
+    def from_labels(cls, name, labs):
+        '''
+        Compile a tier from an iterable of labels with t1, t2 and text
+          attributes (e.g. an audiolabel tier).
+        '''
+        t1, t2, text = [], [], []
+        for lab in labs:
+            t1.append(lab.t1)
+            t2.append(np.nan if lab.t2 is None else lab.t2)
+            text.append("" if lab.text is None else lab.text)
+        labels, codes = np.unique(np.array(text, dtype=str), return_inverse=True)
+        return cls(name, t1, t2, codes, labels)
+
+    def __len__(self):
+        return len(self.t1)
+
+    @property
+    def text(self):
+        '''
+        Label text of every label in the tier, as a string array.
+        '''
+        return self.labels[self.codes]
+
+    @property
+    def center(self):
+        return np.where(np.isnan(self.t2), self.t1, (self.t1 + self.t2) / 2.0)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Label index {} out of range in tier {}".format(idx, self.name))
+        t2 = self.t2[idx]
+        return Label(float(self.t1[idx]),
+                     None if np.isnan(t2) else float(t2),
+                     str(self.labels[self.codes[idx]]),
+                     int(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def match_codes(self, pattern):
+        '''
+        Return a boolean array over the label table, True for label
+          strings matching the regular expression pattern (re.match).
+        '''
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        return np.array([pattern.match(l) is not None for l in self.labels], dtype=bool)
+
+    def search(self, pattern, return_match=False):
+        '''
+        Return labels whose text matches pattern, as in audiolabel; the
+          regular expression is run once per distinct label string.
+        '''
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        hits = np.flatnonzero(self.match_codes(pattern)[self.codes])
+        out = []
+        for idx in hits:
+            lab = self[idx]
+            if return_match:
+                out.append((lab, pattern.match(lab.text)))
+            else:
+                out.append(lab)
+        return out
+
+    def labels_at(self, times):
+        '''
+        Return the index of the label at each of times (t1 <= t < t2;
+          the end point of the final label also counts), or -1 where
+          no label covers the time.
+        Inputs: times, a scalar or array of times in seconds.
+        Outputs: int array of label indices, same shape as times.
+        '''
+        t = np.asarray(times, dtype=np.float64)
+        idx = np.searchsorted(self.t1, t, side='right') - 1
+        safe = np.clip(idx, 0, max(len(self) - 1, 0))
+        if len(self) == 0:
+            return np.full(t.shape, -1, dtype=np.intp)
+        end = self.t2[safe]
+        inside = np.isnan(end) | (t < end)
+        inside |= (safe == len(self) - 1) & (t == end)
+        return np.where((idx >= 0) & inside, idx, -1)
+
+    def label_at(self, t):
+        '''
+        Return the label at time t (t1 <= t < t2), or None.
+        '''
+        idx = int(self.labels_at(t))
+        if idx < 0:
+            return None
+        return self[idx]
+
+    def overlapping(self, t1, t2):
+        '''
+        Return indices of the labels overlapping the interval [t1, t2],
+          i.e. starting before t2 and ending after t1.
+        '''
+        start = np.searchsorted(self.t2, t1, side='right')
+        end = np.searchsorted(self.t1, t2, side='left')
+        return np.arange(start, max(start, end))
+
+    def _nonsilent_idx(self, silence):
+        silent = np.isin(self.labels, list(silence))
+        return np.flatnonzero(~silent[self.codes])
+
+    def prev_nonsilent(self, idxs, silence=SILENCE_LABELS):
+        '''
+        Return the index of the nearest preceding label whose text is
+          not in silence, for each of idxs (-1 if there is none).
+        '''
+        keep = self._nonsilent_idx(silence)
+        j = np.searchsorted(keep, idxs, side='left') - 1
+        if len(keep) == 0:
+            return np.full(np.shape(idxs), -1, dtype=np.intp)
+        return np.where(j >= 0, keep[np.clip(j, 0, None)], -1)
+
+    def next_nonsilent(self, idxs, silence=SILENCE_LABELS):
+        '''
+        Return the index of the nearest following label whose text is
+          not in silence, for each of idxs (-1 if there is none).
+        '''
+        keep = self._nonsilent_idx(silence)
+        j = np.searchsorted(keep, idxs, side='right')
+        if len(keep) == 0:
+            return np.full(np.shape(idxs), -1, dtype=np.intp)
+        return np.where(j < len(keep), keep[np.clip(j, 0, len(keep) - 1)], -1)
+
+    def prev_label(self, label, silence=SILENCE_LABELS):
+        '''
+        Return the nearest non-silent label before label, or None.
+        '''
+        idx = int(self.prev_nonsilent(label.idx, silence=silence))
+        return None if idx < 0 else self[idx]
+
+    def next_label(self, label, silence=SILENCE_LABELS):
+        '''
+        Return the nearest non-silent label after label, or None.
+        '''
+        idx = int(self.next_nonsilent(label.idx, silence=silence))
+        return None if idx < 0 else self[idx]
+
+    def prev(self, label, skip=0):
+        '''
+        Return the label before label (skipping skip labels), or None.
+        '''
+        idx = label.idx - 1 - skip
+        if idx < 0:
+            return None
+        return self[idx]
+
+    def next(self, label, skip=0):
+        '''
+        Return the label after label (skipping skip labels), or None.
+        '''
+        if label is None:
+            return None
+        idx = label.idx + 1 + skip
+        if idx >= len(self):
+            return None
+        return self[idx]
+
+def sidecar_path(tg):
+    '''
+    Return the sidecar file name for TextGrid tg.
+    '''
+    base = os.path.splitext(tg)[0]
+    return base + ".tiers.npz"
+
+def _file_sha1(path):
+    h = sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def compile_textgrid(tg):
+    '''
+    Parse a Praat TextGrid with audiolabel and return a dict of
+      tier name -> Tier, in file order.
+    '''
+    import audiolabel
+    pm = audiolabel.LabelManager(from_file=tg, from_type="praat")
+    return {name: Tier.from_labels(name, pm.tier(name)) for name in pm.names}
+
+def write_sidecar(tg, tiers, st=None, digest=None):
+    '''
+    Store compiled tiers for tg in its sidecar file, keyed by the
+      TextGrid's mtime, size and SHA-1 hash.
+    '''
+    if st is None:
+        st = os.stat(tg)
+    if digest is None:
+        digest = _file_sha1(tg)
+    meta = {
+        'version': SIDECAR_VERSION,
+        'mtime': st.st_mtime,
+        'size': st.st_size,
+        'sha1': digest,
+        'tiers': list(tiers.keys()),
+    }
+    arrays = {'meta': np.array(json.dumps(meta))}
+    for i,tier in enumerate(tiers.values()):
+        arrays['{}_t1'.format(i)] = tier.t1
+        arrays['{}_t2'.format(i)] = tier.t2
+        arrays['{}_codes'.format(i)] = tier.codes
+        arrays['{}_labels'.format(i)] = tier.labels
+    sc = sidecar_path(tg)
+    tmp = sc + ".tmp"
+    with open(tmp, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp, sc)
+
+def _save_sidecar(tg, tiers, st, digest=None):
+    '''
+    write_sidecar(), skipped if the sidecar can't be written.
+    '''
+    try:
+        write_sidecar(tg, tiers, st=st, digest=digest)
+    except OSError:
+        try:
+            os.remove(sidecar_path(tg) + ".tmp")
+        except OSError:
+            pass
+
+def read_sidecar(tg):
+    '''
+    Return (meta, tiers) from tg's sidecar, or (None, None) if there is
+      no readable sidecar.
+    '''
+    sc = sidecar_path(tg)
+    try:
+        with np.load(sc, allow_pickle=False) as npz:
+            meta = json.loads(str(npz['meta']))
+            if meta.get('version') != SIDECAR_VERSION:
+                return None, None
+            tiers = {}
+            for i,name in enumerate(meta['tiers']):
+                tiers[name] = Tier(name,
+                    npz['{}_t1'.format(i)],
+                    npz['{}_t2'.format(i)],
+                    npz['{}_codes'.format(i)],
+                    npz['{}_labels'.format(i)])
+    except (IOError, OSError, ValueError, KeyError):
+        return None, None
+    return meta, tiers
+
+def load_tiers(tg, tiers=None, use_sidecar=True):
+    '''
+    Load compiled tiers for a TextGrid, from its sidecar if it is
+      current, otherwise by parsing the TextGrid (and refreshing the
+      sidecar).
+    Inputs: tg, path to the TextGrid; raises FileNotFoundError if it
+        doesn't exist;
+      tiers, optional list of tier names to return (default all);
+      use_sidecar, if False always parse and don't write a sidecar.
+    Outputs: dict of tier name -> Tier.
+    '''
+    st = os.stat(tg)
+    compiled = None
+    if use_sidecar:
+        meta, cached = read_sidecar(tg)
+        if meta is not None:
+            if meta['mtime'] == st.st_mtime and meta['size'] == st.st_size:
+                compiled = cached
+            else:
+                # touched but maybe not changed; fall back to the hash
+                digest = _file_sha1(tg)
+                if digest == meta['sha1']:
+                    compiled = cached
+                    _save_sidecar(tg, compiled, st, digest)
+    if compiled is None:
+        compiled = compile_textgrid(tg)
+        if use_sidecar:
+            _save_sidecar(tg, compiled, st)
+    if tiers is not None:
+        missing = [name for name in tiers if name not in compiled]
+        if missing:
+            raise KeyError("Tier(s) {} not found in {}".format(missing, tg))
+        compiled = {name: compiled[name] for name in tiers}
+    return compiled
@@ -0,0 +1,164 @@
+'''
+timing: where processing time goes, and how far along it is.
+
+A StageTimer adds up wall-clock and CPU time, calls and frames for
+  each named stage of processing a cache (load, verify, mean, mask,
+  srad, convert, clean, hash, store, save):
+
+    timer = StageTimer()
+    with timer.stage('load'):
+        frames = np.load(...)
+
+  FramePipeline (ultramisc.procframes) times its own stages with the
+  timer it is given; worker processes time theirs separately and send
+  the totals back to be merged, so stage times are summed over workers
+  and can add up to more than the elapsed time of a parallel run.
+  timer.report() gives the totals as a dict, which write_timing()
+  stores next to a cache as JSON (frames_proc.npy ->
+  frames_proc_timing.json).
+
+A Progress is a progress function for process_frames() (or any loop)
+  that prints at most one line every PROGRESS_INTERVAL seconds, with
+  the rate and the estimated time left, instead of one line per frame.
+'''
+
+import contextlib
+import datetime
+import json
+import os
+import time
+
+# suffix of the timing report written next to a cache
+TIMING_SUFFIX = "_timing.json"
+
+# least number of seconds between progress lines
+PROGRESS_INTERVAL = 2.0
+
+class StageTimer(object):
+    '''
+    Cumulative wall-clock and CPU time per stage.
+    Attributes: stages, dict mapping each stage name to a dict of its
+      wall and cpu seconds, calls and frames.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def add(self, name, wall, cpu, frames=0, calls=1):
+        '''
+        Add wall and cpu seconds, frames and calls to stage name.
+        '''
+        stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0, 'frames': 0})
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['calls'] += calls
+        stage['frames'] += frames
+
+    @contextlib.contextmanager
+    def stage(self, name, frames=0):
+        '''
+        Context manager timing its block as one call of stage name,
+          covering frames frames.
+        '''
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu, frames)
+
+    def timed(self, name, iterable, count=None):
+        '''
+        Iterate over iterable, timing each step as one call of stage
+          name; count, optional function giving the number of frames
+          in an item.
+        '''
+        items = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu,
+                     0 if count is None else count(item))
+            yield item
+
+    def merge(self, stages):
+        '''
+        Add the stage totals of another timer (its stages attribute).
+        '''
+        for name,stage in stages.items():
+            self.add(name, stage['wall'], stage['cpu'], stage['frames'], stage['calls'])
+
+    def report(self, frames=None, **extra):
+        '''
+        Return the totals as a dict: elapsed wall and (this process's)
+          cpu seconds, stages, and, given the number of frames
+          processed, frames and frames_per_sec; extra items are added
+          as they are.
+        '''
+        wall = time.perf_counter() - self.start
+        report = dict(extra, wall=round(wall, 6),
+                      cpu=round(time.process_time() - self.cpu_start, 6),
+                      stages={name: {'wall': round(stage['wall'], 6), 'cpu': round(stage['cpu'], 6),
+                                     'calls': stage['calls'], 'frames': stage['frames']}
+                              for name,stage in self.stages.items()})
+        if frames is not None:
+            report['frames'] = frames
+            report['frames_per_sec'] = round(frames / wall, 3) if wall > 0 else None
+        return report
+
+def write_timing(dirpath, stem, report):
+    '''
+    Store a timing report (from StageTimer.report()) for the cache
+      called stem in dirpath; return its path.
+    '''
+    path = os.path.join(dirpath, stem + TIMING_SUFFIX)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as out:
+        json.dump(report, out, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+    return path
+
+def _duration(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+class Progress(object):
+    '''
+    Rate-limited progress lines, e.g.
+      "\tFiltered 640 of 2400 frames (48.2 frames/s, ETA 0:00:36)".
+    Inputs: verb and unit, words in the line;
+      interval, least seconds between lines (the last one is always
+        printed).
+    Call with (done, total). The rate is measured from the first call,
+      so that work skipped before it (e.g. frames read from a store)
+      doesn't inflate it.
+    '''
+    def __init__(self, verb="Processed", unit="frames", interval=PROGRESS_INTERVAL):
+        self.verb = verb
+        self.unit = unit
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._first = None
+        self._printed = None
+
+    def __call__(self, done, total):
+        now = time.perf_counter()
+        if self._first is None:
+            self._first = (done, now)
+            rate = done / (now - self.start) if now > self.start else 0
+        else:
+            first_done, first_time = self._first
+            rate = (done - first_done) / (now - first_time) if now > first_time else 0
+        if done < total and self._printed is not None and now - self._printed < self.interval:
+            return
+        self._printed = now
+        if done >= total:
+            eta = "done in {}".format(_duration(now - self.start))
+        elif rate > 0:
+            eta = "ETA {}".format(_duration((total - done) / rate))
+        else:
+            eta = "ETA unknown"
+        print("\t{} {} of {} {} ({:.1f} {}/s, {})".format(
+            self.verb, done, total, self.unit, rate, self.unit, eta))